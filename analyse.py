@@ -1,5 +1,10 @@
-from db import (get_elapsed_time, get_periodicity)
+from db import (habit_cache, log_change, periodicity_code, periodicity_name, DAILY, WEEKLY)
 from datetime import date
+from typing import NamedTuple
+
+# Status reported by habit_status for a habit already completed in its current period. A weekdays habit completed
+# on Friday is still done over the weekend, so it reports "completed this period" rather than "completed today".
+COMPLETED_STATUS = {DAILY: 3, WEEKLY: 4}
 
 
 def get_habit_names(db):
@@ -9,10 +14,17 @@ def get_habit_names(db):
     :param db: the database connection object
     :return: a list of habit names
     """
+    cache = habit_cache(db)
+    if cache is not None:
+        names = cache.get_names()
+        if names is not None:
+            return names
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
     cur.execute("SELECT name FROM habits")
     data = cur.fetchall()
+    if cache is not None:
+        cache.put_names(data)
     return data
 
 
@@ -24,10 +36,10 @@ def return_max_habit_streaks(db):
     Return:
     - The maximum habit streak.
     """
-    habits = get_habit_names(db)
-    for i in range(len(habits)):
-        streaks = get_streak_counter(db, habits[i])
-        return max(str(streaks))
+    cur = db.cursor()
+    cur.row_factory = lambda cursor, row: row[0]
+    cur.execute("SELECT MAX(bestStreak) FROM habit_stats")
+    return cur.fetchone()
 
 
 def get_name_of_longest_streak(db):
@@ -42,7 +54,7 @@ def get_name_of_longest_streak(db):
     """
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
-    cur.execute("SELECT DISTINCT habitName FROM tracker WHERE streakCounter = ?", (return_max_habit_streaks(db),))
+    cur.execute("SELECT habitName FROM habit_stats WHERE bestStreak = (SELECT MAX(bestStreak) FROM habit_stats)")
     data = cur.fetchall()
     concatenated_data = ""
     for x in range(len(data)):
@@ -55,7 +67,7 @@ def get_name_of_longest_streak(db):
 
 def habit_status(db, habit):
     """
-    Generate and return the status of a habit based on elapsed time and habit periodicity.
+    Generate and return the status of a habit by comparing today with its stored next due day and deadline.
 
     Parameters:
     db (database): The database containing habit data.
@@ -64,23 +76,22 @@ def habit_status(db, habit):
     Returns:
     int: The status code indicating the habit status.
     """
-    data = get_elapsed_time(db, habit)
-    habit_period = str(get_periodicity(db, habit))[2:-3]
-    if data == 1 and habit_period == "daily":
-        return 1
-        # 1 = Habit is ready to complete again
-    if data == 7 and habit_period == "weekly":
+    cur = db.cursor()
+    cur.execute("SELECT periodicity, nextDue, deadline FROM habit_stats JOIN habits ON name = habitName "
+                "WHERE habitName = ?", (habit,))
+    row = cur.fetchone()
+    today = date.today().toordinal()
+    if row is None or row[2] is None or today > row[2]:
+        return 2
+        # 2 = Habit has been broken
+    elif today >= row[1]:
         return 1
         # 1 = Habit is ready to complete again
-    elif data < 1 and habit_period == "daily":
-        return 3
+    else:
+        return COMPLETED_STATUS.get(row[0], 5)
         # 3 = Habit has been marked completed already today
-    elif data < 7 and habit_period == "weekly":
-        return 4
         # 4 = Habit has been marked completed already this week
-    else:
-        return 2
-        # 2 = Habit has been broken
+        # 5 = Habit has been marked completed already this month or period
 
 
 def break_streak(db, habit):
@@ -91,10 +102,52 @@ def break_streak(db, habit):
     - db: the database connection
     - habit: the name of the habit to break the streak for
     """
+    today = date.today().toordinal()
+    cur = db.cursor()
+    cur.execute("INSERT or IGNORE INTO tracker SELECT ?1, ?2, 0 WHERE EXISTS (SELECT 1 FROM habits WHERE name = ?2)",
+                (today, habit))
+    changed = cur.rowcount == 1
+    cur.execute("UPDATE tracker SET streakCounter = 0 WHERE habitName = ? AND date = ? AND streakCounter IS NOT 0",
+                (habit, today))
+    # A habit that does not exist, or whose streak is already broken today, is left unchanged and not logged
+    if changed or cur.rowcount == 1:
+        log_change(db, cur, "break", habit)
+    db.commit()
+
+
+def sweep_broken_streaks(db):
+    """
+    Break the streak of every habit whose deadline has passed without it being completed, or that has no deadline,
+    e.g. a habit without a periodicity.
+    Equivalent to calling break_streak on each habit for which habit_status returns 2, but broken habits are found
+    through the deadline index, reset with one executemany and committed once. Habits without a habit_stats row,
+    which imports made before stats were refreshed for every imported habit can have left behind, are not found
+    until rebuild_habit_stats gives them one.
+
+    Parameters:
+    - db: the database connection
+
+    Returns:
+    - The number of habits whose streak was broken
+    """
+    today = date.today().toordinal()
     cur = db.cursor()
-    cur.execute("INSERT or IGNORE INTO tracker VALUES (?, ?, 0)", (date.today(), habit))
-    cur.execute("UPDATE tracker SET streakCounter = 0 WHERE habitName = ? AND date = ?", (habit, date.today()))
+    # Broken habits are read first, the triggers on tracker move their deadlines as rows are inserted. A habit whose
+    # streak is already broken today is left out, as break_streak leaves it unchanged.
+    cur.execute("""SELECT habit_stats.habitName, tracker.date IS NOT NULL FROM habit_stats
+        JOIN habits ON name = habit_stats.habitName
+        LEFT JOIN tracker ON tracker.habitName = habit_stats.habitName AND date = ?1
+        WHERE (deadline < ?1 OR deadline IS NULL) AND streakCounter IS NOT 0""", (today,))
+    broken = cur.fetchall()
+    cur.executemany("INSERT or IGNORE INTO tracker VALUES (?, ?, 0)",
+                    ((today, name) for name, completed in broken if not completed))
+    # Only a habit without a deadline can have been completed today and still be broken
+    cur.executemany("UPDATE tracker SET streakCounter = 0 WHERE habitName = ? AND date = ?",
+                    ((name, today) for name, completed in broken if completed))
+    for name, _ in broken:
+        log_change(db, cur, "break", name)
     db.commit()
+    return len(broken)
 
 
 def get_streak_counter(db, habit):
@@ -119,7 +172,7 @@ def get_streak_counter(db, habit):
 
 def get_single_alltime_streak(db, habit):
     """
-    Returns the highest streak counter value for a specific habit from the tracker database.
+    Returns the highest streak counter value for a specific habit from the habit_stats summary.
 
     Parameters:
     - db: The database connection object.
@@ -130,14 +183,14 @@ def get_single_alltime_streak(db, habit):
     """
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
-    cur.execute("SELECT MAX(streakCounter) FROM tracker WHERE habitName = ?", (habit,))
+    cur.execute("SELECT bestStreak FROM habit_stats WHERE habitName = ?", (habit,))
     data = cur.fetchone()
     return data
 
 
 def get_alltime_streak(db, periodicity):
     """
-    Returns the highest streak counter value for a given periodicity from the tracker database.
+    Returns the highest streak counter value for a given periodicity from the habit_stats summary.
 
     Parameters:
     - db: The database connection object.
@@ -148,8 +201,8 @@ def get_alltime_streak(db, periodicity):
     """
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
-    cur.execute("SELECT MAX(streakCounter) FROM tracker WHERE habitName IN "
-                "(SELECT name FROM habits WHERE periodicity = ?)", (periodicity,))
+    cur.execute("SELECT MAX(bestStreak) FROM habit_stats JOIN habits ON name = habitName "
+                "WHERE periodicity = ?", (periodicity_code(periodicity),))
     streak_value = cur.fetchone()
     return streak_value
 
@@ -168,11 +221,9 @@ def get_alltime_habit(db, periodicity):
     streak_value = get_alltime_streak(db, periodicity)
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
-    cur.execute("SELECT name FROM habits WHERE periodicity = ?", (periodicity,))
-    periodic_habit_names = cur.fetchall()
-    cur.execute("SELECT habitName FROM tracker WHERE streakCounter = ?", (streak_value,))
-    streak_habit_names = cur.fetchall()
-    data = [i for i in streak_habit_names if i in periodic_habit_names]
+    cur.execute("SELECT habitName FROM habit_stats JOIN habits ON name = habitName "
+                "WHERE periodicity = ? AND bestStreak = ?", (periodicity_code(periodicity), streak_value))
+    data = cur.fetchall()
     concatenated_data = ""
     for x in range(len(data)):
         if x == 0:
@@ -192,7 +243,7 @@ def get_habits_by_periodicity(db, periodicity):
     """
     cur = db.cursor()
     cur.row_factory = lambda cursor, row: row[0]
-    cur.execute("SELECT DISTINCT name FROM habits WHERE periodicity = ?", (periodicity,))
+    cur.execute("SELECT DISTINCT name FROM habits WHERE periodicity = ?", (periodicity_code(periodicity),))
     data = cur.fetchall()
     concatenated_data = ""
     for x in range(len(data)):
@@ -201,3 +252,39 @@ def get_habits_by_periodicity(db, periodicity):
         else:
             concatenated_data += ", " + str(data[x])
     return concatenated_data
+
+
+class StreakRank(NamedTuple):
+    """
+    One entry of the streak leaderboard returned by top_streaks.
+
+    rank: 1 for the longest streak, tied habits share a rank and the next rank is skipped
+    name: the habit name
+    periodicity: the habit's periodicity name
+    streak: the current or all-time streak
+    """
+    rank: int
+    name: str
+    periodicity: str
+    streak: int
+
+
+def top_streaks(db, k=10, current=False, periodicity=None):
+    """
+    Rank habits by streak in a single query over the habit_stats summary.
+    Every habit tied with the k-th place is included, so more than k entries can be returned.
+
+    :param db: The database connection object.
+    :param k: The number of places to return.
+    :param current: Rank by current streak instead of all-time best streak.
+    :param periodicity: Only rank habits of this periodicity, e.g. "weekly".
+    :return: A list of StreakRank, ordered by rank and then name.
+    """
+    column = "currentStreak" if current else "bestStreak"
+    where, parameters = ("", ()) if periodicity is None else ("WHERE periodicity = ?", (periodicity_code(periodicity),))
+    cur = db.cursor()
+    cur.execute(f"""SELECT rank, habitName, periodicity, streak FROM (
+            SELECT habitName, periodicity, {column} AS streak, RANK() OVER (ORDER BY {column} DESC) AS rank
+            FROM habit_stats JOIN habits ON name = habitName {where})
+        WHERE rank <= ? ORDER BY rank, habitName""", (*parameters, k))
+    return [StreakRank(rank, name, periodicity_name(code), streak) for rank, name, code, streak in cur.fetchall()]
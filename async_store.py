@@ -0,0 +1,107 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import analyse
+import db
+from db import ConnectionManager
+
+
+class AsyncHabitStore:
+    """
+    asyncio facade over db.py and analyse.py.
+    Every call runs on a thread pool so the event loop never blocks on SQLite. Writes go to a single dedicated
+    writer thread, which is all SQLite allows at once anyway, while reads are spread over a pool of reader threads
+    that run concurrently thanks to WAL. Each thread uses its own connection from a ConnectionManager.
+
+    Parameters
+    ----------
+    name : str
+        The name of the database file
+    readers : int
+        Number of reader threads
+    max_pending : int
+        Maximum number of calls queued or running at once, further calls wait for a free slot
+    """
+
+    def __init__(self, name="main.db", readers=4, max_pending=1000):
+        self.manager = ConnectionManager(name)
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="habit-writer")
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="habit-reader")
+        self._pending = asyncio.Semaphore(max_pending)
+
+    def _call(self, function, args):
+        return function(self.manager.connection(), *args)
+
+    async def _run(self, executor, function, *args):
+        async with self._pending:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, self._call, function, args)
+
+    async def _write(self, function, *args):
+        return await self._run(self._writer, function, *args)
+
+    async def _read(self, function, *args):
+        return await self._run(self._readers, function, *args)
+
+    async def add_habit(self, name, description, periodicity):
+        return await self._write(db.add_habit, name, description, periodicity)
+
+    async def update_habit(self, name, description, periodicity):
+        return await self._write(db.update_habit, name, description, periodicity)
+
+    async def remove_habit(self, name):
+        return await self._write(db.remove_habit, name)
+
+    async def complete_habit(self, name):
+        return await self._write(db.complete_habit, name)
+
+    async def break_streak(self, name):
+        return await self._write(analyse.break_streak, name)
+
+    async def sweep_broken_streaks(self):
+        return await self._write(analyse.sweep_broken_streaks)
+
+    async def get_habits(self):
+        return await self._read(db.get_habits)
+
+    async def get_habit_names(self):
+        return await self._read(analyse.get_habit_names)
+
+    async def habit_status(self, name):
+        return await self._read(analyse.habit_status, name)
+
+    async def get_streak_counter(self, name):
+        return await self._read(analyse.get_streak_counter, name)
+
+    async def get_single_alltime_streak(self, name):
+        return await self._read(analyse.get_single_alltime_streak, name)
+
+    async def get_alltime_streak(self, periodicity):
+        return await self._read(analyse.get_alltime_streak, periodicity)
+
+    async def get_alltime_habit(self, periodicity):
+        return await self._read(analyse.get_alltime_habit, periodicity)
+
+    async def return_max_habit_streaks(self):
+        return await self._read(analyse.return_max_habit_streaks)
+
+    async def get_name_of_longest_streak(self):
+        return await self._read(analyse.get_name_of_longest_streak)
+
+    async def top_streaks(self, k=10, current=False, periodicity=None):
+        return await self._read(analyse.top_streaks, k, current, periodicity)
+
+    def close(self):
+        """
+        Wait for queued calls to finish, then stop the threads and close their connections.
+        :return: None
+        """
+        self._writer.shutdown()
+        self._readers.shutdown()
+        self.manager.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
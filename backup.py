@@ -0,0 +1,237 @@
+import argparse
+import csv
+import json
+from collections import Counter
+from datetime import date
+from itertools import groupby, islice
+from operator import itemgetter
+
+from db import get_db, bulk_load, log_changes, periodicity_code, periodicity_name, segment_rows, INSERT_HISTORY_ROW
+
+# Columns written for each table, in table order
+TABLES = {
+    "habits": ("name", "description", "periodicity"),
+    "tracker": ("date", "habitName", "streakCounter"),
+}
+CHUNK_SIZE = 10000
+
+
+def portable_row(table, row):
+    """
+    Convert a stored row to the form written to backup files: periodicity names and ISO dates.
+    """
+    if table == "habits":
+        return row[0], row[1], periodicity_name(row[2])
+    return date.fromordinal(row[0]).isoformat(), row[1], row[2]
+
+
+def stored_row(table, row):
+    """
+    Convert a row read from a backup file to the form stored in the database: periodicity codes and day numbers.
+    A habit without a periodicity keeps none, an unknown periodicity raises ValueError.
+    """
+    if table == "habits":
+        code = periodicity_code(row[2]) if row[2] else None
+        if row[2] and code is None:
+            raise ValueError(f"Unknown periodicity {row[2]!r} for habit {row[0]!r} in import")
+        return row[0], row[1], code
+    return date.fromisoformat(row[0]).toordinal(), row[1], row[2]
+
+
+def detect_format(path):
+    """
+    Work out the file format from the file extension.
+
+    :param path: path of the backup file
+    :return: "csv" or "jsonl"
+    """
+    if str(path).endswith(".csv"):
+        return "csv"
+    if str(path).endswith((".jsonl", ".ndjson")):
+        return "jsonl"
+    raise ValueError(f"Cannot tell the format of {path}, use a .csv or .jsonl file")
+
+
+def iter_table_rows(db, chunk_size=CHUNK_SIZE):
+    """
+    Stream every habit and tracker row out of the database.
+    Rows are fetched chunk_size at a time, so memory use does not depend on the size of the history.
+
+    :param db: the database connection object
+    :param chunk_size: number of rows fetched per round trip
+    :return: a generator of (table, row) tuples, all habits before any tracker rows
+    """
+    for table, columns in TABLES.items():
+        cur = db.cursor()
+        cur.execute(f"SELECT {', '.join(columns)} FROM {table}")
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield table, portable_row(table, row)
+    # Compacted history is written back out as the tracker rows it stands for, so backups stay row for row
+    cur = db.cursor()
+    cur.execute("SELECT habitName, startDate, endDate, startStreak, length FROM tracker_segments")
+    while True:
+        segments = cur.fetchmany(chunk_size)
+        if not segments:
+            break
+        for name, *segment in segments:
+            for day, streak in segment_rows(*segment):
+                yield "tracker", portable_row("tracker", (day, name, streak))
+
+
+def write_rows(rows, file, fmt):
+    """
+    Write (table, row) tuples to an open text file.
+
+    :param rows: an iterable of (table, row) tuples
+    :param file: a file object opened for writing text
+    :param fmt: "csv" or "jsonl"
+    :return: the number of rows written
+    """
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(file)
+        for table, row in rows:
+            writer.writerow((table, *row))
+            count += 1
+    else:
+        for table, row in rows:
+            record = {"table": table, **dict(zip(TABLES[table], row))}
+            file.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+
+def read_rows(file, fmt):
+    """
+    Parse (table, row) tuples from an open text file, one line at a time.
+
+    :param file: a file object opened for reading text
+    :param fmt: "csv" or "jsonl"
+    :return: a generator of (table, row) tuples
+    """
+    if fmt == "csv":
+        for record in csv.reader(file):
+            if not record:
+                continue
+            table, *row = record
+            if table == "tracker":
+                row[2] = int(row[2])
+            yield table, tuple(row)
+    else:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            table = record["table"]
+            yield table, tuple(record[column] for column in TABLES[table])
+
+
+def insert_rows(db, rows, chunk_size=CHUNK_SIZE):
+    """
+    Insert (table, row) tuples with executemany, chunk_size rows at a time.
+    Rows that already exist (same habit name, or same habit and date, compacted days included) are kept as they are.
+    The habit_stats summary is refreshed once per imported habit rather than once per row. Likewise, each habit the
+    import changed gets a single "import" change in the log, saying whether the habit was added and how many tracker
+    rows were, instead of a change per row.
+    Nothing is committed, the caller owns the transaction.
+
+    :param db: the database connection object
+    :param rows: an iterable of (table, row) tuples
+    :param chunk_size: number of rows per executemany call
+    :return: a dict with the number of rows read per table
+    """
+    counts = {table: 0 for table in TABLES}
+    added = set()
+    # Habit name -> tracker rows inserted for it
+    inserted = Counter()
+    with bulk_load(db) as touched:
+        cur = db.cursor()
+        for table, group in groupby(rows, key=lambda item: item[0]):
+            if table not in TABLES:
+                raise ValueError(f"Unknown table {table!r} in import")
+            if table == "habits":
+                statement = f"INSERT or IGNORE INTO {table} ({', '.join(TABLES[table])}) VALUES (?, ?, ?)"
+            else:
+                statement = INSERT_HISTORY_ROW
+            group = (row for _, row in group)
+            while True:
+                chunk = [stored_row(table, row) for row in islice(group, chunk_size)]
+                if not chunk:
+                    break
+                if table == "habits":
+                    # The habits not stored yet are found with one query per chunk
+                    cur.execute("SELECT value FROM json_each(?) EXCEPT SELECT name FROM habits",
+                                (json.dumps([row[0] for row in chunk]),))
+                    added.update(name for name, in cur.fetchall())
+                    cur.executemany(statement, chunk)
+                    # Every imported habit gets a habit_stats row, including habits without tracker rows
+                    touched.update(row[0] for row in chunk)
+                else:
+                    # One executemany per habit in the chunk, its rowcount is the number of rows inserted for it
+                    chunk.sort(key=itemgetter(1))
+                    for name, habit_rows in groupby(chunk, key=itemgetter(1)):
+                        cur.executemany(statement, habit_rows)
+                        inserted[name] += cur.rowcount
+                        touched.add(name)
+                counts[table] += len(chunk)
+        today = date.today().toordinal()
+        log_changes(db, cur, [("import", name, today, {"added": name in added, "rows": inserted[name]})
+                              for name in sorted(added | {name for name, count in inserted.items() if count})])
+    return counts
+
+
+def export_data(db, path, fmt=None, chunk_size=CHUNK_SIZE):
+    """
+    Export all habits and tracker history to a CSV or JSONL file.
+
+    :param db: the database connection object
+    :param path: path of the file to write
+    :param fmt: "csv" or "jsonl", guessed from the file extension if not given
+    :param chunk_size: number of rows fetched per round trip
+    :return: the number of rows written
+    """
+    fmt = fmt or detect_format(path)
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        return write_rows(iter_table_rows(db, chunk_size), file, fmt)
+
+
+def import_data(db, path, fmt=None, chunk_size=CHUNK_SIZE):
+    """
+    Import habits and tracker history from a CSV or JSONL file written by export_data.
+    The whole file is applied in one transaction, either every row is imported or none are.
+
+    :param db: the database connection object
+    :param path: path of the file to read
+    :param fmt: "csv" or "jsonl", guessed from the file extension if not given
+    :param chunk_size: number of rows per executemany call
+    :return: a dict with the number of rows read per table
+    """
+    fmt = fmt or detect_format(path)
+    try:
+        with open(path, newline="", encoding="utf-8") as file:
+            counts = insert_rows(db, read_rows(file, fmt), chunk_size)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Back up or restore habits and tracker history.")
+    parser.add_argument("action", choices=["export", "import"])
+    parser.add_argument("path", help="a .csv or .jsonl file")
+    parser.add_argument("--db", default="main.db", help="the database file, defaults to main.db")
+    parser.add_argument("--format", choices=["csv", "jsonl"], help="file format, guessed from the extension")
+    args = parser.parse_args()
+    database = get_db(args.db)
+    if args.action == "export":
+        print(f"Exported {export_data(database, args.path, args.format)} rows")
+    else:
+        counts = import_data(database, args.path, args.format)
+        print(f"Imported {counts['habits']} habits and {counts['tracker']} tracker rows")
+    database.close()
@@ -0,0 +1,661 @@
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+import analyse
+import db as db_module
+from async_store import AsyncHabitStore
+from main import mark_complete
+from name_index import NameIndex
+from db import get_db, add_habit, bulk_load, periodicity_code
+
+# Size tiers for the suite, as (habits, years of history)
+TIERS = {
+    "small": (10, 1),
+    "medium": (100, 2),
+    "large": (1000, 3),
+}
+
+
+def bench_commits(count=2000):
+    """
+    Measure how many single-row commits per second add_habit reaches with SQLite's default settings
+    (rollback journal, synchronous=FULL) and with the tuned settings get_db applies.
+
+    :param count: number of habits added per mode
+    :return: a dict of mode to commits per second
+    """
+    results = {}
+    for mode, pragmas in (("default", {}), ("tuned", None)):
+        with tempfile.TemporaryDirectory() as directory:
+            db = get_db(os.path.join(directory, "bench.db"), pragmas)
+            start = time.perf_counter()
+            for i in range(count):
+                add_habit(db, f"habit {i}", "benchmark habit", "daily")
+            elapsed = time.perf_counter() - start
+            db.close()
+        results[mode] = count / elapsed
+    return results
+
+
+def bench_group_commit(count=2000, max_batch=100, synchronous="FULL"):
+    """
+    Measure completions per second for a stream of new habits, each added and then completed, with every call
+    committing on its own, with one transaction() per habit, and with a GroupCommitter.
+    synchronous=FULL makes every commit wait for an fsync, which is what grouping saves.
+
+    :param count: number of habits added and completed per mode
+    :param max_batch: writes per group commit
+    :param synchronous: the synchronous pragma to run with
+    :return: a dict of mode to (habits per second, commits)
+    """
+    def per_call(db, name):
+        add_habit(db, name, "benchmark habit", "daily")
+        db_module.complete_habit(db, name)
+
+    def unit_of_work(db, name):
+        with db_module.transaction(db):
+            per_call(db, name)
+
+    results = {}
+    for mode in ("per call", "transaction", "group"):
+        with tempfile.TemporaryDirectory() as directory:
+            db = get_db(os.path.join(directory, "bench.db"), dict(db_module.PRAGMAS, synchronous=synchronous))
+            start = time.perf_counter()
+            if mode == "group":
+                with db_module.GroupCommitter(db, max_batch, max_delay=1.0) as group:
+                    for i in range(count):
+                        per_call(db, f"habit {i}")
+                        group.tick(2)
+                commits = group.commits
+            else:
+                for i in range(count):
+                    (per_call if mode == "per call" else unit_of_work)(db, f"habit {i}")
+                commits = count * (2 if mode == "per call" else 1)
+            elapsed = time.perf_counter() - start
+            db.close()
+        results[mode] = (count / elapsed, commits)
+    return results
+
+
+def _stress_worker(path, names, rounds, seed):
+    """
+    Call mark_complete on every habit, in a shuffled order, `rounds` times over, in a worker process.
+    :return: (number of calls, number of calls that recorded a completion, seconds)
+    """
+    rng = random.Random(seed)
+    db = get_db(path)
+    calls = completions = 0
+    start = time.perf_counter()
+    for _ in range(rounds):
+        order = list(names)
+        rng.shuffle(order)
+        for name in order:
+            completions += mark_complete(db, name) in (1, 2)
+            calls += 1
+    elapsed = time.perf_counter() - start
+    db.close()
+    return calls, completions, elapsed
+
+
+def stress_completions(path, workers=8, habits=50, rounds=20, streak=5):
+    """
+    Complete the same habits from many processes at once and check that every habit was completed exactly once.
+    Half the habits were last completed yesterday and must continue their streak at streak + 1, the other half are
+    overdue and must be reset to 0. Every other call must find the habit completed already.
+
+    :param path: path of the database file to create
+    :param workers: number of worker processes
+    :param habits: number of habits
+    :param rounds: times each worker calls mark_complete on every habit
+    :param streak: streak the habits start with
+    :return: a dict with calls per second, completions and a list of (habit, expected, stored rows) that disagree
+    """
+    db = get_db(path)
+    names = [f"habit {i}" for i in range(habits)]
+    today = date.today().toordinal()
+    expected = {}
+    with bulk_load(db) as touched:
+        for i, name in enumerate(names):
+            db.execute("INSERT INTO habits VALUES (?, 'stress habit', ?)", (name, db_module.DAILY))
+            db.execute("INSERT INTO tracker VALUES (?, ?, ?)", (today - 1 - 2 * (i % 2), name, streak))
+            expected[name] = 0 if i % 2 else streak + 1
+        touched.update(names)
+    db.commit()
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        outcomes = list(pool.map(_stress_worker, [path] * workers, [names] * workers, [rounds] * workers,
+                                 range(workers)))
+    elapsed = time.perf_counter() - start
+    cur = db.cursor()
+    cur.execute("SELECT habitName, streakCounter FROM tracker WHERE date = ? ORDER BY habitName", (today,))
+    stored = {}
+    for name, value in cur.fetchall():
+        stored.setdefault(name, []).append(value)
+    db.close()
+    calls = sum(outcome[0] for outcome in outcomes)
+    return {
+        "workers": workers,
+        "calls": calls,
+        "calls_per_second": calls / elapsed,
+        "completions": sum(outcome[1] for outcome in outcomes),
+        "errors": [(name, expected[name], stored.get(name)) for name in names if stored.get(name) != [expected[name]]],
+    }
+
+
+def latency_summary(latencies):
+    """
+    Summarise a list of latencies in seconds.
+
+    :param latencies: a list of floats
+    :return: a dict with the count and the p50/p99/max latency in milliseconds
+    """
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "count": len(latencies),
+        "p50_ms": percentiles[49] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "max_ms": max(latencies) * 1000,
+    }
+
+
+async def async_load(store, habits=100, requests=2000, concurrency=200, write_ratio=0.5, seed=0):
+    """
+    Load generator for AsyncHabitStore: keeps `concurrency` calls in flight, mixing completions with status
+    checks, and records the latency of each call.
+
+    :param store: an AsyncHabitStore
+    :param habits: number of habits created before the run
+    :param requests: total number of calls issued
+    :param concurrency: number of calls kept in flight at once
+    :param write_ratio: share of calls that are completions
+    :param seed: seed for the operation mix
+    :return: a dict of operation to latency summary
+    """
+    names = [f"habit {i}" for i in range(habits)]
+    for name in names:
+        await store.add_habit(name, "load test habit", "daily")
+    rng = random.Random(seed)
+    operations = [(rng.random() < write_ratio, rng.choice(names)) for _ in range(requests)]
+    latencies = {"complete_habit": [], "habit_status": []}
+    queue = iter(operations)
+
+    async def worker():
+        for is_write, name in queue:
+            start = time.perf_counter()
+            if is_write:
+                await store.complete_habit(name)
+                latencies["complete_habit"].append(time.perf_counter() - start)
+            else:
+                await store.habit_status(name)
+                latencies["habit_status"].append(time.perf_counter() - start)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return {operation: latency_summary(values) for operation, values in latencies.items() if len(values) > 1}
+
+
+def bench_async(habits=100, requests=5000, concurrency=200, readers=4):
+    """
+    Run async_load against a fresh database and report latencies and overall throughput.
+
+    :return: a dict of operation to latency summary, plus "requests_per_second"
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        async def run():
+            async with AsyncHabitStore(os.path.join(directory, "bench.db"), readers=readers) as store:
+                start = time.perf_counter()
+                results = await async_load(store, habits, requests, concurrency)
+                results["requests_per_second"] = requests / (time.perf_counter() - start)
+                return results
+
+        return asyncio.run(run())
+
+
+def bench_http(habits=50, requests=5000, clients=8, write_ratio=0.1, cache_age=1.0, seed=0):
+    """
+    Load-test server.HabitServer on localhost: `clients` threads, each on one keep-alive connection, send a mix of
+    streak reads and completions.
+
+    :param habits: number of habits
+    :param requests: total number of requests
+    :param clients: number of concurrent client connections
+    :param write_ratio: share of requests that complete a habit
+    :param cache_age: seconds the server caches GET responses for, 0 to measure uncached reads
+    :param seed: random seed for the request mix
+    :return: a dict of request kind to latency summary, plus "requests_per_second" and "cache_hits"
+    """
+    import http.client
+    import threading
+    from urllib.parse import quote
+    from server import HabitServer
+
+    rng = random.Random(seed)
+    names = [quote(f"habit {i}") for i in range(habits)]
+    operations = [(rng.random() < write_ratio, rng.choice(names)) for _ in range(requests)]
+    latencies = {"complete": [], "streak": []}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        db = get_db(path)
+        for i in range(habits):
+            add_habit(db, f"habit {i}", "load test habit", "daily")
+        db.close()
+        server = HabitServer(("127.0.0.1", 0), path, pool_size=clients, cache_age=cache_age)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        queue = iter(operations)
+        lock = threading.Lock()
+
+        def client():
+            connection = http.client.HTTPConnection(*server.server_address)
+            while True:
+                with lock:
+                    operation = next(queue, None)
+                if operation is None:
+                    break
+                is_write, name = operation
+                start = time.perf_counter()
+                if is_write:
+                    connection.request("POST", f"/habits/{name}/complete")
+                else:
+                    connection.request("GET", f"/habits/{name}/streak")
+                connection.getresponse().read()
+                latencies["complete" if is_write else "streak"].append(time.perf_counter() - start)
+            connection.close()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=client) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        server.shutdown()
+        server.server_close()
+    results = {kind: latency_summary(values) for kind, values in latencies.items() if len(values) > 1}
+    results["requests_per_second"] = requests / elapsed
+    results["cache_hits"] = server.cache.hits
+    return results
+
+
+def bench_names(habits=10000, lookups=2000, seed=0):
+    """
+    Latency of NameIndex lookups over random habit names: exact and case-insensitive resolution, a two-letter prefix
+    as typed into the menu, and "did you mean" suggestions for a misspelt name.
+
+    :param habits: number of names indexed
+    :param lookups: lookups per kind
+    :param seed: random seed for the names
+    :return: a dict of lookup kind to latency summary
+    """
+    rng = random.Random(seed)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    names = list({"".join(rng.choices(letters, k=rng.randint(4, 12))).capitalize() for _ in range(habits)})
+    index = NameIndex(names)
+    typos = []
+    for name in rng.choices(names, k=lookups):
+        position = rng.randrange(len(name))
+        typos.append(name[:position] + rng.choice(letters) + name[position + 1:])
+    queries = {
+        "resolve": [name.lower() for name in rng.choices(names, k=lookups)],
+        "prefix": [name[:2] for name in rng.choices(names, k=lookups)],
+        "suggest": typos,
+    }
+    lookup = {"resolve": index.resolve, "prefix": lambda text: index.prefix(text, 20), "suggest": index.suggest}
+    results = {}
+    for kind, texts in queries.items():
+        latencies = []
+        for text in texts:
+            start = time.perf_counter()
+            lookup[kind](text)
+            latencies.append(time.perf_counter() - start)
+        results[kind] = latency_summary(latencies)
+    return results
+
+
+def generate_history(rng, start, end, period, adherence):
+    """
+    Simulate the tracker rows one habit accumulates between two dates when used through the app.
+    Each due period is completed with probability `adherence`. A missed period is followed by a gap, usually short
+    but occasionally weeks long, and the first completion after a gap restarts the streak at 0, the same way
+    habit_status and break_streak record a broken streak.
+
+    :param rng: a random.Random instance
+    :param start: ordinal of the day the habit was added
+    :param end: ordinal of the last simulated day
+    :param period: 1 for daily habits, 7 for weekly habits
+    :param adherence: probability of completing a due period
+    :return: a list of (ordinal, streakCounter) tuples
+    """
+    rows = [(start, 0)]
+    streak, last = 0, start
+    day = start + period
+    while day <= end:
+        if rng.random() < adherence:
+            streak = streak + 1 if day - last == period else 0
+            rows.append((day, streak))
+            last = day
+            day += period
+        elif rng.random() < 0.9:
+            day += rng.randint(1, period)
+        else:
+            day += rng.randint(7, 28)
+    return rows
+
+
+def generate_database(path, habits=100, years=1, seed=0, weekly_share=0.3):
+    """
+    Build a database of synthetic habits with `years` of history ending today. The same seed always produces the
+    same database.
+
+    :param path: path of the database file to create
+    :param habits: number of habits
+    :param years: years of history per habit
+    :param seed: random seed
+    :param weekly_share: share of weekly habits, the rest are daily
+    :return: the number of tracker rows written
+    """
+    rng = random.Random(seed)
+    end = date.today().toordinal()
+    first = end - 365 * years
+    db = get_db(path)
+    rows = 0
+    with bulk_load(db) as touched:
+        cur = db.cursor()
+        for i in range(habits):
+            name = f"habit {i:06d}"
+            periodicity = "weekly" if rng.random() < weekly_share else "daily"
+            cur.execute("INSERT INTO habits VALUES (?, ?, ?)",
+                        (name, f"synthetic {periodicity} habit", periodicity_code(periodicity)))
+            history = generate_history(rng, first + rng.randrange(30), end, 7 if periodicity == "weekly" else 1,
+                                       rng.uniform(0.6, 0.98))
+            cur.executemany("INSERT INTO tracker VALUES (?, ?, ?)",
+                            ((day, name, streak) for day, streak in history))
+            touched.add(name)
+            rows += len(history)
+    db.commit()
+    db.close()
+    return rows
+
+
+def suite_cases(names, path):
+    """
+    The calls timed by the suite, one entry per public function in db.py and analyse.py.
+    Read-only calls come first; writes only touch a few habits, so later cases still see a database of the
+    tier's size.
+
+    :param names: habit names to cycle through for per-habit calls
+    :param path: path of the database file
+    :return: a dict of function name to (call, repeat), where call takes the connection and a habit name
+    """
+    def open_db(db, name):
+        get_db(path).close()
+
+    def complete_in_transaction(db, name):
+        with db_module.transaction(db):
+            db_module.complete_habit(db, name)
+            analyse.break_streak(db, name)
+
+    def group_commit(db, name):
+        with db_module.GroupCommitter(db) as group:
+            db_module.complete_habit(db, name)
+            group.tick()
+
+    def bulk_load_empty(db, name):
+        with bulk_load(db):
+            pass
+        db.commit()
+
+    def log_update(db, name):
+        db_module.log_change(db, db.cursor(), "update", name, description="updated", periodicity="daily")
+        db.commit()
+
+    def log_updates(db, name):
+        changes = [("update", name, date.today().toordinal(), {"description": "updated"})] * 10
+        db_module.log_changes(db, db.cursor(), changes)
+        db.commit()
+
+    def complete_subscribed(db, name):
+        callback = db_module.subscribe(db, lambda changes: None)
+        db_module.complete_habit(db, name)
+        db_module.unsubscribe(db, callback)
+
+    added = iter(f"bench added {i}" for i in range(10 ** 9))
+    return {
+        "db.get_db": (open_db, 50),
+        "db.get_schema_version": (lambda db, name: db_module.get_schema_version(db), 200),
+        "db.migrate": (lambda db, name: db_module.migrate(db), 200),
+        "db.create_tables": (lambda db, name: db_module.create_tables(db), 200),
+        "db.configure": (lambda db, name: db_module.configure(db, db_module.PRAGMAS), 200),
+        "db.get_habits": (lambda db, name: db_module.get_habits(db), 20),
+        "db.get_tracker_data": (lambda db, name: db_module.get_tracker_data(db, name), 100),
+        "db.get_habit_streak": (lambda db, name: db_module.get_habit_streak(db, name), 200),
+        "db.get_elapsed_time": (lambda db, name: db_module.get_elapsed_time(db, name), 200),
+        "db.get_periodicity": (lambda db, name: db_module.get_periodicity(db, name), 200),
+        "db.get_periodicity_code": (lambda db, name: db_module.get_periodicity_code(db, name), 200),
+        "db.get_due_dates": (lambda db, name: db_module.get_due_dates(db, name), 200),
+        "db.periodicity_code": (lambda db, name: db_module.periodicity_code("weekly"), 200),
+        "db.periodicity_name": (lambda db, name: db_module.periodicity_name(db_module.WEEKLY), 200),
+        "db.period_days": (lambda db, name: db_module.period_days(db_module.MONTHLY), 200),
+        "db.segment_rows": (lambda db, name: db_module.segment_rows(738000, 738364, 1, 365), 200),
+        "db.get_habit": (lambda db, name: db_module.get_habit(db, name), 200),
+        "db.habit_cache": (lambda db, name: db_module.habit_cache(db), 200),
+        "db.calculate_most_recent_date": (lambda db, name: db_module.calculate_most_recent_date(db, name), 200),
+        "analyse.get_habit_names": (lambda db, name: analyse.get_habit_names(db), 20),
+        "analyse.return_max_habit_streaks": (lambda db, name: analyse.return_max_habit_streaks(db), 200),
+        "analyse.get_name_of_longest_streak": (lambda db, name: analyse.get_name_of_longest_streak(db), 200),
+        "analyse.habit_status": (lambda db, name: analyse.habit_status(db, name), 200),
+        "analyse.get_streak_counter": (lambda db, name: analyse.get_streak_counter(db, name), 200),
+        "analyse.get_single_alltime_streak": (lambda db, name: analyse.get_single_alltime_streak(db, name), 200),
+        "analyse.get_alltime_streak": (lambda db, name: analyse.get_alltime_streak(db, "daily"), 200),
+        "analyse.get_alltime_habit": (lambda db, name: analyse.get_alltime_habit(db, "daily"), 200),
+        "analyse.get_habits_by_periodicity": (lambda db, name: analyse.get_habits_by_periodicity(db, "weekly"), 20),
+        "analyse.top_streaks": (lambda db, name: analyse.top_streaks(db, 10), 20),
+        # What cli() runs on startup, the first call does the real work
+        "analyse.sweep_broken_streaks": (lambda db, name: analyse.sweep_broken_streaks(db), 1),
+        "analyse.break_streak": (lambda db, name: analyse.break_streak(db, name), 50),
+        "db.complete_habit": (lambda db, name: db_module.complete_habit(db, name), 50),
+        "db.update_habit": (lambda db, name: db_module.update_habit(db, name, "updated", "daily"), 50),
+        "db.add_habit": (lambda db, name: db_module.add_habit(db, next(added), "added", "daily"), 50),
+        "db.transaction": (complete_in_transaction, 50),
+        "db.GroupCommitter": (group_commit, 50),
+        "db.remove_habit": (lambda db, name: db_module.remove_habit(db, name), 20),
+        "db.log_change": (log_update, 50),
+        "db.log_changes": (log_updates, 50),
+        "db.subscribe": (complete_subscribed, 50),
+        "db.unsubscribe": (complete_subscribed, 50),
+        # Catching up on the changes made by the write cases above
+        "db.get_change_seq": (lambda db, name: db_module.get_change_seq(db), 200),
+        "db.get_changes": (lambda db, name: db_module.get_changes(db, db_module.get_change_seq(db) - 100), 200),
+        "db.prune_changes": (lambda db, name: db_module.prune_changes(db, db_module.get_change_seq(db) - 100), 20),
+        "db.bulk_load": (bulk_load_empty, 5),
+        "db.rebuild_habit_stats": (lambda db, name: db_module.rebuild_habit_stats(db), 3),
+    }
+
+
+def untimed_functions(cases):
+    """
+    List the public functions of db.py and analyse.py that the suite does not time.
+
+    :param cases: the dict returned by suite_cases
+    :return: a sorted list of qualified function names
+    """
+    public = set()
+    for module in (db_module, analyse):
+        for name, member in inspect.getmembers(module, inspect.isfunction):
+            if not name.startswith("_") and member.__module__ == module.__name__:
+                public.add(f"{module.__name__}.{name}")
+    return sorted(public - set(cases))
+
+
+def time_cases(path, cases, names):
+    """
+    Time each case against the database at `path`.
+
+    :return: a dict of function name to timing summary in microseconds
+    """
+    db = get_db(path)
+    results = {}
+    for label, (call, repeat) in cases.items():
+        timings = []
+        for i in range(repeat):
+            name = names[i % len(names)]
+            start = time.perf_counter()
+            call(db, name)
+            timings.append(time.perf_counter() - start)
+        results[label] = {
+            "calls": repeat,
+            "median_us": statistics.median(timings) * 1e6,
+            "min_us": min(timings) * 1e6,
+            "max_us": max(timings) * 1e6,
+        }
+    db.close()
+    return results
+
+
+def run_suite(tiers=("small", "medium"), seed=0):
+    """
+    Generate a database for each size tier and time every public db.py and analyse.py function against it.
+
+    :param tiers: names of entries in TIERS
+    :param seed: random seed for the generated data
+    :return: a JSON-serialisable dict of results
+    """
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "seed": seed,
+        "tiers": {},
+    }
+    for tier in tiers:
+        habits, years = TIERS[tier]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "bench.db")
+            start = time.perf_counter()
+            rows = generate_database(path, habits, years, seed)
+            generated = time.perf_counter() - start
+            names = [f"habit {i:06d}" for i in random.Random(seed).sample(range(habits), min(habits, 50))]
+            cases = suite_cases(names, path)
+            report["untimed"] = untimed_functions(cases)
+            report["tiers"][tier] = {
+                "habits": habits,
+                "years": years,
+                "tracker_rows": rows,
+                "generate_s": generated,
+                "functions": time_cases(path, cases, names),
+            }
+    return report
+
+
+def compare_reports(before, after, threshold=1.25):
+    """
+    Compare two suite reports and list the calls whose median time changed by more than `threshold` times.
+
+    :param before: a report from run_suite
+    :param after: a report from run_suite
+    :param threshold: ratio above which a change is reported
+    :return: a list of (tier, function, before_us, after_us, ratio) tuples, slowest regressions first
+    """
+    changes = []
+    for tier, results in after["tiers"].items():
+        previous = before["tiers"].get(tier, {}).get("functions", {})
+        for label, timing in results["functions"].items():
+            if label not in previous:
+                continue
+            ratio = timing["median_us"] / max(previous[label]["median_us"], 1e-3)
+            if ratio > threshold or ratio < 1 / threshold:
+                changes.append((tier, label, previous[label]["median_us"], timing["median_us"], ratio))
+    return sorted(changes, key=lambda change: change[4], reverse=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the habit tracker.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    commit_parser = subparsers.add_parser("commit", help="commit throughput, default vs tuned connection settings")
+    commit_parser.add_argument("--count", type=int, default=2000, help="commits per mode")
+    group_parser = subparsers.add_parser("group", help="completion throughput, per-call commits vs group commit")
+    group_parser.add_argument("--count", type=int, default=2000, help="habits added and completed per mode")
+    group_parser.add_argument("--batch", type=int, default=100, help="writes per group commit")
+    group_parser.add_argument("--synchronous", default="FULL", help="synchronous pragma, defaults to FULL")
+    stress_parser = subparsers.add_parser("stress", help="complete the same habits from many processes at once")
+    stress_parser.add_argument("--workers", type=int, default=8, help="worker processes")
+    stress_parser.add_argument("--habits", type=int, default=50)
+    stress_parser.add_argument("--rounds", type=int, default=20, help="passes over every habit per worker")
+    http_parser = subparsers.add_parser("http", help="load-test the JSON API in server.py on localhost")
+    http_parser.add_argument("--habits", type=int, default=50)
+    http_parser.add_argument("--requests", type=int, default=5000)
+    http_parser.add_argument("--clients", type=int, default=8, help="concurrent keep-alive connections")
+    http_parser.add_argument("--write-ratio", type=float, default=0.1, help="share of requests that complete")
+    http_parser.add_argument("--cache-age", type=float, default=1.0, help="server response cache, 0 to disable")
+    names_parser = subparsers.add_parser("names", help="latency of habit name lookups, completion and suggestions")
+    names_parser.add_argument("--habits", type=int, default=10000, help="names indexed")
+    names_parser.add_argument("--lookups", type=int, default=2000, help="lookups per kind")
+    async_parser = subparsers.add_parser("async", help="latency of AsyncHabitStore under concurrent load")
+    async_parser.add_argument("--habits", type=int, default=100)
+    async_parser.add_argument("--requests", type=int, default=5000)
+    async_parser.add_argument("--concurrency", type=int, default=200, help="calls in flight at once")
+    async_parser.add_argument("--readers", type=int, default=4, help="reader threads")
+    suite_parser = subparsers.add_parser("suite", help="time every db.py and analyse.py function on synthetic data")
+    suite_parser.add_argument("--tiers", nargs="+", choices=list(TIERS), default=["small", "medium"])
+    suite_parser.add_argument("--seed", type=int, default=0)
+    suite_parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    compare_parser = subparsers.add_parser("compare", help="compare two JSON reports written by suite")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=1.25, help="ratio worth reporting")
+    args = parser.parse_args()
+
+    if args.benchmark == "commit":
+        for mode, rate in bench_commits(args.count).items():
+            print(f"{mode:>8}: {rate:10.0f} commits/s")
+    elif args.benchmark == "group":
+        for mode, (rate, commits) in bench_group_commit(args.count, args.batch, args.synchronous).items():
+            print(f"{mode:>12}: {rate:10.0f} habits/s  {commits:6} commits")
+    elif args.benchmark == "stress":
+        with tempfile.TemporaryDirectory() as stress_directory:
+            results = stress_completions(os.path.join(stress_directory, "stress.db"), args.workers, args.habits,
+                                         args.rounds)
+        print(f"{results['calls_per_second']:.0f} calls/s over {results['workers']} processes, "
+              f"{results['completions']} completions for {args.habits} habits")
+        for habit, expected, stored in results["errors"]:
+            print(f"  {habit}: expected one row with streak {expected}, found {stored}")
+        sys.exit(1 if results["errors"] else 0)
+    elif args.benchmark == "http":
+        results = bench_http(args.habits, args.requests, args.clients, args.write_ratio, args.cache_age)
+        print(f"{results.pop('requests_per_second'):.0f} requests/s, {results.pop('cache_hits')} cache hits")
+        for kind, summary in results.items():
+            print(f"{kind:>10}: p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+                  f"max {summary['max_ms']:7.2f} ms  ({summary['count']} calls)")
+    elif args.benchmark == "names":
+        for kind, summary in bench_names(args.habits, args.lookups).items():
+            print(f"{kind:>8}: p50 {summary['p50_ms']:7.3f} ms  p99 {summary['p99_ms']:7.3f} ms  "
+                  f"max {summary['max_ms']:7.3f} ms  ({summary['count']} calls)")
+    elif args.benchmark == "async":
+        results = bench_async(args.habits, args.requests, args.concurrency, args.readers)
+        print(f"{results.pop('requests_per_second'):.0f} requests/s")
+        for operation, summary in results.items():
+            print(f"{operation:>15}: p50 {summary['p50_ms']:7.2f} ms  p99 {summary['p99_ms']:7.2f} ms  "
+                  f"max {summary['max_ms']:7.2f} ms  ({summary['count']} calls)")
+    elif args.benchmark == "suite":
+        report = json.dumps(run_suite(args.tiers, args.seed), indent=2)
+        if args.output:
+            with open(args.output, "w") as file:
+                file.write(report + "\n")
+        else:
+            print(report)
+    elif args.benchmark == "compare":
+        with open(args.before) as file:
+            before = json.load(file)
+        with open(args.after) as file:
+            after = json.load(file)
+        for tier, label, old, new, ratio in compare_reports(before, after, args.threshold):
+            print(f"{tier:>8} {label:<40} {old:12.1f} us -> {new:12.1f} us  x{ratio:.2f}")
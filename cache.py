@@ -0,0 +1,103 @@
+from collections import OrderedDict
+
+
+class HabitCache:
+    """
+    Read cache for habit metadata: the list of habit names and each habit's description and periodicity.
+    db.py writes through it on every add, update and remove, and drops everything whenever another connection
+    has committed, which SQLite reports through PRAGMA data_version.
+
+    Parameters
+    ----------
+    maxsize : int
+        Maximum number of habits kept, least recently used habits are evicted first. The name list is only
+        cached while it holds at most this many names.
+    """
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._habits = OrderedDict()
+        self._names = None
+        self._data_version = None
+
+    def validate(self, db):
+        """
+        Empty the cache if another connection has changed the database since it was last checked.
+        :param db: the connection the cache belongs to
+        :return: None
+        """
+        data_version = db.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._data_version:
+            self.clear()
+            self._data_version = data_version
+
+    def get(self, name):
+        """
+        Return the cached (name, description, periodicity) row of a habit, or None on a miss.
+        """
+        row = self._habits.get(name)
+        if row is None:
+            self.misses += 1
+            return None
+        self._habits.move_to_end(name)
+        self.hits += 1
+        return row
+
+    def put(self, row):
+        """
+        Store a (name, description, periodicity) row, evicting the least recently used habit if full.
+        """
+        self._habits[row[0]] = row
+        self._habits.move_to_end(row[0])
+        if len(self._habits) > self.maxsize:
+            self._habits.popitem(last=False)
+
+    def get_names(self):
+        """
+        Return the cached list of habit names, or None on a miss.
+        """
+        if self._names is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return list(self._names)
+
+    def put_names(self, names):
+        """
+        Store the full list of habit names, unless it is larger than maxsize.
+        """
+        self._names = dict.fromkeys(names) if len(names) <= self.maxsize else None
+
+    def added(self, row):
+        """
+        Record a habit written to the database.
+        """
+        self.put(row)
+        if self._names is not None:
+            self._names[row[0]] = None
+            if len(self._names) > self.maxsize:
+                self._names = None
+
+    def removed(self, name):
+        """
+        Record a habit deleted from the database.
+        """
+        self._habits.pop(name, None)
+        if self._names is not None:
+            self._names.pop(name, None)
+
+    def clear(self):
+        """
+        Drop every cached entry, the hit and miss counters are kept.
+        """
+        self._habits.clear()
+        self._names = None
+
+    def stats(self):
+        """
+        Return the hit and miss counters and the current size of the cache.
+        """
+        return {"hits": self.hits, "misses": self.misses, "habits": len(self._habits),
+                "names": None if self._names is None else len(self._names), "maxsize": self.maxsize}
@@ -0,0 +1,86 @@
+import argparse
+from datetime import date
+from itertools import groupby
+
+from db import get_db, bulk_load
+
+# Tracker rows younger than this many days are left as they are
+KEEP_DAYS = 90
+
+
+def find_segments(rows, last_segment=None):
+    """
+    Split one habit's tracker rows into runs that a single tracker_segments row can stand for: evenly spaced dates
+    with a streak that counts up by one per row.
+
+    :param rows: (day number, streak) tuples in date order
+    :param last_segment: the habit's latest existing segment as (startDate, endDate, startStreak, length), extended
+                         if the first rows continue it
+    :return: a list of [startDate, endDate, startStreak, length] lists, single rows included with a length of 1
+    """
+    runs = [list(last_segment)] if last_segment is not None else []
+    for day, streak in rows:
+        if runs:
+            start, end, start_streak, length = runs[-1]
+            step = (end - start) // (length - 1) if length > 1 else day - end
+            if streak == start_streak + length and step > 0 and day - end == step:
+                runs[-1][1], runs[-1][3] = day, length + 1
+                continue
+        runs.append([day, day, streak, 1])
+    return runs
+
+
+def compact_tracker(db, keep_days=KEEP_DAYS, today=None):
+    """
+    Fold old tracker rows into streak segments, see db._create_tracker_segments.
+    Every habit's latest tracker row is always kept, as are rows that do not extend a run, so a run of daily
+    completions shrinks to one row however long it is. get_tracker_data, habit_stats and the reports read the
+    segments, so their results do not change. The rows are rewritten in one transaction, which is committed.
+
+    :param db: the database connection object
+    :param keep_days: tracker rows from the last keep_days days are not compacted
+    :param today: day number to count keep_days back from, defaults to today
+    :return: a dict with the number of habits compacted, tracker rows folded and segments written
+    """
+    today = date.today().toordinal() if today is None else today
+    cur = db.cursor()
+    cur.execute("""SELECT habitName, startDate, endDate, startStreak, length FROM tracker_segments AS segment
+        WHERE startDate = (SELECT MAX(startDate) FROM tracker_segments WHERE habitName = segment.habitName)""")
+    last_segments = {name: tuple(segment) for name, *segment in cur.fetchall()}
+    cur.execute("""SELECT habitName, date, streakCounter FROM tracker AS row
+        WHERE date < ? AND date < (SELECT MAX(date) FROM tracker WHERE habitName = row.habitName)
+        ORDER BY habitName, date""", (today - keep_days,))
+    segments, folded = [], []
+    for name, rows in groupby(cur.fetchall(), key=lambda row: row[0]):
+        rows = [(day, streak) for _, day, streak in rows]
+        last_segment = last_segments.get(name)
+        if last_segment is not None and last_segment[1] > rows[0][0]:
+            # Rows older than the compacted history, e.g. restored from a backup, are left raw
+            last_segment = None
+        for start, end, start_streak, length in find_segments(rows, last_segment):
+            if length > 1 and (start, end, start_streak, length) != last_segment:
+                segments.append((name, start, end, start_streak, length))
+                folded.append((name, start, end))
+    try:
+        with bulk_load(db) as touched:
+            cur.executemany("DELETE FROM tracker WHERE habitName = ? AND date BETWEEN ? AND ?", folded)
+            rows = cur.rowcount
+            cur.executemany("INSERT or REPLACE INTO tracker_segments VALUES (?, ?, ?, ?, ?)", segments)
+            touched.update(name for name, *_ in segments)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return {"habits": len(touched), "segments": len(segments), "rows": rows}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fold old tracker history into streak segments.")
+    parser.add_argument("--db", default="main.db", help="the database file, defaults to main.db")
+    parser.add_argument("--keep-days", type=int, default=KEEP_DAYS,
+                        help=f"leave the last KEEP_DAYS days uncompacted, defaults to {KEEP_DAYS}")
+    args = parser.parse_args()
+    database = get_db(args.db)
+    counts = compact_tracker(database, args.keep_days)
+    print(f"Folded {counts['rows']} tracker rows of {counts['habits']} habits into {counts['segments']} segments")
+    database.close()
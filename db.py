@@ -1,27 +1,361 @@
+import json
+import logging
+import re
 import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from datetime import date
+from typing import NamedTuple
 
+from cache import HabitCache
 
-def get_db(name="main.db"):
+# Periodicities are stored as small integer codes. Positive codes are calendar periods, a negative code -N means
+# "every N days", counted from the last completion.
+DAILY = 1
+WEEKLY = 2  # ISO weeks, Monday to Sunday
+WEEKDAYS = 3  # Monday to Friday
+MONTHLY = 4  # calendar months
+PERIODICITY_CODES = {"daily": DAILY, "weekly": WEEKLY, "weekdays": WEEKDAYS, "monthly": MONTHLY}
+PERIODICITY_NAMES = {code: name for name, code in PERIODICITY_CODES.items()}
+EVERY_N_DAYS = re.compile(r"every (\d+) days?")
+# Average days per period for each calendar periodicity code, see period_days
+PERIOD_DAYS = {DAILY: 1, WEEKLY: 7, WEEKDAYS: 7 / 5, MONTHLY: 365.25 / 12}
+# julianday() of a day number, minus this offset, is the day number again
+JULIAN_ORDINAL_OFFSET = 1721424.5
+# Inserts a (date, habitName, streakCounter) tracker row for any day, e.g. restored from a backup. The row is skipped
+# if the habit already has one for that day, including a day compacted into its tracker_segments, which the unique
+# index on tracker no longer covers
+INSERT_HISTORY_ROW = """INSERT or IGNORE INTO tracker (date, habitName, streakCounter) SELECT ?1, ?2, ?3
+    WHERE NOT EXISTS (SELECT 1 FROM tracker_segments WHERE habitName = ?2 AND startDate <= ?1 AND endDate >= ?1)"""
+
+logger = logging.getLogger(__name__)
+
+# Connection settings applied by get_db. WAL lets readers run alongside a writer, and with synchronous=NORMAL a
+# commit only appends to the WAL file, fsyncs happen at checkpoints. A power loss can drop the last commits but
+# cannot corrupt the database.
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,  # in KiB, 16 MiB of page cache
+    "mmap_size": 268435456,  # 256 MiB of the file read through mmap
+    "busy_timeout": 5000,  # milliseconds to wait for a lock before raising "database is locked"
+}
+
+
+class Change(NamedTuple):
+    """
+    One entry of the change log, see subscribe and get_changes.
+    kind is "add", "update", "remove", "complete", "break" or "import". data holds the habit's new description and
+    periodicity for "add" and "update", the extended streak for "complete", and for "import" whether a backup import
+    added the habit and how many of its tracker rows it added. Completing a broken habit logs a "complete" change
+    with the extended streak followed by a "break" change, as the completion restarts the streak at 0.
+    day is the day the change applies to, which is earlier than the day it was logged for a completion synced later.
+    """
+    seq: int
+    kind: str
+    name: str
+    day: int
+    data: dict
+
+
+class Connection(sqlite3.Connection):
+    """
+    sqlite3 connection that carries a HabitCache, returned by get_db.
+    Setting `profiler` to a profiling.QueryProfiler records every statement run on the connection.
+    Inside transaction(), commit() is deferred until the outermost transaction block ends.
+    Changes logged on the connection are passed to its subscribers once they are committed, see subscribe.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.habit_cache = HabitCache()
+        self.profiler = None
+        self.transaction_depth = 0
+        self.subscribers = []
+        self.pending_changes = []
+
+    def commit(self):
+        if self.transaction_depth == 0:
+            super().commit()
+            if self.pending_changes:
+                changes, self.pending_changes = self.pending_changes, []
+                for callback in list(self.subscribers):
+                    # The changes are committed already, a failing subscriber must not look like a failed write
+                    try:
+                        callback(changes)
+                    except Exception:
+                        logger.exception("Change subscriber %r failed", callback)
+
+    def rollback(self):
+        super().rollback()
+        # Entries written through during the transaction may no longer exist
+        self.habit_cache.clear()
+        self.pending_changes.clear()
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = sqlite3.Cursor
+            if self.profiler is not None:
+                from profiling import ProfilingCursor
+                factory = ProfilingCursor
+        return super().cursor(factory)
+
+    # The built-in shortcuts create their cursor without going through cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def periodicity_code(periodicity):
+    """
+    Return the stored code for a periodicity name such as "daily" or "every 3 days", or None if the name is unknown.
+    :param periodicity: the periodicity name
+    :return: int or None
+    """
+    if periodicity in PERIODICITY_CODES:
+        return PERIODICITY_CODES[periodicity]
+    match = EVERY_N_DAYS.fullmatch(periodicity) if isinstance(periodicity, str) else None
+    if match is None or int(match.group(1)) == 0:
+        return None
+    return DAILY if int(match.group(1)) == 1 else -int(match.group(1))
+
+
+def periodicity_name(code):
+    """
+    Return the periodicity name for a stored code, or None if the code is unknown.
+    :param code: the stored periodicity code
+    :return: str or None
+    """
+    if isinstance(code, int) and code < -1:
+        return f"every {-code} days"
+    return PERIODICITY_NAMES.get(code)
+
+
+def period_days(code):
+    """
+    Return the average number of days per period of a periodicity code, N for "every N days".
+    :param code: the stored periodicity code
+    :return: a number of days, or None if the code is unknown
+    """
+    if isinstance(code, int) and code < 0:
+        return -code
+    return PERIOD_DAYS.get(code)
+
+
+def _require_periodicity_code(periodicity):
+    code = periodicity_code(periodicity)
+    if code is None:
+        raise ValueError(f"Unknown periodicity {periodicity!r}, expected one of {', '.join(PERIODICITY_CODES)} "
+                         f"or 'every N days'")
+    return code
+
+
+def get_db(name="main.db", pragmas=None, check_same_thread=True):
     """
     Function to get a database connection.
     Args:
         name (str): The name of the database file. Defaults to "main.db".
+        pragmas (dict): Connection settings to apply. Defaults to PRAGMAS, pass {} for SQLite's own defaults.
+        check_same_thread (bool): Whether sqlite3 refuses use of the connection from other threads.
     Returns:
         sqlite3.Connection: A connection object to the specified database.
     """
-    db = sqlite3.connect(name)
-    create_tables(db)
+    db = sqlite3.connect(name, check_same_thread=check_same_thread, factory=Connection)
+    configure(db, PRAGMAS if pragmas is None else pragmas)
+    migrate(db)
     return db
 
 
+@contextmanager
+def transaction(db, immediate=False):
+    """
+    Context manager that groups calls to the functions in this module and analyse.py into one atomic commit.
+    The commits those functions make are deferred until the block ends; leaving it with an exception rolls every
+    change back instead. Blocks can be nested, only the outermost one commits.
+    :param db: a connection from get_db
+    :param immediate: take the write lock when the block starts, so that what the block reads cannot be changed by
+                      another writer before it writes. Other writers wait up to busy_timeout for the lock.
+    :return: the connection
+    """
+    if db.transaction_depth == 0 and not db.in_transaction:
+        db.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+    db.transaction_depth += 1
+    try:
+        yield db
+    except BaseException:
+        db.transaction_depth -= 1
+        if db.transaction_depth == 0:
+            db.rollback()
+        raise
+    db.transaction_depth -= 1
+    db.commit()
+
+
+class GroupCommitter:
+    """
+    Group commit for high-rate write streams: the functions in this module and analyse.py run inside one open
+    transaction that is committed every max_batch writes or max_delay seconds, whichever comes first, so many
+    writes share one commit. Call tick() after each write.
+    A write is only durable once its group commits, and a crash loses the open group as a whole. Leaving the block
+    with an exception rolls back the open group, groups committed before stay.
+    Inside transaction(), groups are not committed early, the outer block still commits everything at once.
+
+    Parameters
+    ----------
+    db : Connection
+        A connection from get_db
+    max_batch : int
+        Writes per commit
+    max_delay : float
+        Seconds after which the open group is committed at the next tick, however few writes it holds
+    """
+
+    def __init__(self, db, max_batch=100, max_delay=0.05):
+        self.db = db
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = 0
+        self.commits = 0
+        self._opened = 0.0
+        self._transaction = None
+
+    def __enter__(self):
+        # Each group takes the write lock when it opens, so that a write following a read inside the group waits for
+        # busy_timeout instead of failing on a lock it cannot upgrade
+        self._transaction = transaction(self.db, immediate=True)
+        self._transaction.__enter__()
+        self._opened = time.monotonic()
+        return self
+
+    def tick(self, writes=1):
+        """
+        Count writes made since the last call, committing the group if it is full or old enough.
+        :param writes: number of writes to count
+        :return: True if the group was committed
+        """
+        self.pending += writes
+        if self.pending >= self.max_batch or time.monotonic() - self._opened >= self.max_delay:
+            return self.flush()
+        return False
+
+    def flush(self):
+        """
+        Commit the open group now, unless an outer transaction() block owns the commit.
+        :return: True if the group was committed
+        """
+        if self.db.transaction_depth > 1:
+            return False
+        self._transaction.__exit__(None, None, None)
+        self.commits += 1
+        self.pending = 0
+        self.__enter__()
+        return True
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None and self.pending:
+            self.commits += 1
+        self.pending = 0
+        return self._transaction.__exit__(*exc_info)
+
+
+def habit_cache(db):
+    """
+    Return the connection's habit metadata cache, checked against writes made by other connections.
+    :param db: the database connection object
+    :return: a HabitCache, or None for connections not opened through get_db
+    """
+    cache = getattr(db, "habit_cache", None)
+    if cache is not None:
+        cache.validate(db)
+    return cache
+
+
+def configure(db, pragmas):
+    """
+    Apply connection settings with PRAGMA statements.
+    :param db: the database connection object
+    :param pragmas: a dict of pragma names to values
+    :return: None
+    """
+    cur = db.cursor()
+    for pragma, value in pragmas.items():
+        cur.execute(f"PRAGMA {pragma} = {value}")
+
+
+class ConnectionManager:
+    """
+    Hands out one tuned connection per thread for a database file.
+    Connections are opened on first use in each thread and reused afterwards, so threads never share a connection,
+    and with WAL enabled any number of reader threads can work while one thread writes.
+
+    Parameters
+    ----------
+    name : str
+        The name of the database file
+    pragmas : dict
+        Connection settings, defaults to PRAGMAS
+    """
+
+    def __init__(self, name="main.db", pragmas=None):
+        self.name = name
+        self.pragmas = PRAGMAS if pragmas is None else pragmas
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        # Migrate up front so threads do not race to upgrade the schema
+        self.connection()
+
+    def connection(self):
+        """
+        Return the calling thread's connection, opening it if needed.
+        :return: sqlite3.Connection
+        """
+        db = getattr(self._local, "db", None)
+        if db is None:
+            # Allowed across threads only so that close() can close every connection from one thread
+            db = get_db(self.name, self.pragmas, check_same_thread=False)
+            self._local.db = db
+            with self._lock:
+                self._connections.append(db)
+        return db
+
+    def close(self):
+        """
+        Close every connection handed out by the manager.
+        :return: None
+        """
+        with self._lock:
+            for db in self._connections:
+                db.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
 def create_tables(db):
     """
     Create tables in the database if they do not already exist.
+    Kept for existing callers, the schema is now built by running every pending migration.
     :param db: the database connection object
     :return: None
     """
-    cur = db.cursor()
+    migrate(db)
+
+
+def _create_base_tables(cur):
+    """
+    Migration 1: the original habits and tracker tables.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
     cur.execute(
         """CREATE TABLE IF NOT EXISTS habits (
         name TEXT PRIMARY KEY, 
@@ -33,7 +367,508 @@ def create_tables(db):
         habitName TEXT,
         streakCounter INTEGER,
         FOREIGN KEY(habitName) REFERENCES habits(name))""")
+
+
+def _index_tracker(cur):
+    """
+    Migration 2: one tracker row per habit and day, plus indexes for the per-habit lookups.
+    Duplicate (habitName, date) rows left by older versions are dropped, keeping the first one inserted,
+    which is the row the streak queries already returned.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    cur.execute("DELETE FROM tracker WHERE rowid NOT IN (SELECT MIN(rowid) FROM tracker GROUP BY habitName, date)")
+    # MAX(date) / latest streak lookups per habit
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS tracker_habit_date ON tracker (habitName, date)")
+    # MAX(streakCounter) per habit
+    cur.execute("CREATE INDEX IF NOT EXISTS tracker_habit_streak ON tracker (habitName, streakCounter)")
+    # habits holding a given streak value
+    cur.execute("CREATE INDEX IF NOT EXISTS tracker_streak_habit ON tracker (streakCounter, habitName)")
+    cur.execute("CREATE INDEX IF NOT EXISTS habits_periodicity ON habits (periodicity, name)")
+
+
+def _refresh_stats_sql(name, delta, segments=True):
+    """
+    Build the statement that re-reads one habit's streak summary through the tracker indexes.
+    :param name: SQL expression for the habit name, NEW.habitName or OLD.habitName
+    :param delta: SQL expression added to totalCompletions
+    :param segments: also read compacted history from tracker_segments, which exists from migration 6 on
+    :return: str
+    """
+    statement = f"""UPDATE habit_stats SET
+            currentStreak = COALESCE((SELECT streakCounter FROM tracker WHERE habitName = {name}
+                                      ORDER BY date DESC LIMIT 1), 0),
+            bestStreak = COALESCE((SELECT MAX(streakCounter) FROM tracker WHERE habitName = {name}), 0),
+            lastDate = (SELECT MAX(date) FROM tracker WHERE habitName = {name}),
+            totalCompletions = totalCompletions + {delta}
+        WHERE habitName = {name};"""
+    if segments:
+        statement += _merge_segments_sql(f"habitName = {name}", totals=False)
+    return statement
+
+
+def _merge_segments_sql(where, totals=True):
+    """
+    Build the statement that folds tracker_segments into habit_stats rows read from the raw tracker rows only.
+    :param where: SQL condition selecting the habit_stats rows to update
+    :param totals: also add the segments' completions to totalCompletions, off where it is kept by deltas
+    :return: str
+    """
+    segments = "FROM tracker_segments AS segment WHERE segment.habitName = habit_stats.habitName"
+    total = f"""totalCompletions = totalCompletions + (SELECT SUM(length - (startStreak = 0)) {segments}),
+            """ if totals else ""
+    return f"""UPDATE habit_stats SET
+            {total}bestStreak = MAX(bestStreak, (SELECT MAX(startStreak + length - 1) {segments})),
+            currentStreak = CASE WHEN lastDate IS NULL OR lastDate < (SELECT MAX(endDate) {segments})
+                THEN (SELECT startStreak + length - 1 {segments} ORDER BY startDate DESC LIMIT 1)
+                ELSE currentStreak END,
+            lastDate = MAX(COALESCE(lastDate, 0), (SELECT MAX(endDate) {segments}))
+        WHERE {where} AND EXISTS (SELECT 1 {segments});"""
+
+
+def _create_habit_stats(cur):
+    """
+    Migration 3: per-habit streak summary, kept current by triggers on tracker.
+    The triggers run inside the statement that changes tracker, so the summary is always updated in the same
+    transaction as the write that caused it, including ad-hoc SQL against tracker.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    cur.execute("""CREATE TABLE IF NOT EXISTS habit_stats (
+        habitName TEXT PRIMARY KEY,
+        currentStreak INTEGER NOT NULL DEFAULT 0,
+        bestStreak INTEGER NOT NULL DEFAULT 0,
+        lastDate TEXT,
+        totalCompletions INTEGER NOT NULL DEFAULT 0)""")
+    cur.execute("CREATE INDEX IF NOT EXISTS habit_stats_best ON habit_stats (bestStreak, habitName)")
+    _create_stats_triggers(cur, segments=False)
+    _rebuild_habit_stats(cur, segments=False)
+
+
+def _create_stats_triggers(cur, segments=True):
+    """
+    Create the tracker triggers that keep habit_stats current.
+    :param cur: a cursor inside an open transaction
+    :param segments: also read compacted history from tracker_segments, which exists from migration 6 on
+    :return: None
+    """
+    # Appending a row only ever moves the summary forward, no lookups needed
+    cur.execute("""CREATE TRIGGER IF NOT EXISTS tracker_stats_insert AFTER INSERT ON tracker BEGIN
+        INSERT or IGNORE INTO habit_stats (habitName) VALUES (NEW.habitName);
+        UPDATE habit_stats SET
+            currentStreak = CASE WHEN lastDate IS NULL OR NEW.date >= lastDate
+                            THEN COALESCE(NEW.streakCounter, 0) ELSE currentStreak END,
+            bestStreak = MAX(bestStreak, COALESCE(NEW.streakCounter, 0)),
+            lastDate = CASE WHEN lastDate IS NULL OR NEW.date >= lastDate THEN NEW.date ELSE lastDate END,
+            totalCompletions = totalCompletions + (COALESCE(NEW.streakCounter, 0) > 0)
+        WHERE habitName = NEW.habitName;
+    END""")
+    # Rewriting or deleting a row may lower the best streak, so re-read it through the indexes
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS tracker_stats_update AFTER UPDATE ON tracker BEGIN
+        INSERT or IGNORE INTO habit_stats (habitName) VALUES (NEW.habitName);
+        {_refresh_stats_sql("OLD.habitName", "-(COALESCE(OLD.streakCounter, 0) > 0)", segments)}
+        {_refresh_stats_sql("NEW.habitName", "(COALESCE(NEW.streakCounter, 0) > 0)", segments)}
+    END""")
+    cur.execute(f"""CREATE TRIGGER IF NOT EXISTS tracker_stats_delete AFTER DELETE ON tracker BEGIN
+        {_refresh_stats_sql("OLD.habitName", "-(COALESCE(OLD.streakCounter, 0) > 0)", segments)}
+    END""")
+
+
+def _drop_stats_triggers(cur):
+    """
+    Drop the tracker triggers that keep habit_stats current.
+    :param cur: a cursor inside an open transaction
+    :return: None
+    """
+    for trigger in ("tracker_stats_insert", "tracker_stats_update", "tracker_stats_delete"):
+        cur.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+
+
+def _rebuild_habit_stats(cur, segments=True):
+    """
+    Recompute every row of habit_stats from the full tracker history.
+    :param cur: a cursor inside an open transaction
+    :param segments: also read compacted history from tracker_segments, which exists from migration 6 on
+    :return: None
+    """
+    cur.execute("DELETE FROM habit_stats")
+    cur.execute("""INSERT INTO habit_stats (habitName, currentStreak, bestStreak, lastDate, totalCompletions)
+        SELECT habitName,
+            COALESCE((SELECT streakCounter FROM tracker AS latest WHERE latest.habitName = tracker.habitName
+                      ORDER BY date DESC LIMIT 1), 0),
+            COALESCE(MAX(streakCounter), 0), MAX(date), SUM(COALESCE(streakCounter, 0) > 0)
+        FROM tracker GROUP BY habitName""")
+    cur.execute("INSERT or IGNORE INTO habit_stats (habitName) SELECT name FROM habits")
+    if segments:
+        cur.execute("INSERT or IGNORE INTO habit_stats (habitName) SELECT DISTINCT habitName FROM tracker_segments")
+        cur.execute(_merge_segments_sql("1"))
+
+
+def _refresh_habit_stats(cur, names):
+    """
+    Recompute the habit_stats rows of the given habits from their tracker history.
+    :param cur: a cursor inside an open transaction
+    :param names: an iterable of habit names
+    :return: None
+    """
+    cur.executemany("""INSERT or REPLACE INTO habit_stats
+            (habitName, currentStreak, bestStreak, lastDate, totalCompletions)
+        SELECT ?1,
+            COALESCE((SELECT streakCounter FROM tracker WHERE habitName = ?1 ORDER BY date DESC LIMIT 1), 0),
+            COALESCE(MAX(streakCounter), 0), MAX(date), COALESCE(SUM(COALESCE(streakCounter, 0) > 0), 0)
+        FROM tracker WHERE habitName = ?1""", ((name,) for name in names))
+    cur.executemany(_merge_segments_sql("habitName = ?1"), ((name,) for name in names))
+
+
+def _compact_storage(cur):
+    """
+    Migration 4: store tracker dates as day numbers (date.toordinal()) and periodicities as integer codes.
+    Both tables are rebuilt, so their indexes, habit_stats and its triggers are recreated afterwards.
+    Tracker rows whose date cannot be parsed are dropped.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    _drop_stats_triggers(cur)
+    cur.execute("""CREATE TABLE tracker_new (
+        date INTEGER NOT NULL,
+        habitName TEXT NOT NULL,
+        streakCounter INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY(habitName) REFERENCES habits(name))""")
+    cur.execute(f"""INSERT INTO tracker_new
+        SELECT CASE WHEN typeof(date) = 'integer' THEN date
+                    ELSE CAST(julianday(date) - {JULIAN_ORDINAL_OFFSET} AS INTEGER) END,
+            habitName, COALESCE(streakCounter, 0)
+        FROM tracker WHERE habitName IS NOT NULL AND (typeof(date) = 'integer' OR julianday(date) IS NOT NULL)""")
+    cur.execute("DROP TABLE tracker")
+    cur.execute("ALTER TABLE tracker_new RENAME TO tracker")
+    cur.execute("CREATE UNIQUE INDEX tracker_habit_date ON tracker (habitName, date)")
+    cur.execute("CREATE INDEX tracker_habit_streak ON tracker (habitName, streakCounter)")
+    cur.execute("CREATE INDEX tracker_streak_habit ON tracker (streakCounter, habitName)")
+
+    cur.execute("""CREATE TABLE habits_new (
+        name TEXT PRIMARY KEY,
+        description TEXT,
+        periodicity INTEGER)""")
+    cur.execute(f"""INSERT INTO habits_new
+        SELECT name, description, CASE periodicity WHEN 'daily' THEN {DAILY} WHEN 'weekly' THEN {WEEKLY} END
+        FROM habits""")
+    cur.execute("DROP TABLE habits")
+    cur.execute("ALTER TABLE habits_new RENAME TO habits")
+    cur.execute("CREATE INDEX habits_periodicity ON habits (periodicity, name)")
+
+    # lastDate holds a day number now, a TEXT column would store it as a string
+    cur.execute("DROP TABLE habit_stats")
+    cur.execute("""CREATE TABLE habit_stats (
+        habitName TEXT PRIMARY KEY,
+        currentStreak INTEGER NOT NULL DEFAULT 0,
+        bestStreak INTEGER NOT NULL DEFAULT 0,
+        lastDate INTEGER,
+        totalCompletions INTEGER NOT NULL DEFAULT 0)""")
+    cur.execute("CREATE INDEX habit_stats_best ON habit_stats (bestStreak, habitName)")
+    _create_stats_triggers(cur, segments=False)
+    _rebuild_habit_stats(cur, segments=False)
+
+
+def _due_sql(day, periodicity):
+    """
+    Build the SQL expressions for the period after the one containing `day`: the first day a habit last completed on
+    `day` can be completed again (nextDue), and the last day that still continues its streak (deadline).
+    Both are NULL for a NULL day or an unknown periodicity.
+    :param day: SQL expression for the day number of the last completion
+    :param periodicity: SQL expression for the periodicity code
+    :return: (nextDue, deadline) SQL expressions
+    """
+    monday = f"({day} - ({day} - 1) % 7)"  # day number 1 is a Monday
+    month = f"{day} + {JULIAN_ORDINAL_OFFSET}, 'start of month'"
+    next_weekday = f"{day} + CASE ({day} - 1) % 7 WHEN 4 THEN 3 WHEN 5 THEN 2 ELSE 1 END"
+    next_due = f"""CASE
+            WHEN {periodicity} = {DAILY} THEN {day} + 1
+            WHEN {periodicity} = {WEEKLY} THEN {monday} + 7
+            WHEN {periodicity} = {WEEKDAYS} THEN {next_weekday}
+            WHEN {periodicity} = {MONTHLY}
+                THEN CAST(julianday({month}, '+1 month') - {JULIAN_ORDINAL_OFFSET} AS INTEGER)
+            WHEN {periodicity} < 0 THEN {day} - {periodicity} END"""
+    deadline = f"""CASE
+            WHEN {periodicity} = {DAILY} THEN {day} + 1
+            WHEN {periodicity} = {WEEKLY} THEN {monday} + 13
+            WHEN {periodicity} = {WEEKDAYS} THEN {next_weekday}
+            WHEN {periodicity} = {MONTHLY}
+                THEN CAST(julianday({month}, '+2 months', '-1 day') - {JULIAN_ORDINAL_OFFSET} AS INTEGER)
+            WHEN {periodicity} < 0 THEN {day} - 2 * {periodicity} - 1 END"""
+    return next_due, deadline
+
+
+def _update_due_sql(name):
+    """
+    Build the statement that recomputes one habit's nextDue and deadline from its lastDate and periodicity.
+    :param name: SQL expression for the habit name
+    :return: str
+    """
+    next_due, deadline = _due_sql("habit_stats.lastDate", "habits.periodicity")
+    return f"""UPDATE habit_stats SET (nextDue, deadline) = (SELECT {next_due}, {deadline}
+            FROM habits WHERE habits.name = {name})
+        WHERE habitName = {name};"""
+
+
+def _create_due_dates(cur):
+    """
+    Migration 5: store each habit's next due day and grace deadline in habit_stats.
+    They only change when a habit's last tracker date or its periodicity does, so triggers recompute them then and
+    status checks and the sweep compare today against the stored days instead of doing date arithmetic.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    cur.execute("ALTER TABLE habit_stats ADD COLUMN nextDue INTEGER")
+    cur.execute("ALTER TABLE habit_stats ADD COLUMN deadline INTEGER")
+    # Overdue habits for the sweep
+    cur.execute("CREATE INDEX habit_stats_deadline ON habit_stats (deadline)")
+    cur.execute(f"""CREATE TRIGGER habit_stats_due_insert AFTER INSERT ON habit_stats
+        WHEN NEW.lastDate IS NOT NULL BEGIN
+        {_update_due_sql("NEW.habitName")}
+    END""")
+    cur.execute(f"""CREATE TRIGGER habit_stats_due_update AFTER UPDATE OF lastDate ON habit_stats
+        WHEN NEW.lastDate IS NOT OLD.lastDate BEGIN
+        {_update_due_sql("NEW.habitName")}
+    END""")
+    cur.execute(f"""CREATE TRIGGER habits_due_update AFTER UPDATE OF periodicity ON habits
+        WHEN NEW.periodicity IS NOT OLD.periodicity BEGIN
+        {_update_due_sql("NEW.name")}
+    END""")
+    next_due, deadline = _due_sql("habit_stats.lastDate", "habits.periodicity")
+    cur.execute(f"""UPDATE habit_stats SET (nextDue, deadline) = (SELECT {next_due}, {deadline}
+        FROM habits WHERE habits.name = habit_stats.habitName)""")
+
+
+def _create_tracker_segments(cur):
+    """
+    Migration 6: table for compacted tracker history, see compaction.py.
+    A segment stands for `length` tracker rows whose dates are evenly spaced from startDate to endDate and whose
+    streak counts up by one from startStreak. The habit_stats triggers are recreated to read it.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    cur.execute("""CREATE TABLE tracker_segments (
+        habitName TEXT NOT NULL,
+        startDate INTEGER NOT NULL,
+        endDate INTEGER NOT NULL,
+        startStreak INTEGER NOT NULL,
+        length INTEGER NOT NULL,
+        PRIMARY KEY (habitName, startDate),
+        FOREIGN KEY(habitName) REFERENCES habits(name))""")
+    _drop_stats_triggers(cur)
+    _create_stats_triggers(cur)
+
+
+def _create_change_log(cur):
+    """
+    Migration 7: sequenced log of habit changes, see subscribe and get_changes.
+    The functions in this module and analyse.py that change a habit append a row in the same transaction as the
+    change itself. AUTOINCREMENT keeps sequence numbers from being reused after prune_changes.
+    :param cur: a cursor inside the migration transaction
+    :return: None
+    """
+    cur.execute("""CREATE TABLE change_log (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        habitName TEXT NOT NULL,
+        date INTEGER NOT NULL,
+        data TEXT NOT NULL)""")
+
+
+# Ordered list of schema migrations, the schema version is the number of migrations applied.
+# Only ever append to this list.
+MIGRATIONS = [
+    _create_base_tables,
+    _index_tracker,
+    _create_habit_stats,
+    _compact_storage,
+    _create_due_dates,
+    _create_tracker_segments,
+    _create_change_log,
+]
+
+
+def get_schema_version(db):
+    """
+    Return the schema version of the database, 0 for a database that has never been migrated.
+    :param db: the database connection object
+    :return: int
+    """
+    cur = db.cursor()
+    cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+    cur.execute("SELECT MAX(version) FROM schema_version")
+    version = cur.fetchone()[0]
+    return version or 0
+
+
+def migrate(db):
+    """
+    Upgrade the database in place by running every migration newer than its schema version.
+    All pending migrations run inside a single transaction, so a failed upgrade leaves the file untouched.
+    :param db: the database connection object
+    :return: int, the schema version after migrating
+    """
+    if get_schema_version(db) >= len(MIGRATIONS):
+        return len(MIGRATIONS)
+    db.commit()
+    cur = db.cursor()
+    # Take the write lock before re-reading the version, another process may have migrated meanwhile
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        version = get_schema_version(db)
+        for number in range(version, len(MIGRATIONS)):
+            MIGRATIONS[number](cur)
+            cur.execute("INSERT INTO schema_version VALUES (?)", (number + 1,))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    return len(MIGRATIONS)
+
+
+def rebuild_habit_stats(db):
+    """
+    Rebuild the habit_stats summary table from the tracker history.
+    Only needed if the summary is suspected to have drifted, e.g. after restoring tracker rows with the triggers
+    dropped, the migration that creates the table already fills it for existing databases.
+    :param db: the database connection object
+    :return: None
+    """
+    cur = db.cursor()
+    _rebuild_habit_stats(cur)
+    db.commit()
+
+
+@contextmanager
+def bulk_load(db):
+    """
+    Context manager for writing many tracker rows at once.
+    Per-row habit_stats maintenance is suspended for the duration and the summary of every habit added to the
+    yielded set is recomputed at the end, which is several times faster than firing the triggers per row.
+    The triggers are dropped and recreated inside the caller's transaction, so other connections never see
+    them missing. Nothing is committed, the caller owns the transaction.
+    :param db: the database connection object
+    :return: a set, the caller adds the name of every habit it writes tracker rows for
+    """
+    touched = set()
+    cur = db.cursor()
+    # DDL does not open a transaction implicitly, the caller's writes must share one with the trigger swap
+    if not db.in_transaction:
+        cur.execute("BEGIN")
+    _drop_stats_triggers(cur)
+    yield touched
+    _refresh_habit_stats(cur, touched)
+    _create_stats_triggers(cur)
+    # Bulk loads write habits directly
+    cache = habit_cache(db)
+    if cache is not None:
+        cache.clear()
+
+
+def log_change(db, cur, kind, name, day=None, **data):
+    """
+    Append a change to the change log, inside the transaction of the write it records.
+    Nothing is committed, the change is passed to subscribers when the caller commits.
+    :param db: the database connection object
+    :param cur: the cursor the write was made with
+    :param kind: "add", "update", "remove", "complete", "break" or "import"
+    :param name: the name of the habit
+    :param day: day number the change applies to, defaults to today
+    :param data: details of the change, stored as JSON
+    :return: the Change
+    """
+    day = date.today().toordinal() if day is None else day
+    cur.execute("INSERT INTO change_log (kind, habitName, date, data) VALUES (?, ?, ?, ?)",
+                (kind, name, day, json.dumps(data)))
+    change = Change(cur.lastrowid, kind, name, day, data)
+    pending = getattr(db, "pending_changes", None)
+    if pending is not None:
+        pending.append(change)
+    return change
+
+
+def log_changes(db, cur, changes):
+    """
+    Append many changes to the change log with one executemany, for batch writes, see log_change.
+    :param db: the database connection object
+    :param cur: a cursor inside the transaction of the writes
+    :param changes: a list of (kind, name, day number, data dict) tuples
+    :return: a list of Change
+    """
+    if not changes:
+        return []
+    cur.executemany("INSERT INTO change_log (kind, habitName, date, data) VALUES (?, ?, ?, ?)",
+                    [(kind, name, day, json.dumps(data)) for kind, name, day, data in changes])
+    # The write lock is held, so the batch got consecutive sequence numbers ending at the latest one
+    first = get_change_seq(db) - len(changes) + 1
+    logged = [Change(first + offset, *change) for offset, change in enumerate(changes)]
+    pending = getattr(db, "pending_changes", None)
+    if pending is not None:
+        pending.extend(logged)
+    return logged
+
+
+def subscribe(db, callback):
+    """
+    Call callback with the list of changes made on this connection after each commit that made any, in log order.
+    Callbacks run after the commit. An exception raised by one is logged and does not reach the writer, the changes
+    stay committed and the other callbacks still run.
+    :param db: a connection from get_db
+    :param callback: called with a list of Change
+    :return: callback, to pass to unsubscribe
+    """
+    db.subscribers.append(callback)
+    return callback
+
+
+def unsubscribe(db, callback):
+    """
+    Stop calling a callback registered with subscribe.
+    :return: None
+    """
+    if callback in db.subscribers:
+        db.subscribers.remove(callback)
+
+
+def get_changes(db, since=0, limit=None):
+    """
+    Return the committed changes after sequence number since, oldest first, to catch up from the last change seen
+    instead of re-reading every habit. Changes made by other connections and processes are included.
+    :param db: the database connection object
+    :param since: the seq of the last change already processed, 0 for the whole log
+    :param limit: return at most this many changes
+    :return: a list of Change
+    """
+    cur = db.cursor()
+    cur.execute("SELECT seq, kind, habitName, date, data FROM change_log WHERE seq > ? ORDER BY seq LIMIT ?",
+                (since, -1 if limit is None else limit))
+    return [Change(seq, kind, name, day, json.loads(data)) for seq, kind, name, day, data in cur.fetchall()]
+
+
+def get_change_seq(db):
+    """
+    Return the sequence number of the latest change, 0 if none were logged, to start following the log from now.
+    :param db: the database connection object
+    :return: int
+    """
+    cur = db.cursor()
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'")
+    row = cur.fetchone()
+    return row[0] if row is not None else 0
+
+
+def prune_changes(db, upto):
+    """
+    Delete the changes up to and including sequence number upto, once every consumer has processed them.
+    Later changes keep their sequence numbers.
+    :param db: the database connection object
+    :param upto: the seq of the last change to delete
+    :return: the number of changes deleted
+    """
+    cur = db.cursor()
+    cur.execute("DELETE FROM change_log WHERE seq <= ?", (upto,))
     db.commit()
+    return cur.rowcount
 
 
 def add_habit(db, name, description, periodicity):
@@ -49,10 +884,19 @@ def add_habit(db, name, description, periodicity):
     Returns:
     This function does not return anything.
     """
+    code = _require_periodicity_code(periodicity)
     cur = db.cursor()
-    cur.execute("INSERT or IGNORE INTO habits VALUES (?, ?, ?)", (name, description, periodicity))
-    cur.execute("INSERT INTO tracker VALUES (?, ?, 0)", (date.today(), name))
+    cur.execute("INSERT or IGNORE INTO habits VALUES (?, ?, ?)", (name, description, code))
+    added = cur.rowcount == 1
+    # An existing habit is left as it is, its tracker history included
+    if added:
+        # habit_stats is filled in by the tracker insert trigger
+        cur.execute("INSERT or IGNORE INTO tracker VALUES (?, ?, 0)", (date.today().toordinal(), name))
+        log_change(db, cur, "add", name, description=description, periodicity=periodicity_name(code))
     db.commit()
+    cache = habit_cache(db)
+    if cache is not None and added:
+        cache.added((name, description, periodicity_name(code)))
 
 
 def remove_habit(db, name):
@@ -68,8 +912,16 @@ def remove_habit(db, name):
     """
     cur = db.cursor()
     cur.execute("DELETE FROM habits WHERE name = ?", (name,))
+    if cur.rowcount == 1:
+        log_change(db, cur, "remove", name)
+    # Dropping the summary row first turns the per-row stats triggers of the tracker delete into no-ops
+    cur.execute("DELETE FROM habit_stats WHERE habitName = ?", (name,))
     cur.execute("DELETE FROM tracker WHERE habitName = ?", (name,))
+    cur.execute("DELETE FROM tracker_segments WHERE habitName = ?", (name,))
     db.commit()
+    cache = habit_cache(db)
+    if cache is not None:
+        cache.removed(name)
 
 
 def update_habit(db, name, description, periodicity):
@@ -85,9 +937,16 @@ def update_habit(db, name, description, periodicity):
     Returns:
     None
     """
+    code = _require_periodicity_code(periodicity)
     cur = db.cursor()
-    cur.execute("UPDATE habits SET description = ?, periodicity = ? WHERE name = ?", (description, periodicity, name))
+    cur.execute("UPDATE habits SET description = ?, periodicity = ? WHERE name = ?", (description, code, name))
+    updated = cur.rowcount == 1
+    if updated:
+        log_change(db, cur, "update", name, description=description, periodicity=periodicity_name(code))
     db.commit()
+    cache = habit_cache(db)
+    if cache is not None and updated:
+        cache.added((name, description, periodicity_name(code)))
 
 
 def complete_habit(db, name):
@@ -100,14 +959,22 @@ def complete_habit(db, name):
     name (string): The name of the habit to update.
 
     Returns:
-    None
+    bool: True if the completion was recorded, False if the habit does not exist or already has a row for today.
     """
-    date_row = calculate_most_recent_date(db, name)
+    today = date.today().toordinal()
     cur = db.cursor()
-    cur.execute("SELECT streakCounter FROM tracker WHERE date = ?", (date_row[0],))
-    streak = cur.fetchone()
-    cur.execute("INSERT or IGNORE INTO tracker VALUES (?, ?, ?)", (date.today(), name, streak[0] + 1))
+    # One statement reads the latest streak and inserts today's row, so no other writer can slip in between, and
+    # the unique (habitName, date) index turns a second completion on the same day into a no-op
+    cur.execute("""INSERT or IGNORE INTO tracker (date, habitName, streakCounter)
+        SELECT ?1, ?2, COALESCE((SELECT streakCounter FROM tracker WHERE habitName = ?2 ORDER BY date DESC LIMIT 1),
+                                -1) + 1
+        WHERE EXISTS (SELECT 1 FROM habits WHERE name = ?2)""", (today, name))
+    completed = cur.rowcount == 1
+    if completed:
+        cur.execute("SELECT streakCounter FROM tracker WHERE habitName = ? AND date = ?", (name, today))
+        log_change(db, cur, "complete", name, streak=cur.fetchone()[0])
     db.commit()
+    return completed
 
 
 def get_habits(db):
@@ -121,8 +988,8 @@ def get_habits(db):
     list : a list of tuples representing the retrieved habits
     """
     cur = db.cursor()
-    cur.execute("SELECT * FROM habits")
-    return cur.fetchall()
+    cur.execute("SELECT name, description, periodicity FROM habits")
+    return [(name, description, periodicity_name(code)) for name, description, code in cur.fetchall()]
 
 
 def get_tracker_data(db, name):
@@ -134,11 +1001,29 @@ def get_tracker_data(db, name):
         name: The name of the habit to retrieve tracker data for.
 
     Returns:
-        A list of tuples containing the retrieved tracker data.
+        A list of (ISO date, habit name, streak) tuples containing the retrieved tracker data.
     """
     cur = db.cursor()
-    cur.execute("SELECT * FROM tracker WHERE habitName = ?", (name,))
-    return cur.fetchall()
+    cur.execute("SELECT date, streakCounter FROM tracker WHERE habitName = ?", (name,))
+    rows = cur.fetchall()
+    cur.execute("SELECT startDate, endDate, startStreak, length FROM tracker_segments WHERE habitName = ?", (name,))
+    for segment in cur.fetchall():
+        rows.extend(segment_rows(*segment))
+    rows.sort()
+    return [(date.fromordinal(day).isoformat(), name, streak) for day, streak in rows]
+
+
+def segment_rows(start_date, end_date, start_streak, length):
+    """
+    Expand a tracker_segments row back into the tracker rows it stands for.
+    :param start_date: day number of the first row
+    :param end_date: day number of the last row
+    :param start_streak: streak of the first row
+    :param length: number of rows
+    :return: a list of (day number, streak) tuples
+    """
+    step = (end_date - start_date) // (length - 1) if length > 1 else 0
+    return [(start_date + index * step, start_streak + index) for index in range(length)]
 
 
 def get_habit_streak(db, name):
@@ -150,10 +1035,10 @@ def get_habit_streak(db, name):
     - name: the name of the habit to retrieve the streak for
 
     Returns:
-    - A single row from the database containing the streakCounter value for the specified habit
+    - A single row from the database containing the most recent streakCounter value for the specified habit
     """
     cur = db.cursor()
-    cur.execute("SELECT streakCounter FROM tracker WHERE habitName = ?", (name,))
+    cur.execute("SELECT streakCounter FROM tracker WHERE habitName = ? ORDER BY date DESC LIMIT 1", (name,))
     return cur.fetchone()
 
 
@@ -171,13 +1056,56 @@ def get_elapsed_time(db, habit):
     cur = db.cursor()
     cur.execute("SELECT MAX(date) FROM tracker WHERE habitName = ?", (habit,))
     habit_start_date = cur.fetchone()
-    start_date = date.fromisoformat(habit_start_date[0])
-    end_date = date.today()
-    elapsed_time = end_date - start_date
-    elapsed_delta = elapsed_time.days
+    elapsed_delta = date.today().toordinal() - habit_start_date[0]
     return elapsed_delta
 
 
+def get_due_dates(db, habit):
+    """
+    Retrieves when a habit can next be completed and the last day its streak can still be continued.
+
+    Parameters:
+    - db: the database connection object
+    - habit: the name of the habit
+
+    Returns:
+    - A (next due, deadline) tuple of ISO date strings, or None if the habit has no tracker rows or periodicity
+    """
+    cur = db.cursor()
+    cur.execute("SELECT nextDue, deadline FROM habit_stats WHERE habitName = ?", (habit,))
+    row = cur.fetchone()
+    if row is None or row[1] is None:
+        return None
+    return date.fromordinal(row[0]).isoformat(), date.fromordinal(row[1]).isoformat()
+
+
+def get_habit(db, name):
+    """
+    Retrieves a single habit, answered from the connection's habit cache when possible.
+
+    Parameters:
+    - db: the database connection object
+    - name: the name of the habit
+
+    Returns:
+    - A (name, description, periodicity) tuple, or None if the habit does not exist
+    """
+    cache = habit_cache(db)
+    if cache is not None:
+        row = cache.get(name)
+        if row is not None:
+            return row
+    cur = db.cursor()
+    cur.execute("SELECT name, description, periodicity FROM habits WHERE name = ?", (name,))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    row = (row[0], row[1], periodicity_name(row[2]))
+    if cache is not None:
+        cache.put(row)
+    return row
+
+
 def get_periodicity(db, habit):
     """
     Retrieves the periodicity of a specific habit from the database.
@@ -189,10 +1117,27 @@ def get_periodicity(db, habit):
     Returns:
     - The periodicity of the habit
     """
-    cur = db.cursor()
-    cur.execute("SELECT periodicity FROM habits WHERE name = ?", (habit,))
-    periodicity = cur.fetchone()
-    return periodicity
+    row = get_habit(db, habit)
+    if row is None:
+        return None
+    return row[2],
+
+
+def get_periodicity_code(db, habit):
+    """
+    Retrieves the stored periodicity code (DAILY, WEEKLY) of a specific habit.
+
+    Parameters:
+    - db: the database connection object
+    - habit: the name of the habit
+
+    Returns:
+    - The periodicity code, or None if the habit does not exist
+    """
+    row = get_habit(db, habit)
+    if row is None:
+        return None
+    return periodicity_code(row[2])
 
 
 def calculate_most_recent_date(db, habit):
@@ -204,8 +1149,9 @@ def calculate_most_recent_date(db, habit):
         habit: The name of the habit.
 
     Returns:
-        tuple: A tuple containing the most recent date for the habit.
+        tuple: A tuple containing the most recent date for the habit as an ISO date string, or None.
     """
     cur = db.cursor()
     cur.execute('SELECT MAX(date) FROM tracker WHERE habitName = ?', (habit,))
-    return cur.fetchone()
+    day = cur.fetchone()[0]
+    return (None if day is None else date.fromordinal(day).isoformat()),
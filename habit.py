@@ -12,9 +12,11 @@ class Habit:
     description : str
         A description of what is required to complete the habit
     periodicity : str
-        The periodicity of the habit, either weekly or daily
+        The periodicity of the habit: daily, weekly, weekdays, monthly or "every N days"
     """
 
+    __slots__ = ("name", "description", "periodicity")
+
     def __init__(self, name: str, description: str, periodicity: str):
         self.name = name
         self.description = description
@@ -33,4 +35,5 @@ class Habit:
         remove_habit(db, self.name)
 
     def get_streak(self, db):
-        get_habit_streak(db, self.name)
+        row = get_habit_streak(db, self.name)
+        return None if row is None else row[0]
@@ -1,23 +1,152 @@
-import questionary
-from db import get_db, get_habits, get_periodicity
+import argparse
+import atexit
+import shlex
+import sys
+from datetime import date, datetime
+from db import (get_db, get_habits, get_habit, get_changes, rebuild_habit_stats, transaction, periodicity_code,
+                PERIODICITY_CODES, DAILY, WEEKLY, WEEKDAYS, MONTHLY)
+from profiling import enable_profiling, set_action
 from habit import Habit
-from analyse import (return_max_habit_streaks, break_streak, habit_status, get_habit_names,
-                     get_streak_counter, get_name_of_longest_streak, get_single_alltime_streak, get_alltime_streak,
-                     get_alltime_habit, get_habits_by_periodicity)
+from reports import completion_report, format_report, render_heatmap
+from name_index import NameIndex
+from replica import SnapshotReplica
+from scheduler import DueScheduler, run_reminders
+from analyse import (break_streak, habit_status, get_habit_names, sweep_broken_streaks, get_streak_counter,
+                     get_single_alltime_streak, get_habits_by_periodicity, top_streaks)
 
+STATUS_MESSAGES = {
+    1: "ready to complete",
+    2: "broken",
+    3: "completed today",
+    4: "completed this week",
+    5: "completed this period",
+}
 
-def cli():
+# Unit a streak is counted in for each periodicity code, "every N days" habits count periods
+STREAK_UNITS = {DAILY: "days", WEEKLY: "weeks", WEEKDAYS: "weekdays", MONTHLY: "months"}
+# Read-only commands that --snapshot runs against a SnapshotReplica
+SNAPSHOT_COMMANDS = ("status", "streak", "report", "top", "rates", "due", "changes")
+
+
+class CommandError(Exception):
+    """
+    Raised by a scripted command that cannot be carried out, e.g. for a habit that does not exist.
+    """
+
+
+def mark_complete(db, name):
+    """
+    Mark a habit as complete if its status allows it. A broken habit is completed and then has its streak broken,
+    both in one commit, so the completion is never stored without the reset.
+    The status is read under the write lock, so concurrent calls for the same habit take effect one after another.
+
+    Parameters:
+    - db: the database connection object
+    - name: the name of the habit
+
+    Returns:
+    - The habit status before completing, as returned by habit_status
+    """
+    habit = Habit(name, "", "")
+    with transaction(db, immediate=True):
+        status = habit_status(db, name)
+        if status == 1:
+            habit.complete(db)
+        elif status == 2:
+            habit.complete(db)
+            break_streak(db, name)
+    return status
+
+
+def ask_periodicity(questionary):
+    """
+    Ask for a periodicity in the interactive menu, asking for the number of days for "every N days".
+    """
+    periodicity = questionary.select(
+        "Enter the periodicity of the habit",
+        choices=[*PERIODICITY_CODES, "every N days"],
+    ).ask()
+    if periodicity == "every N days":
+        days = questionary.text("Enter the number of days",
+                                validate=lambda text: text.isdigit() and int(text) > 0).ask()
+        periodicity = f"every {days} days"
+    return periodicity
+
+
+def name_completer(index, limit=20):
+    """
+    Build a prompt_toolkit completer offering the indexed names that start with the text typed so far.
+    """
+    # prompt_toolkit comes with questionary, so it is only imported by the interactive menu
+    from prompt_toolkit.completion import Completer, Completion
+
+    class NameCompleter(Completer):
+        def get_completions(self, document, complete_event):
+            text = document.text_before_cursor
+            for name in index.prefix(text, limit):
+                yield Completion(name, start_position=-len(text))
+
+    return NameCompleter()
+
+
+def ask_habit_name(questionary, index):
+    """
+    Ask for the name of an existing habit in the interactive menu, completing names as they are typed.
+    A name differing only in case from a single habit's is taken as that habit's. Otherwise prints why the name was
+    not accepted, with close matches if there are any, and returns None.
+    """
+    name = questionary.autocomplete("Enter the name of the habit", choices=index.names,
+                                    completer=name_completer(index)).ask()
+    if not name:
+        print("Habit name cannot be empty")
+        return None
+    match = index.resolve(name)
+    if match is None:
+        print(missing_habit(name, index))
+    return match
+
+
+def missing_habit(name, index):
+    """
+    Return the message for a habit that does not exist, suggesting names that are close to it.
+    """
+    suggestions = index.suggest(name)
+    message = f'Habit "{name}" does not exist'
+    return f"{message}, did you mean {', '.join(suggestions)}?" if suggestions else message
+
+
+def profile_session(db, profile_output=None):
+    """
+    Record every SQL statement run on the connection and report on them when the program exits.
+    The summary is printed, or written as JSON to profile_output if given.
+    """
+    profiler = enable_profiling(db)
+    if profile_output:
+        atexit.register(profiler.dump, profile_output)
+    else:
+        atexit.register(profiler.report)
+
+
+def cli(profile=False, profile_output=None, name="main.db"):
     """
     Command line interface for managing habits. Allows users to add, remove, and mark habits as complete,
-    as well as view and manage habit streaks. Upon initialization, checks if there are any habits in the database and
-    calls the corresponding function to check the status of each habit, overwriting streak data if necessary.
+    as well as view and manage habit streaks. Upon initialization, sweeps the database once for habits that were not
+    completed within their period, overwriting streak data if necessary.
+    With profile set, every SQL statement of the session is recorded and a summary grouped by menu action is printed
+    on exit, or written as JSON to profile_output.
     """
-    db = get_db()
-    habit_names = get_habit_names(db)
-    # Checks for habits in the database and breaks streaks if necessary
-    for i in range(len(habit_names)):
-        if habit_status(db, habit_names[i]) == 2:
-            break_streak(db, habit_names[i])
+    # Only the interactive menu needs questionary, scripted commands start without it
+    import questionary
+
+    db = get_db(name)
+    if profile:
+        profile_session(db, profile_output)
+        set_action(db, "Startup")
+    # Breaks the streaks of all habits that were not completed in time
+    sweep_broken_streaks(db)
+    scheduler = DueScheduler.load(db)
+    index = NameIndex.load(db)
+    print(format_due(scheduler.due_now(), scheduler.breaking_within(24), 24))
 
     # Main loop for user interaction
     stop = False
@@ -29,8 +158,9 @@ def cli():
                 "Add habit", "Remove habit", "Mark habit complete", "Update Habit",
                 "Show habits", "Show habits by periodicity",
                 "Show a habit's streak", "Show my longest streak", "Show a habit's longest streak",
-                "Show the longest streak by periodicity", "Exit"],
+                "Show the longest streak by periodicity", "Show completion rates", "Exit"],
         ).ask()
+        set_action(db, choice)
 
         if choice == "Show habits":
             # Display all habits within the database
@@ -43,142 +173,416 @@ def cli():
         elif choice == "Add habit":
             # Write a new habit to the database
             name = questionary.text("Enter the name of the habit").ask()
-            if get_habit_names(db) is not None and name in get_habit_names(db):
+            if name in index:
                 print("Habit already exists")
             elif name == "":
                 print("Habit name cannot be empty")
             else:
                 description = questionary.text("Enter the description of the habit").ask()
-                periodicity = questionary.select(
-                    "Enter the periodicity of the habit",
-                    choices=["daily", "weekly"],
-                ).ask()
+                periodicity = ask_periodicity(questionary)
                 habit = Habit(name, description, periodicity)
                 habit.store(db)
+                index.add(name)
+                scheduler.refresh(db, name)
 
         elif choice == "Remove habit":
             # Remove a habit and all corresponding tracker data from the database
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                name = questionary.text("Enter the name of the habit").ask()
-                if name == "":
-                    print("Habit name cannot be empty")
-                elif name not in get_habit_names(db):
-                    print("Habit does not exist")
-                habit = Habit(name, "", "")
-                habit.remove(db)
+                name = ask_habit_name(questionary, index)
+                if name is not None:
+                    habit = Habit(name, "", "")
+                    habit.remove(db)
+                    index.remove(name)
+                    scheduler.remove(name)
 
         elif choice == "Update Habit":
             # Update a habit's description and periodicity in the database
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                name = questionary.text("Enter the name of the habit").ask()
-                if name not in get_habit_names(db):
-                    print("Habit does not exist")
-                else:
+                name = ask_habit_name(questionary, index)
+                if name is not None:
                     description = questionary.text("Enter the description of the habit").ask()
-                    periodicity = questionary.select(
-                        "Enter the periodicity of the habit",
-                        choices=["daily", "weekly"],
-                    ).ask()
+                    periodicity = ask_periodicity(questionary)
                     habit = Habit(name, description, periodicity)
                     habit.update(db)
+                    scheduler.refresh(db, name)
 
         elif choice == "Mark habit complete":
             # Write a new row entry to the database, incrementing the previous streak counter value by 1
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                name = questionary.text("Enter the name of the habit").ask()
-                if name not in get_habit_names(db):
-                    print("Habit does not exist")
-                else:
-                    habit = Habit(name, "", "")
-                    status = habit_status(db, name)
-                    if status == 1:
-                        habit.complete(db)
-                    elif status == 3:
+                name = ask_habit_name(questionary, index)
+                if name is not None:
+                    status = mark_complete(db, name)
+                    scheduler.refresh(db, name)
+                    if status == 3:
                         print("Habit has been marked completed already today")
                     elif status == 4:
                         print("Habit has been marked completed already this week")
+                    elif status == 5:
+                        print("Habit has been marked completed already this period")
                     elif status == 2:
-                        habit.complete(db)
-                        break_streak(db, name)
                         print("Habit has been broken")
 
         elif choice == "Show habits by periodicity":
             # Display all habits by periodicity
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                periodicity = questionary.select(
-                    "Enter the periodicity of the habit",
-                    choices=["daily", "weekly"],
-                ).ask()
+                periodicity = ask_periodicity(questionary)
                 print(get_habits_by_periodicity(db, periodicity))
 
         elif choice == "Show a habit's streak":
             # Display the current streak for a given habit
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                name = questionary.text("Enter the name of the habit").ask()
-                if name not in get_habit_names(db):
-                    print("Habit does not exist")
-                elif name == "":
-                    print("Habit name cannot be empty")
-                else:
+                name = ask_habit_name(questionary, index)
+                if name is not None:
                     streak = get_streak_counter(db, name)
-                    habit = name
-                    periodicity = str(get_periodicity(db, habit))[2:-3]
-                    if periodicity == "daily":
-                        print(f'The habit "{name}" has a streak of {streak} days!')
-                    elif periodicity == "weekly":
-                        print(f'The habit "{name}" has a streak of {streak} weeks!')
+                    print(f'The habit "{name}" has a streak of {streak} {unit(db, name)}!')
 
         elif choice == "Show my longest streak":
             # Display the name(s) of the habit(s) with the longest streak
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                print(f'The habit(s) with the longest streak are {get_name_of_longest_streak(db)}'
-                      f' with a streak of {return_max_habit_streaks(db)}!')
+                leaders = top_streaks(db, 1)
+                if not leaders:
+                    print("No streaks found")
+                else:
+                    print(f'The habit(s) with the longest streak are {leader_names(leaders)}'
+                          f' with a streak of {leaders[0].streak}!')
 
         elif choice == "Show a habit's longest streak":
             # Display the longest streak for a given habit
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                name = questionary.text("Enter the name of the habit").ask()
-                if name not in get_habit_names(db):
-                    print("Habit does not exist")
-                elif name == "":
-                    print("Habit name cannot be empty")
-                else:
+                name = ask_habit_name(questionary, index)
+                if name is not None:
                     streak = get_single_alltime_streak(db, name)
                     print(f'The longest streak for habit "{name}" is {streak}!')
 
         elif choice == "Show the longest streak by periodicity":
             # Display the longest streak for a given periodicity
-            if not get_habits(db):
+            if not index:
                 print("No habits found")
             else:
-                periodicity = questionary.select(
-                    "Enter the periodicity of the habit",
-                    choices=["daily", "weekly"],
-                ).ask()
-                alltime_streak = get_alltime_streak(db, periodicity)
-                habits = get_alltime_habit(db, periodicity)
-                if periodicity == "weekly":
-                    print(f'The longest recorded {periodicity} streak is {habits} at {alltime_streak} weeks!')
-                elif periodicity == "daily":
-                    print(f'The longest recorded {periodicity} streak is {habits} at {alltime_streak} days!')
+                periodicity = ask_periodicity(questionary)
+                leaders = top_streaks(db, 1, periodicity=periodicity)
+                if not leaders:
+                    print(f"No {periodicity} habits found")
+                else:
+                    print(f'The longest recorded {periodicity} streak is {leader_names(leaders)} at '
+                          f'{leaders[0].streak} {streak_unit(periodicity)}!')
+
+        elif choice == "Show completion rates":
+            # Display rolling completion rates per habit and overall, then optionally one habit's heatmap
+            if not index:
+                print("No habits found")
+            else:
+                report = completion_report(db)
+                print(format_report(report))
+                name = questionary.text("Enter a habit to show its heatmap, or leave empty to go back").ask()
+                for rates in report.habits:
+                    if rates.name == name:
+                        print(render_heatmap(rates.heatmap))
 
         elif choice == "Exit":
             exit()
 
 
+def require_habit(db, name):
+    """
+    Raise CommandError unless the habit exists, naming close matches if there are any.
+    """
+    if get_habit(db, name) is None:
+        raise CommandError(missing_habit(name, NameIndex.load(db)))
+
+
+def streak_unit(periodicity):
+    """
+    Return the unit streaks of a periodicity are counted in, e.g. "days" for "daily".
+    """
+    return STREAK_UNITS.get(periodicity_code(periodicity), "periods")
+
+
+def leader_names(leaders):
+    """
+    Join the names of tied habits from top_streaks for display.
+    """
+    return ", ".join(leader.name for leader in leaders)
+
+
+def unit(db, name):
+    """
+    Return the unit a habit's streak is counted in, e.g. "days" or "weeks".
+    """
+    return streak_unit(get_habit(db, name)[2])
+
+
+def periodicity_argument(text):
+    """
+    argparse type for --periodicity: a periodicity name such as "weekly" or "every 3 days".
+    """
+    if periodicity_code(text) is None:
+        raise argparse.ArgumentTypeError(f"invalid periodicity {text!r}, use one of {', '.join(PERIODICITY_CODES)} "
+                                         f"or 'every N days'")
+    return text
+
+
+def sweep(db):
+    """
+    Break overdue streaks before reading them, unless db is a read-only snapshot, see replica.py.
+    """
+    if not db.execute("PRAGMA query_only").fetchone()[0]:
+        sweep_broken_streaks(db)
+
+
+def format_due(due, breaking, hours):
+    """
+    Describe what is due: the habits that can be completed now and those whose streak breaks within hours.
+    """
+    lines = [f"Due now: {', '.join(due) if due else 'nothing'}"]
+    if breaking:
+        lines.append(f"Breaking within {hours:g} hours: {', '.join(breaking)}")
+    return "\n".join(lines)
+
+
+def run_command(db, args):
+    """
+    Run one scripted command and print its output.
+
+    Parameters:
+    - db: the database connection object
+    - args: the parsed arguments of a subcommand, see build_parser
+
+    Raises:
+    - CommandError if the command cannot be carried out
+    """
+    if args.command == "add":
+        if get_habit(db, args.name) is not None:
+            raise CommandError(f'Habit "{args.name}" already exists')
+        if args.name == "":
+            raise CommandError("Habit name cannot be empty")
+        Habit(args.name, args.description, args.periodicity).store(db)
+        print(f'Added habit "{args.name}"')
+
+    elif args.command == "complete":
+        for name in args.names:
+            require_habit(db, name)
+            status = mark_complete(db, name)
+            if status == 1:
+                print(f'Habit "{name}" marked complete')
+            elif status == 2:
+                print(f'Habit "{name}" marked complete, its streak had been broken')
+            else:
+                print(f'Habit "{name}" has been {STATUS_MESSAGES[status]} already')
+
+    elif args.command == "status":
+        for name in args.names or get_habit_names(db):
+            require_habit(db, name)
+            print(f"{name}: {STATUS_MESSAGES[habit_status(db, name)]}")
+
+    elif args.command == "streak":
+        require_habit(db, args.name)
+        sweep(db)
+        if args.longest:
+            print(f'{args.name}: longest streak {get_single_alltime_streak(db, args.name)} {unit(db, args.name)}')
+        else:
+            print(f'{args.name}: streak {get_streak_counter(db, args.name)} {unit(db, args.name)}')
+
+    elif args.command == "report":
+        sweep(db)
+        if not get_habits(db):
+            print("No habits found")
+            return
+        leaders = top_streaks(db, 1)
+        if not leaders:
+            print("No streaks found")
+            return
+        print(f"Longest streak: {leader_names(leaders)} at {leaders[0].streak}")
+        # Calendar periodicities first, then "every N days" from the shortest period
+        periodicities = {row[2] for row in get_habits(db) if row[2] is not None}
+        for periodicity in sorted(periodicities, key=lambda name: (periodicity_code(name) < 0,
+                                                                   abs(periodicity_code(name)))):
+            leaders = top_streaks(db, 1, periodicity=periodicity)
+            if leaders:
+                print(f"Longest {periodicity} streak: {leader_names(leaders)} "
+                      f"at {leaders[0].streak} {streak_unit(periodicity)}")
+
+    elif args.command == "top":
+        sweep(db)
+        for leader in top_streaks(db, args.k, args.current, args.periodicity):
+            print(f"{leader.rank:3}. {leader.name} ({leader.periodicity}): {leader.streak} "
+                  f"{streak_unit(leader.periodicity)}")
+
+    elif args.command == "rates":
+        report = completion_report(db)
+        print(format_report(report))
+        for name in args.heatmap:
+            require_habit(db, name)
+            heatmap = next(rates.heatmap for rates in report.habits if rates.name == name)
+            print(f"\n{name}\n{render_heatmap(heatmap)}")
+
+    elif args.command == "due":
+        sweep(db)
+        scheduler = DueScheduler.load(db)
+        print(format_due(scheduler.due_now(), scheduler.breaking_within(args.hours), args.hours))
+        reminder = scheduler.next_reminder(warn_hours=args.hours)
+        if reminder is not None:
+            moment, kind, name = reminder
+            print(f"Next reminder: {moment:%Y-%m-%d %H:%M}, {name} {'is due' if kind == 'due' else 'breaks soon'}")
+
+    elif args.command == "remind":
+        sweep(db)
+
+        def notify(due, breaking):
+            print(f"[{datetime.now():%Y-%m-%d %H:%M}] {format_due(due, breaking, args.hours)}", flush=True)
+        try:
+            run_reminders(DueScheduler.load(db), notify, args.hours)
+        except KeyboardInterrupt:
+            pass
+
+    elif args.command == "changes":
+        for change in get_changes(db, args.since, args.limit):
+            details = "".join(f" {key}={value!r}" for key, value in change.data.items())
+            print(f"{change.seq} {date.fromordinal(change.day)} {change.kind} {change.name}{details}")
+
+    elif args.command == "rebuild-stats":
+        rebuild_habit_stats(db)
+        print("Rebuilt habit statistics")
+
+
+def run_batch(db, lines, parser):
+    """
+    Run one scripted command per line in a single transaction. Blank lines and lines starting with # are skipped.
+    If any command fails, none of the batch is applied.
+
+    Parameters:
+    - db: the database connection object
+    - lines: an iterable of command lines, e.g. sys.stdin
+    - parser: the parser from build_parser
+
+    Returns:
+    - The number of commands run
+
+    Raises:
+    - CommandError naming the failing line
+    """
+    count = 0
+    # The write lock is taken up front: a batch that starts with a read could not take it later while another
+    # connection writes, and would fail at once instead of waiting for busy_timeout
+    with transaction(db, immediate=True):
+        for number, line in enumerate(lines, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                args = parser.parse_args(shlex.split(line))
+            except SystemExit:
+                raise CommandError(f"line {number}: invalid command {line!r}")
+            if args.command in (None, "batch", "remind"):
+                raise CommandError(f"line {number}: {args.command or 'interactive'} cannot run in a batch")
+            try:
+                run_command(db, args)
+            except CommandError as error:
+                raise CommandError(f"line {number}: {error}")
+            count += 1
+    return count
+
+
+def build_parser():
+    """
+    Build the argument parser for the scripted commands.
+    """
+    parser = argparse.ArgumentParser(
+        description="Habit tracker. Without a command, starts the interactive menu.")
+    parser.add_argument("--db", default="main.db", help="the database file, defaults to main.db")
+    parser.add_argument("--snapshot", type=float, metavar="SECONDS",
+                        help="run " + ", ".join(SNAPSHOT_COMMANDS) + " against a read-only snapshot of the database "
+                             "at most SECONDS old, so they do not hold up writers")
+    parser.add_argument("--profile", action="store_true",
+                        help="record every SQL statement and print a summary on exit")
+    parser.add_argument("--profile-output", metavar="FILE",
+                        help="write the --profile summary to FILE as JSON instead, implies --profile")
+    subparsers = parser.add_subparsers(dest="command")
+    add_parser = subparsers.add_parser("add", help="add a habit")
+    add_parser.add_argument("name")
+    add_parser.add_argument("--description", default="")
+    add_parser.add_argument("--periodicity", type=periodicity_argument, default="daily",
+                            help='daily, weekly, weekdays, monthly or "every N days", defaults to daily')
+    complete_parser = subparsers.add_parser("complete", help="mark habits complete")
+    complete_parser.add_argument("names", nargs="+", metavar="name")
+    status_parser = subparsers.add_parser("status", help="show the status of habits, all habits by default")
+    status_parser.add_argument("names", nargs="*", metavar="name")
+    streak_parser = subparsers.add_parser("streak", help="show a habit's streak")
+    streak_parser.add_argument("name")
+    streak_parser.add_argument("--longest", action="store_true", help="show the longest streak ever instead")
+    subparsers.add_parser("report", help="show the longest streaks")
+    rates_parser = subparsers.add_parser("rates", help="show completion rates over the last 7, 30 and 365 days")
+    rates_parser.add_argument("--heatmap", action="append", default=[], metavar="NAME",
+                              help="also draw a habit's completions over the last year, can be repeated")
+    top_parser = subparsers.add_parser("top", help="rank habits by streak, tied habits share a place")
+    top_parser.add_argument("-k", type=int, default=10, help="number of places, defaults to 10")
+    top_parser.add_argument("--current", action="store_true", help="rank by current streak instead of longest ever")
+    top_parser.add_argument("--periodicity", type=periodicity_argument, help="only rank habits of this periodicity")
+    due_parser = subparsers.add_parser("due", help="show which habits are due and which streaks break soon")
+    due_parser.add_argument("--hours", type=float, default=24, help="window for streaks about to break, default 24")
+    remind_parser = subparsers.add_parser("remind", help="print a reminder whenever habits become due or are about "
+                                                         "to break, until interrupted")
+    remind_parser.add_argument("--hours", type=float, default=1, help="hours before a break to remind at, default 1")
+    changes_parser = subparsers.add_parser("changes", help="list the logged habit changes, oldest first")
+    changes_parser.add_argument("--since", type=int, default=0, metavar="SEQ",
+                                help="only changes after sequence number SEQ, the first column of each line")
+    changes_parser.add_argument("--limit", type=int, help="list at most LIMIT changes")
+    subparsers.add_parser("rebuild-stats", help="recompute the streak summary table from the tracker history")
+    subparsers.add_parser("batch", help="run commands read from stdin, one per line, in a single transaction")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point: runs a scripted command, a batch from stdin, or the interactive menu when no command is given.
+    Returns the process exit status.
+    """
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    profile = args.profile or args.profile_output is not None
+    if args.command is None:
+        cli(profile=profile, profile_output=args.profile_output, name=args.db)
+        return 0
+    db = get_db(args.db)
+    replica = None
+    if args.snapshot is not None and args.command in SNAPSHOT_COMMANDS:
+        # Streaks are swept on the primary, so a fresh snapshot already has them broken
+        sweep_broken_streaks(db)
+        db.close()
+        replica = SnapshotReplica(args.db, max_staleness=args.snapshot)
+        db = replica.connection()
+    if profile:
+        profile_session(db, args.profile_output)
+        set_action(db, args.command)
+    try:
+        if args.command == "batch":
+            run_batch(db, sys.stdin, parser)
+        else:
+            run_command(db, args)
+    except CommandError as error:
+        print(error, file=sys.stderr)
+        return 1
+    finally:
+        if replica is not None:
+            replica.close()
+        else:
+            db.close()
+    return 0
+
+
 if __name__ == "__main__":
-    cli()
+    sys.exit(main())
@@ -0,0 +1,168 @@
+from bisect import bisect_left, insort
+from collections import Counter, defaultdict
+
+# Fuzzy matches are at most this many single-character edits away from the query
+MAX_DISTANCE = 2
+
+
+def bigrams(key):
+    """
+    Return the distinct pairs of adjacent characters of a key, with its start and end marked, e.g. "run" gives
+    {"^r", "ru", "un", "n$"}. A single edit changes at most two of them.
+    """
+    padded = f"^{key}$"
+    return {padded[i:i + 2] for i in range(len(padded) - 1)}
+
+
+def edit_distance(a, b, limit=MAX_DISTANCE):
+    """
+    Levenshtein distance between two strings, or limit + 1 as soon as it is known to exceed limit.
+    Only the band of the table within limit of the diagonal is filled in, so it takes O(limit * len(a)).
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i] + [limit + 1] * len(b)
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != b[j - 1]))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
+
+
+class NameIndex:
+    """
+    In-memory index of habit names for exact, prefix and fuzzy lookups, e.g. to check or autocomplete a typed name.
+    Names are kept case-folded in a sorted list, so a prefix lookup is a bisect plus the matches it returns, in a
+    dict for exact lookups, and by bigram for fuzzy lookups. Add and remove names as habits are added and removed.
+
+    Parameters
+    ----------
+    names : iterable
+        The habit names to index
+    """
+
+    def __init__(self, names=()):
+        self._names = {}
+        # bigram -> names whose key contains it
+        self._bigrams = defaultdict(set)
+        for name in names:
+            self._names[name] = name.casefold()
+        self._keys = sorted((key, name) for name, key in self._names.items())
+        for name, key in self._names.items():
+            for gram in bigrams(key):
+                self._bigrams[gram].add(name)
+
+    @classmethod
+    def load(cls, db):
+        """
+        Index every habit name with a single query.
+        :param db: the database connection object
+        :return: a NameIndex
+        """
+        cur = db.cursor()
+        cur.execute("SELECT name FROM habits")
+        return cls(name for name, in cur.fetchall())
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    @property
+    def names(self):
+        """
+        Every indexed name, in case-insensitive order.
+        """
+        return [name for _, name in self._keys]
+
+    def add(self, name):
+        """
+        Index a new habit name.
+        :return: None
+        """
+        if name not in self._names:
+            self._names[name] = name.casefold()
+            insort(self._keys, (self._names[name], name))
+            for gram in bigrams(self._names[name]):
+                self._bigrams[gram].add(name)
+
+    def remove(self, name):
+        """
+        Drop a habit name from the index.
+        :return: None
+        """
+        key = self._names.pop(name, None)
+        if key is not None:
+            del self._keys[bisect_left(self._keys, (key, name))]
+            for gram in bigrams(key):
+                self._bigrams[gram].discard(name)
+
+    def resolve(self, name):
+        """
+        Return the indexed name a typed name stands for: the name itself, or the only name that matches it
+        ignoring case. Returns None if there is no such name or more than one.
+        """
+        if name in self._names:
+            return name
+        key = name.casefold()
+        start = bisect_left(self._keys, (key,))
+        matches = [match for match_key, match in self._keys[start:start + 2] if match_key == key]
+        return matches[0] if len(matches) == 1 else None
+
+    def prefix(self, prefix, limit=None):
+        """
+        Return the names that start with prefix, ignoring case, in case-insensitive order.
+        :param prefix: the typed text
+        :param limit: return at most this many names
+        :return: a list of names
+        """
+        key = prefix.casefold()
+        matches = []
+        for index in range(bisect_left(self._keys, (key,)), len(self._keys)):
+            match_key, name = self._keys[index]
+            if not match_key.startswith(key) or (limit is not None and len(matches) >= limit):
+                break
+            matches.append(name)
+        return matches
+
+    def fuzzy(self, name, limit=5, max_distance=MAX_DISTANCE):
+        """
+        Return the names within max_distance edits (Levenshtein distance) of name, ignoring case, closest first, for
+        "did you mean" suggestions.
+        Each edit changes at most two bigrams, so a match shares all but 2 * max_distance of name's bigrams. Only the
+        names sharing that many, counted from the bigram lists, have their distance computed, instead of every name.
+        :param name: the typed name
+        :param limit: return at most this many names
+        :param max_distance: the largest edit distance suggested
+        :return: a list of names
+        """
+        key = name.casefold()
+        grams = bigrams(key)
+        needed = len(grams) - 2 * max_distance
+        if needed > 0:
+            shared = Counter(match for gram in grams for match in self._bigrams.get(gram, ()))
+            candidates = [match for match, count in shared.items() if count >= needed]
+        else:
+            # Too short for the bigrams to rule anything out
+            candidates = self._names
+        scored = []
+        for match in candidates:
+            match_key = self._names[match]
+            distance = edit_distance(key, match_key, max_distance)
+            if distance <= max_distance:
+                scored.append((distance, match_key, match))
+        return [match for _, _, match in sorted(scored)[:limit]]
+
+    def suggest(self, name, limit=5):
+        """
+        Return names to offer for a typed name that does not exist: the names it is a prefix of, then close matches.
+        """
+        suggestions = self.prefix(name, limit) if name else []
+        for match in self.fuzzy(name, limit):
+            if match not in suggestions and len(suggestions) < limit:
+                suggestions.append(match)
+        return suggestions
@@ -0,0 +1,193 @@
+import heapq
+import json
+import sqlite3
+import sys
+import time
+from collections import defaultdict
+
+_PROFILING_MODULES = {__name__, "sqlite3", "sqlite3.dbapi2"}
+
+
+def _caller():
+    """
+    Return "module.function" of the nearest frame outside this module and the connection's own methods, i.e. the
+    code that ran the statement.
+    """
+    frame = sys._getframe(2)
+    while frame is not None and (frame.f_globals.get("__name__") in _PROFILING_MODULES
+                                 or isinstance(frame.f_locals.get("self"), sqlite3.Connection)):
+        frame = frame.f_back
+    if frame is None:
+        return "?"
+    return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_name}"
+
+
+class QueryProfiler:
+    """
+    Collects the text, row count and latency of every statement run on a profiled connection, grouped by the
+    calling function and by the menu action that was active at the time.
+    Statements are aggregated as they arrive, so memory use does not grow with the length of the session.
+
+    Parameters
+    ----------
+    keep_slowest : int
+        Number of individual slowest statements to remember
+    """
+
+    def __init__(self, keep_slowest=10):
+        self.keep_slowest = keep_slowest
+        self.action = None
+        self._statements = defaultdict(lambda: [0, 0, 0.0, 0.0])  # count, rows, total seconds, max seconds
+        self._slowest = []
+        self._sequence = 0
+
+    def start(self, sql, caller):
+        """
+        Open a record for a statement that is about to run.
+        :return: a list [action, caller, sql, rows, seconds] that the cursor fills in
+        """
+        return [self.action, caller, " ".join(sql.split()), 0, 0.0]
+
+    def finish(self, record):
+        """
+        Fold a completed statement record into the totals.
+        """
+        action, caller, sql, rows, seconds = record
+        totals = self._statements[action, caller, sql]
+        totals[0] += 1
+        totals[1] += rows
+        totals[2] += seconds
+        totals[3] = max(totals[3], seconds)
+        self._sequence += 1
+        entry = (seconds, self._sequence, action, caller, sql, rows)
+        if len(self._slowest) < self.keep_slowest:
+            heapq.heappush(self._slowest, entry)
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, entry)
+
+    def fetched(self, record, rows, seconds):
+        """
+        Add rows fetched after a statement ran, and the time spent fetching them, to that statement's totals.
+        """
+        totals = self._statements[record[0], record[1], record[2]]
+        totals[1] += rows
+        totals[2] += seconds
+
+    def summary(self):
+        """
+        Return the collected figures as a JSON-serialisable dict: overall totals, totals per menu action and per
+        calling function, every distinct statement ordered by total time including fetches, and the slowest single
+        executions.
+        """
+        by_action = defaultdict(lambda: {"queries": 0, "rows": 0, "seconds": 0.0})
+        by_caller = defaultdict(lambda: {"queries": 0, "rows": 0, "seconds": 0.0})
+        statements = []
+        for (action, caller, sql), (count, rows, seconds, slowest) in self._statements.items():
+            for group in (by_action[action or "(none)"], by_caller[caller]):
+                group["queries"] += count
+                group["rows"] += rows
+                group["seconds"] += seconds
+            statements.append({"action": action, "caller": caller, "sql": sql, "count": count, "rows": rows,
+                               "seconds": seconds, "max_seconds": slowest})
+        statements.sort(key=lambda statement: statement["seconds"], reverse=True)
+        return {
+            "queries": sum(group["queries"] for group in by_caller.values()),
+            "seconds": sum(group["seconds"] for group in by_caller.values()),
+            "by_action": dict(by_action),
+            "by_caller": dict(by_caller),
+            "statements": statements,
+            "slowest": [{"seconds": seconds, "action": action, "caller": caller, "sql": sql, "rows": rows}
+                        for seconds, _, action, caller, sql, rows in sorted(self._slowest, reverse=True)],
+        }
+
+    def report(self, file=sys.stdout, top=10):
+        """
+        Print a readable summary of the session.
+        """
+        summary = self.summary()
+        print(f"\n{summary['queries']} queries in {summary['seconds'] * 1000:.2f} ms", file=file)
+        for title, groups in (("By menu action", summary["by_action"]), ("By function", summary["by_caller"])):
+            print(f"\n{title}:", file=file)
+            for name, group in sorted(groups.items(), key=lambda item: item[1]["seconds"], reverse=True)[:top]:
+                print(f"  {group['seconds'] * 1000:9.2f} ms  {group['queries']:6} queries  {name}", file=file)
+        print("\nSlowest statements:", file=file)
+        for statement in summary["slowest"][:top]:
+            print(f"  {statement['seconds'] * 1000:9.2f} ms  {statement['caller']}: {statement['sql'][:80]}",
+                  file=file)
+
+    def dump(self, path):
+        """
+        Write the summary to a JSON file.
+        """
+        with open(path, "w") as file:
+            json.dump(self.summary(), file, indent=2)
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor that reports every statement it runs to the connection's profiler. The time spent fetching rows is
+    added to the statement that produced them.
+    """
+
+    def execute(self, sql, parameters=()):
+        self._record = self.connection.profiler.start(sql, _caller())
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._record = self.connection.profiler.start(sql, _caller())
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        self._record = self.connection.profiler.start(sql_script, _caller())
+        return self._timed(super().executescript, sql_script)
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._record[4] += time.perf_counter() - start
+            if self.rowcount > 0:
+                self._record[3] += self.rowcount
+            self.connection.profiler.finish(self._record)
+
+    def _fetched(self, method, *args):
+        start = time.perf_counter()
+        rows = method(*args)
+        record = getattr(self, "_record", None)
+        if record is not None:
+            fetched = len(rows) if isinstance(rows, list) else int(rows is not None)
+            self.connection.profiler.fetched(record, fetched, time.perf_counter() - start)
+        return rows
+
+    def fetchone(self):
+        return self._fetched(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._fetched(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._fetched(super().fetchall)
+
+
+def enable_profiling(db, profiler=None):
+    """
+    Start profiling every statement run on a connection returned by get_db.
+    :param db: the database connection object
+    :param profiler: a QueryProfiler to report to, a new one if not given
+    :return: the QueryProfiler
+    """
+    db.profiler = profiler or QueryProfiler()
+    return db.profiler
+
+
+def set_action(db, action):
+    """
+    Label the statements that follow with a menu action, does nothing if the connection is not being profiled.
+    :param db: the database connection object
+    :param action: name of the action, or None
+    :return: None
+    """
+    profiler = getattr(db, "profiler", None)
+    if profiler is not None:
+        profiler.action = action
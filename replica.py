@@ -0,0 +1,110 @@
+import os
+import sqlite3
+import time
+
+from db import get_db, configure, Connection
+
+# Settings for snapshot connections. The snapshot file never changes once written, so it is read through mmap
+# without any locking, and query_only turns accidental writes into errors.
+SNAPSHOT_PRAGMAS = {
+    "query_only": 1,
+    "cache_size": -16000,
+    "mmap_size": 268435456,
+}
+
+
+class SnapshotReplica:
+    """
+    Read-only copy of a database for long analytics queries, so they never hold up writes to the primary.
+    The copy is taken with SQLite's backup API in a single step, which reads one consistent snapshot of the primary
+    while writers carry on, and is written to a new file that replaces the old one. Connections to it are opened
+    immutable, so readers take no locks at all.
+    connection() retakes the snapshot once it is older than max_staleness seconds. The age is read from the
+    snapshot file itself, so processes sharing a snapshot file share its freshness too.
+
+    Parameters
+    ----------
+    name : str
+        The primary database file
+    path : str
+        The snapshot file, defaults to the primary's name with ".snapshot" before the extension
+    max_staleness : float
+        Seconds a snapshot may lag behind the primary before it is retaken, 0 to retake it on every call
+    """
+
+    def __init__(self, name="main.db", path=None, max_staleness=60.0):
+        root, extension = os.path.splitext(name)
+        self.name = name
+        self.path = path or f"{root}.snapshot{extension or '.db'}"
+        self.max_staleness = max_staleness
+        self.refreshes = 0
+        self._db = None
+        self._opened = None
+
+    def staleness(self):
+        """
+        Return how many seconds old the snapshot is, or None if it has not been taken yet.
+        :return: float or None
+        """
+        try:
+            return max(time.time() - os.path.getmtime(self.path), 0.0)
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """
+        Take a new snapshot of the primary now.
+        :return: the connection to the new snapshot
+        """
+        partial = f"{self.path}.partial"
+        source = get_db(self.name)
+        try:
+            target = sqlite3.connect(partial)
+            try:
+                source.backup(target)
+                # The copy is opened immutable, which needs it to be self-contained rather than in WAL mode
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+        finally:
+            source.close()
+        os.replace(partial, self.path)
+        self.refreshes += 1
+        return self._open()
+
+    def connection(self):
+        """
+        Return a connection to a snapshot no older than max_staleness, taking a new snapshot if needed.
+        A connection returned earlier is closed once a newer snapshot is opened, so call this before each batch of
+        queries rather than keeping the connection.
+        :return: a read-only db.Connection that the analyse.py functions accept
+        """
+        staleness = self.staleness()
+        if staleness is None or staleness > self.max_staleness:
+            return self.refresh()
+        if self._db is None or self._opened != os.path.getmtime(self.path):
+            # Another process replaced the snapshot file
+            return self._open()
+        return self._db
+
+    def _open(self):
+        self.close()
+        self._opened = os.path.getmtime(self.path)
+        self._db = sqlite3.connect(f"file:{self.path}?immutable=1", uri=True, factory=Connection)
+        configure(self._db, SNAPSHOT_PRAGMAS)
+        return self._db
+
+    def close(self):
+        """
+        Close the connection to the latest snapshot, the snapshot file is kept for later use.
+        :return: None
+        """
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
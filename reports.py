@@ -0,0 +1,202 @@
+from collections import defaultdict
+from datetime import date
+from typing import NamedTuple
+
+from db import period_days, periodicity_name, segment_rows
+
+# Rolling windows reported by default, in days ending today
+WINDOWS = (7, 30, 365)
+# Rows fetched per round trip while streaming the tracker
+CHUNK_SIZE = 10000
+HEATMAP_DAYS = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+
+
+class Heatmap(NamedTuple):
+    """
+    Completions of one habit on a calendar grid of whole ISO weeks.
+
+    start: day number of the Monday the grid starts on
+    today: day number of the last day shown
+    first_day: day number of the habit's first tracker row, earlier cells are outside its history
+    cells: one byte per day from start, 1 for a completion
+    """
+    start: int
+    today: int
+    first_day: int
+    cells: bytes
+
+
+class HabitRates(NamedTuple):
+    """
+    Completion figures of one habit.
+
+    completions: number of completions per window
+    expected: number of periods per window the habit existed for, at least 1
+    rates: completions divided by expected per window, capped at 1
+    """
+    name: str
+    periodicity: str
+    completions: dict
+    expected: dict
+    rates: dict
+    heatmap: Heatmap
+
+
+class CompletionReport(NamedTuple):
+    """
+    Completion rates of every habit plus the overall rate per window, across all habits.
+    """
+    today: int
+    windows: tuple
+    habits: list
+    overall: dict
+
+
+class RateAccumulator:
+    """
+    Single-pass accumulator for one habit: counts completions in each rolling window and marks heatmap cells as
+    rows arrive in date order. Its size depends only on the windows, never on the length of the history.
+    """
+
+    def __init__(self, name, periodicity, first_day, today, windows):
+        self.name = name
+        self.periodicity = periodicity
+        self.first_day = first_day
+        self.today = today
+        self.windows = windows
+        self.counts = [0] * len(windows)
+        # Whole weeks, starting on the Monday of the week of the longest window's first day
+        oldest = today - max(windows) + 1
+        self.start = oldest - (oldest - 1) % 7
+        self.cells = bytearray(today - self.start + 1)
+
+    def add(self, day):
+        """
+        Record a completion on a day number.
+        """
+        for index, window in enumerate(self.windows):
+            if self.today - window < day <= self.today:
+                self.counts[index] += 1
+        if self.start <= day <= self.today:
+            self.cells[day - self.start] = 1
+
+    def result(self):
+        """
+        Return the HabitRates of the rows seen so far.
+        """
+        days_per_period = period_days(self.periodicity)
+        completions, expected, rates = {}, {}, {}
+        for window, count in zip(self.windows, self.counts):
+            active = max(min(window, self.today - self.first_day + 1), 1)
+            periods = max(active / days_per_period, 1) if days_per_period else 1
+            completions[window], expected[window] = count, periods
+            rates[window] = min(count / periods, 1.0)
+        return HabitRates(self.name, periodicity_name(self.periodicity), completions, expected, rates,
+                          Heatmap(self.start, self.today, self.first_day, bytes(self.cells)))
+
+
+def iter_habit_rates(db, today=None, windows=WINDOWS, chunk_size=CHUNK_SIZE):
+    """
+    Stream tracker rows ordered by habit and date through one RateAccumulator at a time, yielding each habit's
+    rates as soon as its last row has been read.
+    Completions are rows with a streak above 0, as counted in habit_stats.totalCompletions.
+
+    :param db: the database connection object
+    :param today: day number the windows end on, defaults to today
+    :param windows: window lengths in days
+    :param chunk_size: number of rows fetched per round trip
+    :return: a generator of HabitRates, in habit name order
+    """
+    today = date.today().toordinal() if today is None else today
+    cur = db.cursor()
+    cur.execute("""SELECT name, periodicity, (SELECT MIN(day) FROM (
+            SELECT MIN(date) AS day FROM tracker WHERE habitName = name
+            UNION ALL SELECT MIN(startDate) FROM tracker_segments WHERE habitName = name))
+        FROM habits ORDER BY name""")
+    habits = cur.fetchall()
+    oldest = today - max(windows)
+    # Compacted history overlapping the windows, see compaction.py. Segments are few, so they are read in one go.
+    segments = defaultdict(list)
+    cur.execute("""SELECT habitName, startDate, endDate, startStreak, length FROM tracker_segments
+        WHERE endDate > ? AND startDate <= ?""", (oldest, today))
+    for name, *segment in cur.fetchall():
+        segments[name].extend(day for day, streak in segment_rows(*segment) if streak > 0 and oldest < day <= today)
+    rows = db.cursor()
+    # Only the rows inside the longest window matter, the index on (habitName, date) keeps them in order
+    rows.execute("SELECT habitName, date FROM tracker WHERE date > ? AND date <= ? AND streakCounter > 0 "
+                 "ORDER BY habitName, date", (oldest, today))
+    stream = _fetch_rows(rows, chunk_size)
+    row = next(stream, None)
+    for name, periodicity, first_day in habits:
+        accumulator = RateAccumulator(name, periodicity, today if first_day is None else first_day, today, windows)
+        for day in segments.get(name, ()):
+            accumulator.add(day)
+        # Both queries are ordered by habit name, so the rows are merged in step with the habits
+        while row is not None and row[0] < name:
+            row = next(stream, None)
+        while row is not None and row[0] == name:
+            accumulator.add(row[1])
+            row = next(stream, None)
+        yield accumulator.result()
+
+
+def _fetch_rows(cur, chunk_size):
+    while True:
+        chunk = cur.fetchmany(chunk_size)
+        if not chunk:
+            return
+        yield from chunk
+
+
+def completion_report(db, today=None, windows=WINDOWS, chunk_size=CHUNK_SIZE):
+    """
+    Build the rolling completion-rate report for every habit. The overall rate of a window is the sum of completions
+    across habits divided by the sum of expected completions.
+
+    :param db: the database connection object
+    :param today: day number the windows end on, defaults to today
+    :param windows: window lengths in days
+    :param chunk_size: number of rows fetched per round trip
+    :return: a CompletionReport
+    """
+    today = date.today().toordinal() if today is None else today
+    habits = []
+    done = dict.fromkeys(windows, 0)
+    expected = dict.fromkeys(windows, 0)
+    for rates in iter_habit_rates(db, today, windows, chunk_size):
+        habits.append(rates)
+        for window in windows:
+            done[window] += min(rates.completions[window], rates.expected[window])
+            expected[window] += rates.expected[window]
+    overall = {window: done[window] / expected[window] if expected[window] else 0.0 for window in windows}
+    return CompletionReport(today, tuple(windows), habits, overall)
+
+
+def render_heatmap(heatmap):
+    """
+    Draw a heatmap as text, one line per weekday and one column per week: "#" for a completion, "." for a day
+    without one, and a blank outside the habit's history.
+    """
+    lines = []
+    for weekday, label in enumerate(HEATMAP_DAYS):
+        cells = []
+        for day in range(heatmap.start + weekday, heatmap.today + 1, 7):
+            if day < heatmap.first_day:
+                cells.append(" ")
+            else:
+                cells.append("#" if heatmap.cells[day - heatmap.start] else ".")
+        lines.append(f"{label} {''.join(cells)}")
+    return "\n".join(lines)
+
+
+def format_report(report):
+    """
+    Format a CompletionReport as a table of rates per habit and window.
+    """
+    header = "".join(f"{f'{window}d':>7}" for window in report.windows)
+    lines = [f"{'Habit':<30}{header}"]
+    for habit in report.habits:
+        rates = "".join(f"{habit.rates[window]:>7.0%}" for window in report.windows)
+        lines.append(f"{habit.name[:29]:<30}{rates}")
+    lines.append(f"{'All habits':<30}" + "".join(f"{report.overall[window]:>7.0%}" for window in report.windows))
+    return "\n".join(lines)
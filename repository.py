@@ -0,0 +1,172 @@
+import json
+import sys
+from datetime import date
+
+import numpy as np
+
+from analyse import COMPLETED_STATUS
+from db import log_changes, periodicity_name, transaction, INSERT_HISTORY_ROW
+from habit import Habit
+from streaks import due_window
+
+# Stored for a missing lastDate, nextDue or deadline. Every day is later than it, so such habits count as broken,
+# the same as in habit_status.
+NO_DAY = -1
+
+
+class HabitRepository:
+    """
+    Every habit with its latest tracker state, held in parallel arrays for analytics over large habit sets.
+    It is loaded with a single query. Completions are applied to the arrays, and sync writes them back in one batch.
+    The arrays are not refreshed from the database, so load a new repository to see writes made elsewhere.
+
+    Attributes
+    ----------
+    names : list
+        Interned habit names, in the row order of every array
+    descriptions : list
+        Habit descriptions
+    periodicity : np.ndarray
+        Periodicity codes, 0 for an unknown periodicity
+    last_day : np.ndarray
+        Day number (date.toordinal()) of the latest tracker row
+    streak : np.ndarray
+        Current streak
+    best : np.ndarray
+        Longest streak ever
+    next_due : np.ndarray
+        First day the habit can be completed again
+    deadline : np.ndarray
+        Last day a completion still continues the streak
+    """
+
+    def __init__(self, names, descriptions, periodicity, last_day, streak, best, next_due, deadline):
+        self.names = names
+        self.descriptions = descriptions
+        self.periodicity = periodicity
+        self.last_day = last_day
+        self.streak = streak
+        self.best = best
+        self.next_due = next_due
+        self.deadline = deadline
+        self._index = {name: row for row, name in enumerate(names)}
+        # Row index -> (day, streak, streak had it not been broken) of the tracker row still to be written
+        self._pending = {}
+
+    @classmethod
+    def load(cls, db):
+        """
+        Load every habit and its habit_stats summary.
+        :param db: the database connection object
+        :return: a HabitRepository
+        """
+        cur = db.cursor()
+        cur.execute("""SELECT name, description, periodicity, lastDate, currentStreak, bestStreak, nextDue, deadline
+            FROM habits LEFT JOIN habit_stats ON habitName = name ORDER BY name""")
+        rows = cur.fetchall()
+        columns = list(zip(*rows)) or [()] * 8
+
+        def array(column, missing):
+            return np.fromiter((missing if value is None else value for value in column), dtype=np.int64,
+                               count=len(rows))
+
+        return cls([sys.intern(name) for name in columns[0]], list(columns[1]), array(columns[2], 0),
+                   array(columns[3], NO_DAY), array(columns[4], 0), array(columns[5], 0), array(columns[6], NO_DAY),
+                   array(columns[7], NO_DAY))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __getitem__(self, name):
+        """
+        Return a Habit for one row, its name, description and periodicity are read from the arrays.
+        """
+        row = self._index[name]
+        return Habit(name, self.descriptions[row], periodicity_name(int(self.periodicity[row])))
+
+    def __iter__(self):
+        for name in self.names:
+            yield self[name]
+
+    def statuses(self, today=None):
+        """
+        Evaluate the status of every habit at once, with the codes habit_status returns.
+        :param today: day number to evaluate on, defaults to today
+        :return: an array of status codes in the order of names
+        """
+        today = date.today().toordinal() if today is None else today
+        completed = np.full(len(self.names), 5)
+        for code, status in COMPLETED_STATUS.items():
+            completed[self.periodicity == code] = status
+        return np.select([today > self.deadline, today >= self.next_due], [2, 1], completed)
+
+    def names_with_status(self, status, today=None):
+        """
+        Return the names of the habits with a given status, e.g. 1 for every habit that is ready to complete.
+        """
+        return [self.names[row] for row in np.flatnonzero(self.statuses(today) == status)]
+
+    def complete(self, names, today=None):
+        """
+        Mark habits complete in memory, following main.mark_complete: a ready habit extends its streak and a broken
+        habit restarts at 0. Habits already completed in their current period are left as they are.
+        Nothing is written until sync is called.
+
+        :param names: names of the habits to complete, each at most once
+        :param today: day number of the completion, defaults to today
+        :return: an array with the status of each habit before completing
+        """
+        today = date.today().toordinal() if today is None else today
+        rows = np.fromiter((self._index[name] for name in names), dtype=np.int64)
+        if len(np.unique(rows)) != len(rows):
+            raise ValueError("A habit can only be completed once per call")
+        status = self.statuses(today)[rows]
+        changed = (status == 1) | (status == 2)
+        rows = rows[changed]
+        extended = self.streak[rows] + 1
+        self.streak[rows] = np.where(status[changed] == 1, extended, 0)
+        self.best[rows] = np.maximum(self.best[rows], self.streak[rows])
+        self.last_day[rows] = today
+        next_due, deadline = due_window(self.last_day[rows], self.periodicity[rows])
+        known = self.periodicity[rows] != 0
+        self.next_due[rows] = np.where(known, next_due, NO_DAY)
+        self.deadline[rows] = np.where(known, deadline, NO_DAY)
+        for row, streak, extended_streak in zip(rows.tolist(), self.streak[rows].tolist(), extended.tolist()):
+            self._pending[row] = (today, streak, extended_streak)
+        return status
+
+    def sync(self, db):
+        """
+        Write every completion made since the last sync with one executemany. The changes logged are those of
+        main.mark_complete: a "complete" change with the extended streak, followed by a "break" change if the habit
+        was broken and restarts at 0.
+        A completion is skipped if the habit already has a tracker row for its day, e.g. one written elsewhere.
+        :param db: a connection from get_db
+        :return: the number of tracker rows written
+        """
+        rows = [(day, self.names[row], streak) for row, (day, streak, _) in self._pending.items()]
+        extended = {self.names[row]: streak for row, (_, _, streak) in self._pending.items()}
+        # The write lock is taken first, so no row can be written elsewhere between the check and the insert
+        with transaction(db, immediate=True):
+            cur = db.cursor()
+            # The completions that already have a row, raw or compacted, are found with one query instead of one each
+            cur.execute("""SELECT day, name FROM (SELECT json_extract(value, '$[0]') AS day,
+                    json_extract(value, '$[1]') AS name FROM json_each(?))
+                WHERE EXISTS (SELECT 1 FROM tracker WHERE habitName = name AND date = day)
+                    OR EXISTS (SELECT 1 FROM tracker_segments
+                               WHERE habitName = name AND startDate <= day AND endDate >= day)""",
+                        (json.dumps(rows),))
+            stored = set(cur.fetchall())
+            rows = [row for row in rows if row[:2] not in stored]
+            cur.executemany(INSERT_HISTORY_ROW, rows)
+            changes = []
+            for day, name, streak in rows:
+                changes.append(("complete", name, day, {"streak": extended[name]}))
+                if streak != extended[name]:
+                    changes.append(("break", name, day, {}))
+            log_changes(db, cur, changes)
+        self._pending.clear()
+        return len(rows)
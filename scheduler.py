@@ -0,0 +1,238 @@
+import heapq
+import threading
+from datetime import date, datetime, time, timedelta
+
+# Stored for a missing nextDue or deadline, so such habits are due and broken, the same as in habit_status
+NO_DAY = -1
+
+
+def day_start(day):
+    """
+    Return the datetime a day number begins at, midnight local time.
+    """
+    return datetime.combine(date.fromordinal(day), time.min)
+
+
+def _entries_until(heap, bound):
+    """
+    Yield the entries of a heap with a key up to bound, in key order, without popping them from the heap.
+    Only those entries and their direct children are visited, so it takes O(k log k) for k entries.
+    """
+    if not heap:
+        return
+    frontier = [(heap[0], 0)]
+    while frontier:
+        entry, index = heapq.heappop(frontier)
+        if entry[0] > bound:
+            continue
+        yield entry
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+
+
+def _first_after(heap, bound, current):
+    """
+    Return the smallest live entry of a heap with a key above bound, or None. Entries up to bound are skipped the
+    same way _entries_until visits them, so it takes O(k log k) for k skipped entries.
+    """
+    if not heap:
+        return None
+    frontier = [(heap[0], 0)]
+    while frontier:
+        entry, index = heapq.heappop(frontier)
+        if entry[0] > bound and current(entry):
+            return entry
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child], child))
+    return None
+
+
+class DueScheduler:
+    """
+    In-memory schedule of every habit's next due day and deadline, as stored in habit_stats, for "what is due"
+    queries that do not scan every habit.
+    Two min-heaps hold (day, sequence, name) entries, one keyed by next due day and one by deadline. Changing a habit
+    pushes new entries with a new sequence number and leaves the old ones in place, they are skipped when read and
+    dropped when the heaps are rebuilt.
+    Queries visit only the entries they return, so they take O(k log k) for k matching habits instead of a status
+    query per habit. Call refresh after completing, adding or updating a habit and remove after removing one.
+    The scheduler can be shared between threads, e.g. with run_reminders.
+    """
+
+    def __init__(self):
+        # name -> (next due day, deadline, sequence number of its live heap entries)
+        self._habits = {}
+        self._sequence = 0
+        self._due = []
+        self._deadlines = []
+        # Notified on every change, so a reminder loop can recompute when to wake up
+        self.changed = threading.Condition()
+
+    @classmethod
+    def load(cls, db):
+        """
+        Build the schedule of every habit with a single query.
+        :param db: the database connection object
+        :return: a DueScheduler
+        """
+        scheduler = cls()
+        cur = db.cursor()
+        cur.execute("SELECT name, nextDue, deadline FROM habits LEFT JOIN habit_stats ON habitName = name")
+        for sequence, (name, next_due, deadline) in enumerate(cur.fetchall()):
+            scheduler._habits[name] = (NO_DAY if next_due is None else next_due,
+                                       NO_DAY if deadline is None else deadline, sequence)
+        scheduler._sequence = len(scheduler._habits)
+        scheduler._rebuild()
+        return scheduler
+
+    def __len__(self):
+        return len(self._habits)
+
+    def __contains__(self, name):
+        return name in self._habits
+
+    def set(self, name, next_due, deadline):
+        """
+        Schedule a habit with a new next due day and deadline, as day numbers, None counting as already passed.
+        :return: None
+        """
+        next_due = NO_DAY if next_due is None else next_due
+        deadline = NO_DAY if deadline is None else deadline
+        with self.changed:
+            self._sequence += 1
+            self._habits[name] = (next_due, deadline, self._sequence)
+            heapq.heappush(self._due, (next_due, self._sequence, name))
+            heapq.heappush(self._deadlines, (deadline, self._sequence, name))
+            if len(self._due) > 2 * len(self._habits) + 16:
+                self._rebuild()
+            self.changed.notify_all()
+
+    def refresh(self, db, name):
+        """
+        Re-read one habit's next due day and deadline after it was completed, added, updated or removed.
+        :param db: the database connection object
+        :param name: the name of the habit
+        :return: None
+        """
+        cur = db.cursor()
+        cur.execute("SELECT nextDue, deadline FROM habits LEFT JOIN habit_stats ON habitName = name WHERE name = ?",
+                    (name,))
+        row = cur.fetchone()
+        if row is None:
+            self.remove(name)
+        else:
+            self.set(name, *row)
+
+    def remove(self, name):
+        """
+        Stop scheduling a habit.
+        :return: None
+        """
+        with self.changed:
+            if self._habits.pop(name, None) is not None:
+                self.changed.notify_all()
+
+    def wake(self):
+        """
+        Wake up a run_reminders loop waiting on this scheduler, e.g. after setting its stop event.
+        :return: None
+        """
+        with self.changed:
+            self.changed.notify_all()
+
+    def _rebuild(self):
+        self._due = [(next_due, sequence, name) for name, (next_due, _, sequence) in self._habits.items()]
+        self._deadlines = [(deadline, sequence, name) for name, (_, deadline, sequence) in self._habits.items()]
+        heapq.heapify(self._due)
+        heapq.heapify(self._deadlines)
+
+    def _is_live(self, entry):
+        habit = self._habits.get(entry[2])
+        return habit is not None and habit[2] == entry[1]
+
+    def due_now(self, today=None):
+        """
+        Return the habits that can be completed today, which includes broken habits, earliest due first.
+        :param today: day number, defaults to today
+        :return: a list of names
+        """
+        today = date.today().toordinal() if today is None else today
+        with self.changed:
+            return [entry[2] for entry in _entries_until(self._due, today) if self._is_live(entry)]
+
+    def broken(self, today=None):
+        """
+        Return the habits whose deadline has passed, i.e. those habit_status reports as broken.
+        :param today: day number, defaults to today
+        :return: a list of names
+        """
+        today = date.today().toordinal() if today is None else today
+        with self.changed:
+            return [entry[2] for entry in _entries_until(self._deadlines, today - 1) if self._is_live(entry)]
+
+    def breaking_within(self, hours, now=None):
+        """
+        Return the habits whose streak breaks within the next hours unless they are completed, soonest first.
+        A streak breaks when its deadline day ends.
+        :param hours: length of the window in hours
+        :param now: a datetime, defaults to now
+        :return: a list of names
+        """
+        now = datetime.now() if now is None else now
+        today = now.date().toordinal()
+        # The deadline day ends at the start of the next day, which must fall inside the window
+        last_deadline = (now + timedelta(hours=hours)).date().toordinal() - 1
+        with self.changed:
+            return [entry[2] for entry in _entries_until(self._deadlines, last_deadline)
+                    if entry[0] >= today and self._is_live(entry)]
+
+    def next_reminder(self, now=None, warn_hours=0):
+        """
+        Return the next moment something changes: a habit becomes due, or warn_hours before a streak breaks.
+        :param now: a datetime, defaults to now
+        :param warn_hours: hours before a break to remind at
+        :return: (datetime, "due" or "breaking", name), or None if no habits are scheduled
+        """
+        now = datetime.now() if now is None else now
+        reminders = []
+        with self.changed:
+            due = _first_after(self._due, now.date().toordinal(), self._is_live)
+            if due is not None:
+                reminders.append((day_start(due[0]), "due", due[2]))
+            # Warned about from the moment warn_hours before the deadline day ends, the first such moment after now
+            warned = (now + timedelta(hours=warn_hours)).date().toordinal() - 1
+            deadline = _first_after(self._deadlines, warned, self._is_live)
+            if deadline is not None:
+                reminders.append((day_start(deadline[0] + 1) - timedelta(hours=warn_hours), "breaking", deadline[2]))
+        return min(reminders, default=None)
+
+
+def run_reminders(scheduler, notify, warn_hours=1, stop=None, clock=datetime.now):
+    """
+    Call notify whenever habits become due or are about to break, sleeping until the next such moment rather than
+    polling. Changes made to the scheduler from other threads wake the loop up to recompute that moment.
+
+    :param scheduler: a DueScheduler
+    :param notify: called with the habits due now and the habits breaking within warn_hours, right away and at
+                   every reminder
+    :param warn_hours: hours before a break to remind at
+    :param stop: a threading.Event that ends the loop when set, followed by scheduler.wake()
+    :param clock: returns the current datetime
+    :return: None
+    """
+    stop = stop or threading.Event()
+    reminded = False
+    while not stop.is_set():
+        now = clock()
+        if not reminded:
+            notify(scheduler.due_now(now.date().toordinal()), scheduler.breaking_within(warn_hours, now))
+        with scheduler.changed:
+            if stop.is_set():
+                break
+            reminder = scheduler.next_reminder(now, warn_hours)
+            # Without a reminder ahead, sleep until the schedule changes
+            timeout = None if reminder is None else max((reminder[0] - clock()).total_seconds(), 0) + 0.001
+            # wait returns True when woken by a change rather than by reaching the reminder
+            reminded = scheduler.changed.wait(timeout)
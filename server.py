@@ -0,0 +1,346 @@
+import argparse
+import json
+import queue
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs, unquote
+
+from analyse import (break_streak, habit_status, sweep_broken_streaks, get_streak_counter, get_single_alltime_streak,
+                     top_streaks)
+from db import (get_db, get_habit, get_habits, get_due_dates, add_habit, update_habit, remove_habit, transaction,
+                periodicity_code, get_changes, get_change_seq)
+from main import mark_complete, STATUS_MESSAGES
+from reports import completion_report
+
+HABIT_PATH = re.compile(r"/habits/([^/]+)(?:/(complete|break|streak))?")
+
+
+class ApiError(Exception):
+    """
+    Raised by an endpoint that cannot carry out a request, turned into a JSON error response with the given status.
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ConnectionPool:
+    """
+    A fixed set of connections to one database, borrowed by request threads for the length of a request.
+    Unlike ConnectionManager it does not open a connection per thread, which would leak one per client since the
+    server starts a thread for each.
+
+    Parameters
+    ----------
+    name : str
+        The name of the database file
+    size : int
+        Number of connections, requests beyond that wait for a free one
+    """
+
+    def __init__(self, name="main.db", size=8):
+        self._free = queue.Queue()
+        for _ in range(size):
+            self._free.put(get_db(name, check_same_thread=False))
+
+    @contextmanager
+    def connection(self):
+        db = self._free.get()
+        try:
+            yield db
+        finally:
+            if db.in_transaction:
+                db.rollback()
+            self._free.put(db)
+
+    def close(self):
+        while not self._free.empty():
+            self._free.get().close()
+
+
+class ResponseCache:
+    """
+    Cache of the JSON bodies of GET responses, keyed by path and query string.
+    Every write made through the server empties it and starts a new generation. A response is only stored if no
+    write happened since it was read, see put. Writes made by other processes are picked up once an entry is max_age
+    seconds old.
+
+    Parameters
+    ----------
+    max_age : float
+        Seconds an entry is served for
+    """
+
+    def __init__(self, max_age=1.0):
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.max_age:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, body, generation):
+        """
+        Store a response read during the given generation, unless a write has emptied the cache since.
+        """
+        with self._lock:
+            if generation == self.generation:
+                self._entries[key] = (time.monotonic(), body)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+
+class HabitServer(ThreadingHTTPServer):
+    """
+    HTTP server exposing the habit store as JSON endpoints, one thread per client connection.
+
+    GET    /habits                       every habit
+    POST   /habits                       add a habit: {"name", "description", "periodicity"}
+    GET    /habits/NAME                  one habit with its status, streaks and due dates
+    PUT    /habits/NAME                  update a habit: {"description", "periodicity"}
+    DELETE /habits/NAME                  remove a habit
+    POST   /habits/NAME/complete         mark a habit complete, as the menu does
+    POST   /habits/NAME/break            break a habit's streak
+    GET    /habits/NAME/streak           current and longest streak
+    GET    /streaks/top?k=&current=&periodicity=
+                                         habits ranked by streak, see analyse.top_streaks
+    GET    /rates                        completion rates over the last 7, 30 and 365 days
+    POST   /batch/complete               mark many habits complete in one transaction: {"names": [...]}
+    GET    /changes?since=&limit=        changes logged after sequence number since, and the latest sequence number
+
+    Parameters
+    ----------
+    address : tuple
+        (host, port) to listen on, port 0 picks a free port
+    name : str
+        The name of the database file
+    pool_size : int
+        Number of database connections shared by the request threads
+    cache_age : float
+        Seconds a cached GET response is served for, see ResponseCache
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address=("127.0.0.1", 8000), name="main.db", pool_size=8, cache_age=1.0):
+        super().__init__(address, HabitRequestHandler)
+        self.pool = ConnectionPool(name, pool_size)
+        self.cache = ResponseCache(cache_age)
+        with self.pool.connection() as db:
+            sweep_broken_streaks(db)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.close()
+
+
+class HabitRequestHandler(BaseHTTPRequestHandler):
+    """
+    Routes requests to the endpoints listed on HabitServer. HTTP/1.1 keeps client connections open between requests.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which Nagle's algorithm would hold back on a kept-alive connection
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def do_PUT(self):
+        self._handle("PUT")
+
+    def do_DELETE(self):
+        self._handle("DELETE")
+
+    def log_message(self, format, *args):
+        # One line per request on stderr would dominate under load
+        pass
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        cache = self.server.cache
+        key = self.path if method == "GET" else None
+        body = cache.get(key) if key is not None else None
+        status = 200
+        if body is None:
+            try:
+                payload = self._read_json() if method in ("POST", "PUT") else {}
+                with self.server.pool.connection() as db:
+                    # Streaks are read after breaking the overdue ones, as the menu does
+                    if key is not None and sweep_broken_streaks(db):
+                        cache.clear()
+                    # Taken before reading, a write made while this request reads moves it on, see ResponseCache.put
+                    generation = cache.generation
+                    status, result = route(db, method, unquote(url.path), parse_qs(url.query), payload)
+                body = json.dumps(result).encode()
+                if key is not None:
+                    cache.put(key, body, generation)
+                else:
+                    cache.clear()
+            except ApiError as error:
+                status, body = error.status, json.dumps({"error": str(error)}).encode()
+            except Exception as error:
+                status, body = 500, json.dumps({"error": f"{type(error).__name__}: {error}"}).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            payload = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise ApiError(400, "Request body is not valid JSON")
+        if not isinstance(payload, dict):
+            raise ApiError(400, "Request body must be a JSON object")
+        return payload
+
+
+def require_habit(db, name):
+    """
+    Return a habit's (name, description, periodicity) row, raising a 404 ApiError if it does not exist.
+    """
+    row = get_habit(db, name)
+    if row is None:
+        raise ApiError(404, f'Habit "{name}" does not exist')
+    return row
+
+
+def require_periodicity(periodicity):
+    """
+    Raise a 400 ApiError unless periodicity is a valid periodicity name.
+    """
+    if periodicity_code(periodicity) is None:
+        raise ApiError(400, f"Invalid periodicity {periodicity!r}")
+    return periodicity
+
+
+def habit_json(row):
+    return {"name": row[0], "description": row[1], "periodicity": row[2]}
+
+
+def completion_json(name, status):
+    return {"name": name, "status": status, "message": STATUS_MESSAGES[status], "completed": status in (1, 2)}
+
+
+def route(db, method, path, query, payload):
+    """
+    Carry out one request.
+
+    :param db: a connection from the server's pool
+    :param method: the HTTP method
+    :param path: the decoded URL path
+    :param query: the parsed query string, as returned by parse_qs
+    :param payload: the decoded JSON body, {} for requests without one
+    :return: (HTTP status, JSON-serialisable result)
+    """
+    if path == "/habits" and method == "GET":
+        return 200, [habit_json(row) for row in get_habits(db)]
+    if path == "/habits" and method == "POST":
+        name = payload.get("name")
+        if not isinstance(name, str) or not name:
+            raise ApiError(400, "Habit name cannot be empty")
+        if get_habit(db, name) is not None:
+            raise ApiError(409, f'Habit "{name}" already exists')
+        add_habit(db, name, payload.get("description", ""), require_periodicity(payload.get("periodicity", "daily")))
+        return 201, habit_json(get_habit(db, name))
+    if path == "/streaks/top" and method == "GET":
+        periodicity = query.get("periodicity", [None])[0]
+        if periodicity is not None:
+            require_periodicity(periodicity)
+        try:
+            k = int(query.get("k", ["10"])[0])
+        except ValueError:
+            raise ApiError(400, "k must be a whole number")
+        current = query.get("current", ["false"])[0].lower() in ("1", "true", "yes")
+        return 200, [leader._asdict() for leader in top_streaks(db, k, current, periodicity)]
+    if path == "/rates" and method == "GET":
+        report = completion_report(db)
+        return 200, {"windows": report.windows, "overall": report.overall,
+                     "habits": [{"name": habit.name, "periodicity": habit.periodicity, "rates": habit.rates,
+                                 "completions": habit.completions} for habit in report.habits]}
+    if path == "/changes" and method == "GET":
+        try:
+            since = int(query.get("since", ["0"])[0])
+            limit = int(query.get("limit", ["1000"])[0])
+        except ValueError:
+            raise ApiError(400, "since and limit must be whole numbers")
+        changes = get_changes(db, since, limit)
+        return 200, {"seq": get_change_seq(db), "changes": [change._asdict() for change in changes]}
+    if path == "/batch/complete" and method == "POST":
+        names = payload.get("names")
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ApiError(400, 'Expected {"names": [...]}')
+        # Every habit is checked before anything is written, then all of them are completed with one commit
+        for name in names:
+            require_habit(db, name)
+        with transaction(db, immediate=True):
+            return 200, [completion_json(name, mark_complete(db, name)) for name in names]
+
+    match = HABIT_PATH.fullmatch(path)
+    if match is None:
+        raise ApiError(404, f"No endpoint at {path}")
+    name, action = match.groups()
+    row = require_habit(db, name)
+    if action is None and method == "GET":
+        due = get_due_dates(db, name)
+        return 200, dict(habit_json(row), status=habit_status(db, name), streak=get_streak_counter(db, name),
+                         longest=get_single_alltime_streak(db, name), next_due=due and due[0],
+                         deadline=due and due[1])
+    if action is None and method == "PUT":
+        update_habit(db, name, payload.get("description", row[1]),
+                     require_periodicity(payload.get("periodicity", row[2])))
+        return 200, habit_json(get_habit(db, name))
+    if action is None and method == "DELETE":
+        remove_habit(db, name)
+        return 200, habit_json(row)
+    if action == "complete" and method == "POST":
+        return 200, completion_json(name, mark_complete(db, name))
+    if action == "break" and method == "POST":
+        break_streak(db, name)
+        return 200, {"name": name, "streak": get_streak_counter(db, name)}
+    if action == "streak" and method == "GET":
+        return 200, {"name": name, "streak": get_streak_counter(db, name),
+                     "longest": get_single_alltime_streak(db, name)}
+    raise ApiError(405, f"{method} is not supported on {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the habit tracker as a JSON API.")
+    parser.add_argument("--db", default="main.db", help="the database file, defaults to main.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--pool", type=int, default=8, help="database connections, defaults to 8")
+    parser.add_argument("--cache-age", type=float, default=1.0, help="seconds GET responses are cached for")
+    args = parser.parse_args()
+    server = HabitServer((args.host, args.port), args.db, args.pool, args.cache_age)
+    print(f"Serving {args.db} on http://{server.server_address[0]}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
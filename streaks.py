@@ -0,0 +1,226 @@
+from datetime import date
+from typing import NamedTuple
+
+import numpy as np
+
+from analyse import get_single_alltime_streak
+from db import period_days, DAILY, WEEKLY, WEEKDAYS, MONTHLY
+
+# date.toordinal() of 1970-01-01, the epoch of numpy datetime64
+EPOCH_ORDINAL = 719163
+
+
+class CompletionLog(NamedTuple):
+    """
+    Tracker rows of one or more habits as parallel arrays, ordered by habit and date.
+
+    names: habit names, indexed by the values in `habit`
+    periodicity: periodicity code per habit, same order as `names`
+    periods: average days per period per habit, same order as `names`
+    habit: index into `names` per row
+    day: date.toordinal() of each row
+    streak: streakCounter of each row
+    """
+    names: list
+    periodicity: np.ndarray
+    periods: np.ndarray
+    habit: np.ndarray
+    day: np.ndarray
+    streak: np.ndarray
+
+
+class StreakRuns(NamedTuple):
+    """
+    Every streak that ever ran, one entry per run with at least one completion.
+
+    habit: index into CompletionLog.names
+    start: ordinal of the first completion of the run
+    end: ordinal of the last completion of the run
+    length: number of completions in the run
+    """
+    habit: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    length: np.ndarray
+
+
+class StreakSummary(NamedTuple):
+    """
+    Per-habit streak figures, same order as CompletionLog.names.
+
+    best: longest streak ever
+    current: length of the streak still running today, 0 if it has been broken
+    completions: number of completions recorded
+    completion_rate: completions divided by the number of periods since the habit was added
+    mean_streak: average length of the habit's streaks, 0 if it never had one
+    """
+    names: list
+    best: np.ndarray
+    current: np.ndarray
+    completions: np.ndarray
+    completion_rate: np.ndarray
+    mean_streak: np.ndarray
+
+
+def load_completions(db, habit=None):
+    """
+    Load the tracker history of one habit, or of every habit, into arrays with a single query.
+
+    :param db: the database connection object
+    :param habit: name of the habit to load, all habits if None
+    :return: a CompletionLog
+    """
+    where, parameters = ("", ()) if habit is None else (" WHERE name = ?", (habit,))
+    cur = db.cursor()
+    cur.execute(f"SELECT rowid, name, periodicity FROM habits{where} ORDER BY rowid", parameters)
+    habits = cur.fetchall()
+    rowids = np.fromiter((row[0] for row in habits), dtype=np.int64, count=len(habits))
+    names = [row[1] for row in habits]
+    periodicity = np.fromiter((DAILY if row[2] is None else row[2] for row in habits), dtype=np.int64,
+                              count=len(habits))
+    periods = np.array([period_days(code) for code in periodicity.tolist()], dtype=float)
+
+    # tracker.date is already a day number, so rows go straight into the arrays
+    query = """SELECT habits.rowid, tracker.date, tracker.streakCounter
+        FROM tracker JOIN habits ON habits.name = tracker.habitName"""
+    if habit is not None:
+        query += " WHERE tracker.habitName = ?"
+    cur.execute(query + " ORDER BY tracker.habitName, tracker.date", parameters)
+    rows = np.fromiter(cur, dtype=[("habit", np.int64), ("day", np.int64), ("streak", np.int64)])
+    habit_rows, day, streak = np.searchsorted(rowids, rows["habit"]), rows["day"], rows["streak"]
+
+    # Compacted history, see compaction.py: each segment expands to `length` evenly spaced rows
+    query = """SELECT habits.rowid, startDate, endDate, startStreak, length
+        FROM tracker_segments JOIN habits ON habits.name = tracker_segments.habitName"""
+    if habit is not None:
+        query += " WHERE tracker_segments.habitName = ?"
+    cur.execute(query, parameters)
+    segments = np.fromiter(cur, dtype=[("habit", np.int64), ("start", np.int64), ("end", np.int64),
+                                       ("streak", np.int64), ("length", np.int64)])
+    if len(segments):
+        length = segments["length"]
+        step = (segments["end"] - segments["start"]) // np.maximum(length - 1, 1)
+        offset = np.arange(length.sum()) - np.repeat(np.cumsum(length) - length, length)
+        habit_rows = np.concatenate([habit_rows, np.repeat(np.searchsorted(rowids, segments["habit"]), length)])
+        day = np.concatenate([day, np.repeat(segments["start"], length) + offset * np.repeat(step, length)])
+        streak = np.concatenate([streak, np.repeat(segments["streak"], length) + offset])
+        # Back into habit name and date order
+        name_rank = np.argsort(np.argsort(np.array(names, dtype=object)))
+        order = np.lexsort((day, name_rank[habit_rows]))
+        habit_rows, day, streak = habit_rows[order], day[order], streak[order]
+    return CompletionLog(names, periodicity, periods, habit_rows, day, streak)
+
+
+def due_window(day, periodicity):
+    """
+    The array form of the nextDue and deadline columns of habit_stats: for each day, the first and last day of the
+    following period of its periodicity.
+
+    :param day: array of day numbers
+    :param periodicity: array of periodicity codes, same length as day
+    :return: (next_due, deadline) arrays
+    """
+    weekday = (day - 1) % 7
+    monday = day - weekday
+    next_weekday = day + np.select([weekday == 4, weekday == 5], [3, 2], 1)
+    month = (day - EPOCH_ORDINAL).astype("datetime64[D]").astype("datetime64[M]")
+    month_days = [(month + offset).astype("datetime64[D]").astype(np.int64) + EPOCH_ORDINAL for offset in (1, 2)]
+    conditions = [periodicity == DAILY, periodicity == WEEKLY, periodicity == WEEKDAYS, periodicity == MONTHLY]
+    # Negative codes are "every N days"
+    next_due = np.select(conditions, [day + 1, monday + 7, next_weekday, month_days[0]], day - periodicity)
+    deadline = np.select(conditions, [day + 1, monday + 13, next_weekday, month_days[1] - 1],
+                         day - 2 * periodicity - 1)
+    return next_due, deadline
+
+
+def find_runs(log):
+    """
+    Split the history into streak runs from the dates alone.
+    A row continues the previous row's run when it belongs to the same habit, falls in the period after the previous
+    row's (see due_window) and is a completion. Rows recorded with a streak of 0 (a new habit, or a broken streak)
+    start a new run that holds no completions yet.
+
+    :param log: a CompletionLog
+    :return: a StreakRuns, plus the index of the last run of each habit (-1 for habits without rows)
+    """
+    count = len(log.day)
+    if count == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return StreakRuns(empty, empty, empty, empty), np.full(len(log.names), -1)
+    next_due, deadline = due_window(log.day[:-1], log.periodicity[log.habit[:-1]])
+    starts = np.ones(count, dtype=bool)
+    starts[1:] = ((log.habit[1:] != log.habit[:-1])
+                  | (log.day[1:] < next_due) | (log.day[1:] > deadline)
+                  | (log.streak[1:] == 0))
+    first_rows = np.flatnonzero(starts)
+    last_rows = np.append(first_rows[1:], count) - 1
+    length = last_rows - first_rows + 1 - (log.streak[first_rows] == 0)
+    habit = log.habit[first_rows]
+    last_run = np.full(len(log.names), -1)
+    last_run[habit] = np.arange(len(first_rows))
+    # The run that opens with an anchor row starts at its first completion
+    start = log.day[np.minimum(first_rows + (log.streak[first_rows] == 0), last_rows)]
+    return StreakRuns(habit, start, log.day[last_rows], length), last_run
+
+
+def summarise(log, today=None):
+    """
+    Compute best and current streaks, completion counts and rates and mean streak length for every habit in the
+    log, with array operations over all rows at once.
+
+    :param log: a CompletionLog
+    :param today: ordinal of the day to measure current streaks and rates against, defaults to today
+    :return: a StreakSummary, and the StreakRuns with at least one completion
+    """
+    today = date.today().toordinal() if today is None else today
+    habits = len(log.names)
+    runs, last_run = find_runs(log)
+
+    best = np.zeros(habits, dtype=np.int64)
+    np.maximum.at(best, runs.habit, runs.length)
+
+    current = np.zeros(habits, dtype=np.int64)
+    has_rows = last_run >= 0
+    last = last_run[has_rows]
+    alive = today <= due_window(runs.end[last], log.periodicity[has_rows])[1]
+    current[has_rows] = np.where(alive, runs.length[last], 0)
+
+    completions = np.bincount(log.habit, weights=log.streak > 0, minlength=habits).astype(np.int64)
+    first_day = np.full(habits, today, dtype=np.int64)
+    np.minimum.at(first_day, log.habit, log.day)
+    periods_elapsed = np.maximum((today - first_day) // log.periods, 1)
+    completion_rate = completions / periods_elapsed
+
+    completed = runs.length > 0
+    runs = StreakRuns(*(column[completed] for column in runs))
+    run_counts = np.bincount(runs.habit, minlength=habits)
+    run_totals = np.bincount(runs.habit, weights=runs.length, minlength=habits)
+    mean_streak = np.divide(run_totals, run_counts, out=np.zeros(habits), where=run_counts > 0)
+    return StreakSummary(log.names, best, current, completions, completion_rate, mean_streak), runs
+
+
+def streak_length_distribution(runs):
+    """
+    Count how many streaks reached each length.
+
+    :param runs: a StreakRuns
+    :return: an array where entry n is the number of streaks of length n
+    """
+    return np.bincount(runs.length)
+
+
+def cross_check(db, summary):
+    """
+    Compare the best streaks computed from the dates with the stored counters reported by
+    get_single_alltime_streak.
+
+    :param db: the database connection object
+    :param summary: a StreakSummary
+    :return: a list of (habit name, computed best, stored best) for every habit that disagrees
+    """
+    mismatches = []
+    for name, best in zip(summary.names, summary.best.tolist()):
+        stored = get_single_alltime_streak(db, name) or 0
+        if stored != best:
+            mismatches.append((name, best, stored))
+    return mismatches
@@ -0,0 +1,164 @@
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+
+from analyse import sweep_broken_streaks
+from compaction import compact_tracker
+from db import get_db, configure, rebuild_habit_stats, PRAGMAS
+
+
+class ShardRegistry:
+    """
+    Maps each tenant (one user of the tracker) to their own shard database.
+    The registry itself is a small SQLite file listing every tenant and the path of its shard, shards are created
+    on first use.
+
+    Parameters
+    ----------
+    path : str
+        The registry database file
+    shard_dir : str
+        Directory new shards are created in, defaults to a "shards" directory next to the registry
+    """
+
+    def __init__(self, path="tenants.db", shard_dir=None):
+        self.path = path
+        self.shard_dir = shard_dir or os.path.join(os.path.dirname(os.path.abspath(path)), "shards")
+        self.db = sqlite3.connect(path)
+        configure(self.db, PRAGMAS)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS tenants (
+            tenant TEXT PRIMARY KEY,
+            shard TEXT NOT NULL,
+            created TEXT)""")
+        self.db.commit()
+
+    def shard_path(self, tenant):
+        """
+        Return the shard file of a tenant, registering the tenant if it is new.
+        Shard file names are derived from a hash of the tenant id, so any id is safe to use.
+        :param tenant: the tenant id
+        :return: str
+        """
+        cur = self.db.cursor()
+        cur.execute("SELECT shard FROM tenants WHERE tenant = ?", (tenant,))
+        row = cur.fetchone()
+        if row is not None:
+            return row[0]
+        shard = os.path.join(self.shard_dir, hashlib.sha256(tenant.encode()).hexdigest()[:32] + ".db")
+        cur.execute("INSERT or IGNORE INTO tenants VALUES (?, ?, ?)", (tenant, shard, date.today().isoformat()))
+        self.db.commit()
+        # Another process may have registered the tenant first
+        cur.execute("SELECT shard FROM tenants WHERE tenant = ?", (tenant,))
+        return cur.fetchone()[0]
+
+    def get_db(self, tenant):
+        """
+        Open a connection to a tenant's shard, creating the shard if needed.
+        :param tenant: the tenant id
+        :return: a connection from db.get_db
+        """
+        shard = self.shard_path(tenant)
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        return get_db(shard)
+
+    def shards(self):
+        """
+        Return every registered tenant with its shard path.
+        :return: a list of (tenant, shard) tuples
+        """
+        cur = self.db.cursor()
+        cur.execute("SELECT tenant, shard FROM tenants ORDER BY tenant")
+        return cur.fetchall()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _sweep_shard(db):
+    return sweep_broken_streaks(db)
+
+
+def _rebuild_stats_shard(db):
+    rebuild_habit_stats(db)
+    return db.execute("SELECT COUNT(*) FROM habit_stats").fetchone()[0]
+
+
+def _compact_shard(db):
+    return compact_tracker(db)["rows"]
+
+
+# Maintenance jobs that can run across shards, each returns a number summed into the report
+JOBS = {
+    "sweep": _sweep_shard,
+    "rebuild_stats": _rebuild_stats_shard,
+    "compact": _compact_shard,
+}
+
+
+def _run_job(job, tenant, shard):
+    """
+    Run a maintenance job on one shard, in a worker process.
+    :return: (tenant, result, seconds, error message or None)
+    """
+    start = time.perf_counter()
+    try:
+        db = get_db(shard)
+        try:
+            result = JOBS[job](db)
+        finally:
+            db.close()
+        return tenant, result, time.perf_counter() - start, None
+    except Exception as error:
+        return tenant, None, time.perf_counter() - start, f"{type(error).__name__}: {error}"
+
+
+def run_maintenance(registry, job, processes=None):
+    """
+    Run a maintenance job on every shard, fanned out over a pool of processes.
+    A failing shard does not stop the others, its error is listed in the report.
+
+    :param registry: a ShardRegistry
+    :param job: a key of JOBS
+    :param processes: number of worker processes, defaults to the number of CPUs
+    :return: a dict with the total across shards, per-tenant results, failures and timings
+    """
+    if job not in JOBS:
+        raise ValueError(f"Unknown maintenance job {job!r}, expected one of {', '.join(JOBS)}")
+    shards = [(tenant, shard) for tenant, shard in registry.shards() if os.path.exists(shard)]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        outcomes = list(pool.map(_run_job, [job] * len(shards), *zip(*shards))) if shards else []
+    results = {tenant: result for tenant, result, _, error in outcomes if error is None}
+    return {
+        "job": job,
+        "shards": len(shards),
+        "total": sum(results.values()),
+        "results": results,
+        "failed": {tenant: error for tenant, _, _, error in outcomes if error is not None},
+        "seconds": time.perf_counter() - start,
+        "shard_seconds": sum(seconds for _, _, seconds, _ in outcomes),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a maintenance job on every tenant shard.")
+    parser.add_argument("job", choices=list(JOBS))
+    parser.add_argument("--registry", default="tenants.db", help="the registry database, defaults to tenants.db")
+    parser.add_argument("--processes", type=int, help="worker processes, defaults to the number of CPUs")
+    args = parser.parse_args()
+    with ShardRegistry(args.registry) as shard_registry:
+        report = run_maintenance(shard_registry, args.job, args.processes)
+    print(f"{report['job']}: {report['total']} across {report['shards']} shards in {report['seconds']:.2f} s "
+          f"({report['shard_seconds']:.2f} s of shard work)")
+    for failed_tenant, message in report["failed"].items():
+        print(f"  {failed_tenant} failed: {message}")
@@ -1,9 +1,33 @@
 from habit import Habit
-from db import get_db, add_habit, update_habit, complete_habit, get_periodicity, calculate_most_recent_date
+from backup import export_data, import_data
+from async_store import AsyncHabitStore
+from profiling import enable_profiling, set_action
+from tenants import ShardRegistry, run_maintenance
+from main import main, mark_complete, build_parser, run_batch
+from benchmark import async_load, bench_http, generate_database, run_suite, stress_completions
+from reports import completion_report, render_heatmap
+from compaction import compact_tracker
+from replica import SnapshotReplica
+from server import HabitServer
+from scheduler import DueScheduler, run_reminders, day_start
+from name_index import NameIndex, edit_distance
+from db import (get_db, ConnectionManager, get_habit, get_habits, get_tracker_data, get_schema_version, MIGRATIONS,
+                add_habit, update_habit, remove_habit, complete_habit, get_periodicity, calculate_most_recent_date,
+                rebuild_habit_stats, get_due_dates, transaction, GroupCommitter, subscribe, unsubscribe, get_changes,
+                get_change_seq, prune_changes, DAILY)
 from analyse import (get_streak_counter, habit_status, break_streak, get_habit_names, return_max_habit_streaks,
                      get_name_of_longest_streak, get_single_alltime_streak, get_alltime_streak, get_alltime_habit,
-                     get_habits_by_periodicity)
+                     get_habits_by_periodicity, sweep_broken_streaks, top_streaks, StreakRank)
 from datetime import date, timedelta
+import sqlite3
+import pytest
+
+
+def days_ago(days):
+    """
+    Day number of a date the given number of days back, the form tracker dates are stored in.
+    """
+    return (date.today() - timedelta(days=days)).toordinal()
 
 
 class TestHabit:
@@ -35,8 +59,7 @@ class TestHabit:
         habit.complete(self.db)
         assert get_streak_counter(self.db, "test_habit_3") == 0
         cur = self.db.cursor()
-        cur.execute("UPDATE tracker SET date = ? WHERE habitName = ?", (date.today() -
-                                                                        timedelta(days=1), "test_habit_3"))
+        cur.execute("UPDATE tracker SET date = ? WHERE habitName = ?", (days_ago(1), "test_habit_3"))
         habit.complete(self.db)
         assert get_streak_counter(self.db, "test_habit_3") == 1
         break_streak(self.db, "test_habit_3")
@@ -67,12 +90,993 @@ class TestHabit:
         status = habit_status(self.db, "test_habit_4")
         assert status == 3
         cur = self.db.cursor()
-        cur.execute("UPDATE tracker SET date = ? WHERE habitName = ?", (date.today() -
-                                                                        timedelta(days=1), "test_habit_4"))
+        cur.execute("UPDATE tracker SET date = ? WHERE habitName = ?", (days_ago(1), "test_habit_4"))
         status = habit_status(self.db, "test_habit_4")
         assert status == 1
 
+    def test_sweep_broken_streaks(self):
+        Habit("test_daily", "test_daily", "daily").store(self.db)
+        Habit("test_weekly", "test_weekly", "weekly").store(self.db)
+        cur = self.db.cursor()
+        cur.execute("UPDATE tracker SET date = ?, streakCounter = 3 WHERE habitName IN (?, ?)",
+                    (days_ago(3), "test_daily", "test_weekly"))
+        # "test" is still within its period, only the daily habit is overdue
+        assert sweep_broken_streaks(self.db) == 1
+        assert habit_status(self.db, "test_daily") == 3
+        assert get_streak_counter(self.db, "test_daily") == 0
+        assert get_streak_counter(self.db, "test_weekly") == 3
+        assert sweep_broken_streaks(self.db) == 0
+
+    def test_habit_stats(self):
+        habit = Habit("test_habit_5", "test_habit_5", "daily")
+        habit.store(self.db)
+        cur = self.db.cursor()
+        cur.execute("UPDATE tracker SET date = ?, streakCounter = 4 WHERE habitName = ?",
+                    (days_ago(1), "test_habit_5"))
+        habit.complete(self.db)
+        assert get_single_alltime_streak(self.db, "test_habit_5") == 5
+        assert return_max_habit_streaks(self.db) == 5
+        assert get_name_of_longest_streak(self.db) == "test_habit_5"
+        break_streak(self.db, "test_habit_5")
+        assert get_single_alltime_streak(self.db, "test_habit_5") == 4
+        cur.execute("SELECT * FROM habit_stats ORDER BY habitName")
+        incremental = cur.fetchall()
+        rebuild_habit_stats(self.db)
+        cur.execute("SELECT * FROM habit_stats ORDER BY habitName")
+        assert cur.fetchall() == incremental
+        habit.remove(self.db)
+        cur.execute("SELECT COUNT(*) FROM habit_stats WHERE habitName = ?", ("test_habit_5",))
+        assert cur.fetchone()[0] == 0
+
+    def test_top_streaks(self):
+        for name, periodicity, streak in (("tied_a", "daily", 7), ("tied_b", "weekly", 7), ("third", "weekly", 2)):
+            Habit(name, name, periodicity).store(self.db)
+            self.db.execute("UPDATE tracker SET streakCounter = ? WHERE habitName = ?", (streak, name))
+        assert top_streaks(self.db, 1) == [StreakRank(1, "tied_a", "daily", 7), StreakRank(1, "tied_b", "weekly", 7)]
+        assert [leader.name for leader in top_streaks(self.db, 3)] == ["tied_a", "tied_b", "third"]
+        assert top_streaks(self.db, 2, periodicity="weekly") == [StreakRank(1, "tied_b", "weekly", 7),
+                                                                   StreakRank(2, "third", "weekly", 2)]
+        break_streak(self.db, "tied_a")
+        assert top_streaks(self.db, 1, current=True) == [StreakRank(1, "tied_b", "weekly", 7)]
+        assert top_streaks(self.db, 1, periodicity="monthly") == []
+
+    def test_transaction(self):
+        with pytest.raises(RuntimeError):
+            with transaction(self.db):
+                add_habit(self.db, "rolled_back", "rolled_back", "daily")
+                complete_habit(self.db, "rolled_back")
+                raise RuntimeError("crash between the two writes")
+        assert get_habit(self.db, "rolled_back") is None
+        assert get_tracker_data(self.db, "rolled_back") == []
+
+    def test_group_commit(self):
+        reader = get_db("test.db")
+        reader.execute("PRAGMA busy_timeout = 0")
+        with GroupCommitter(self.db, max_batch=3, max_delay=60) as group:
+            # The open group holds the write lock before its first write
+            with pytest.raises(sqlite3.OperationalError):
+                reader.execute("BEGIN IMMEDIATE")
+            for i in range(4):
+                add_habit(self.db, f"grouped_{i}", "grouped", "daily")
+                group.tick()
+            # The first three share a commit, the fourth waits for the end of the block
+            assert len(get_habits(reader)) == 1 + 3
+        assert len(get_habits(reader)) == 1 + 4
+        assert group.commits == 2
+        reader.close()
+
+    def test_mark_complete_is_atomic(self, monkeypatch):
+        import main as main_module
+        self.db.execute("UPDATE tracker SET date = ?, streakCounter = 3", (days_ago(5),))
+        self.db.commit()
+
+        def crash(db, name):
+            raise RuntimeError("crash after completing")
+        monkeypatch.setattr(main_module, "break_streak", crash)
+        with pytest.raises(RuntimeError):
+            mark_complete(self.db, "test")
+        assert get_streak_counter(self.db, "test") == 3
+        monkeypatch.undo()
+        assert mark_complete(self.db, "test") == 2
+        assert get_streak_counter(self.db, "test") == 0
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestMigrations:
+
+    def setup_method(self):
+        # A database in the original, unindexed layout with a duplicated tracker row
+        db = sqlite3.connect("test_legacy.db")
+        db.execute("CREATE TABLE habits (name TEXT PRIMARY KEY, description TEXT, periodicity TEXT)")
+        db.execute("CREATE TABLE tracker (date TEXT, habitName TEXT, streakCounter INTEGER)")
+        db.execute("INSERT INTO habits VALUES ('legacy', 'legacy', 'daily')")
+        db.executemany("INSERT INTO tracker VALUES (?, 'legacy', ?)", [("2024-03-13", 0), ("2024-03-14", 1),
+                                                                        ("2024-03-14", 2)])
+        db.commit()
+        db.close()
+        self.db = get_db("test_legacy.db")
+
+    def test_upgrade_in_place(self):
+        assert get_schema_version(self.db) == len(MIGRATIONS)
+        assert get_streak_counter(self.db, "legacy") == 1
+        cur = self.db.cursor()
+        cur.execute("SELECT COUNT(*) FROM tracker WHERE habitName = 'legacy'")
+        assert cur.fetchone()[0] == 2
+        cur.execute("EXPLAIN QUERY PLAN SELECT MAX(date) FROM tracker WHERE habitName = 'legacy'")
+        assert "INDEX" in cur.fetchone()[3]
+
+    def test_compact_storage(self):
+        cur = self.db.cursor()
+        cur.execute("SELECT DISTINCT typeof(date) FROM tracker")
+        assert cur.fetchall() == [("integer",)]
+        cur.execute("SELECT periodicity FROM habits WHERE name = 'legacy'")
+        assert cur.fetchone()[0] == DAILY
+        assert get_tracker_data(self.db, "legacy") == [("2024-03-13", "legacy", 0), ("2024-03-14", "legacy", 1)]
+        assert get_habit(self.db, "legacy") == ("legacy", "legacy", "daily")
+        assert calculate_most_recent_date(self.db, "legacy") == ("2024-03-14",)
+        with pytest.raises(ValueError):
+            add_habit(self.db, "fortnightly", "unknown periodicity", "fortnightly")
+
+    def test_migrate_is_idempotent(self):
+        self.db.close()
+        self.db = get_db("test_legacy.db")
+        cur = self.db.cursor()
+        cur.execute("SELECT COUNT(*) FROM schema_version")
+        assert cur.fetchone()[0] == len(MIGRATIONS)
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test_legacy.db")
+
+
+class TestBackup:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        add_habit(self.db, "backup_daily", "daily, habit", "daily")
+        add_habit(self.db, "backup_weekly", "weekly", "weekly")
+        cur = self.db.cursor()
+        cur.executemany("INSERT INTO tracker VALUES (?, ?, ?)",
+                        [(days_ago(days), "backup_daily", 10 - days) for days in range(1, 10)])
+        self.db.commit()
+        self.restored = get_db("test_restored.db")
+
+    def roundtrip(self, path):
+        assert export_data(self.db, path, chunk_size=4) == 13
+        assert import_data(self.restored, path, chunk_size=4) == {"habits": 2, "tracker": 11}
+        for table in ("habits", "tracker", "habit_stats"):
+            query = f"SELECT * FROM {table} ORDER BY 1, 2"
+            assert self.restored.execute(query).fetchall() == self.db.execute(query).fetchall()
+        # One change per imported habit, not one per row
+        changes = [(change.kind, change.name, change.data) for change in get_changes(self.restored)]
+        assert changes == [("import", "backup_daily", {"added": True, "rows": 10}),
+                           ("import", "backup_weekly", {"added": True, "rows": 1})]
+
+    def test_csv_roundtrip(self):
+        self.roundtrip("test_backup.csv")
+
+    def test_jsonl_roundtrip(self):
+        self.roundtrip("test_backup.jsonl")
+        # Importing the same file again leaves existing rows alone
+        import_data(self.restored, "test_backup.jsonl")
+        assert get_single_alltime_streak(self.restored, "backup_daily") == 9
+        assert get_change_seq(self.restored) == 2
+
+    def test_import_habits_without_history(self):
+        with open("test_backup.csv", "w") as file:
+            file.write("habits,imported,no history,weekly\n")
+        assert import_data(self.restored, "test_backup.csv") == {"habits": 1, "tracker": 0}
+        assert top_streaks(self.restored, 1) == [StreakRank(1, "imported", "weekly", 0)]
+        with open("test_backup.csv", "w") as file:
+            file.write("habits,unknown,bad periodicity,fortnightly\n")
+        with pytest.raises(ValueError):
+            import_data(self.restored, "test_backup.csv")
+        assert get_habit(self.restored, "unknown") is None
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        self.restored.close()
+        for path in ("test.db", "test_restored.db", "test_backup.csv", "test_backup.jsonl"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestConnectionManager:
+
+    def setup_method(self):
+        self.manager = ConnectionManager("test.db")
+
+    def test_wal_enabled(self):
+        cur = self.manager.connection().cursor()
+        cur.execute("PRAGMA journal_mode")
+        assert cur.fetchone()[0] == "wal"
+
+    def test_readers_alongside_writer(self):
+        import threading
+        errors = []
+
+        def write():
+            try:
+                for i in range(200):
+                    add_habit(self.manager.connection(), f"concurrent {i}", "", "daily")
+            except sqlite3.Error as error:
+                errors.append(error)
+
+        def read():
+            try:
+                for _ in range(200):
+                    get_habit_names(self.manager.connection())
+            except sqlite3.Error as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=write)] + [threading.Thread(target=read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+        assert len(get_habit_names(self.manager.connection())) == 200
+
+    def teardown_method(self):
+        import os
+        self.manager.close()
+        os.remove("test.db")
+
+
+class TestAsyncStore:
+
+    def test_concurrent_load(self):
+        import asyncio
+
+        async def run():
+            async with AsyncHabitStore("test.db", readers=2) as store:
+                results = await async_load(store, habits=10, requests=300, concurrency=50)
+                assert set(results) == {"complete_habit", "habit_status"}
+                assert results["complete_habit"]["p99_ms"] >= results["complete_habit"]["p50_ms"]
+                # Every habit was added today, so completions today are ignored and streaks stay at 0
+                assert len(await store.get_habit_names()) == 10
+                assert await store.return_max_habit_streaks() == 0
+                assert await store.habit_status("habit 0") == 3
+
+        asyncio.run(run())
+
+    def teardown_method(self):
+        import os
+        os.remove("test.db")
+
+
+class TestBenchmarkSuite:
+
+    def test_generated_history_is_consistent(self):
+        rows = generate_database("test.db", habits=5, years=1, seed=1)
+        db = get_db("test.db")
+        cur = db.cursor()
+        cur.execute("SELECT COUNT(*) FROM tracker")
+        assert cur.fetchone()[0] == rows
+        stats = cur.execute("SELECT * FROM habit_stats ORDER BY habitName").fetchall()
+        rebuild_habit_stats(db)
+        assert cur.execute("SELECT * FROM habit_stats ORDER BY habitName").fetchall() == stats
+        db.close()
+
+    def test_suite_times_every_public_function(self):
+        report = run_suite(("small",))
+        assert report["untimed"] == []
+        assert report["tiers"]["small"]["functions"]["analyse.sweep_broken_streaks"]["calls"] == 1
+
+    def test_concurrent_completions(self):
+        results = stress_completions("test.db", workers=4, habits=10, rounds=3)
+        assert results["errors"] == []
+        assert results["completions"] == 10 and results["calls"] == 4 * 10 * 3
+
+    def teardown_method(self):
+        import os
+        if os.path.exists("test.db"):
+            os.remove("test.db")
+
+
+class TestStreakAnalytics:
+
+    def setup_method(self):
+        generate_database("test.db", habits=20, years=1, seed=3)
+        self.db = get_db("test.db")
+
+    def test_matches_stored_streaks(self):
+        import pytest
+        streaks = pytest.importorskip("streaks")
+        summary, runs = streaks.summarise(streaks.load_completions(self.db))
+        assert len(summary.names) == 20
+        assert streaks.cross_check(self.db, summary) == []
+        assert streaks.streak_length_distribution(runs).sum() == len(runs.length)
+        cur = self.db.cursor()
+        cur.execute("SELECT habitName, totalCompletions FROM habit_stats ORDER BY habitName")
+        assert cur.fetchall() == list(zip(summary.names, summary.completions.tolist()))
+
+    def test_single_habit(self):
+        import pytest
+        streaks = pytest.importorskip("streaks")
+        cur = self.db.cursor()
+        cur.execute("INSERT INTO habits VALUES ('vector_habit', 'vector_habit', ?)", (DAILY,))
+        cur.executemany("INSERT INTO tracker VALUES (?, ?, ?)",
+                        [(days_ago(days), "vector_habit", streak)
+                         for days, streak in ((9, 1), (8, 2), (7, 3), (5, 0), (2, 0), (1, 1))])
+        summary, runs = streaks.summarise(streaks.load_completions(self.db, "vector_habit"))
+        assert summary.names == ["vector_habit"]
+        assert summary.best.tolist() == [3]
+        assert summary.current.tolist() == [1]
+        assert summary.completions.tolist() == [4]
+        assert runs.length.tolist() == [3, 1]
+        assert summary.mean_streak.tolist() == [2.0]
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestHabitCache:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        Habit("cached", "cached", "daily").store(self.db)
+
+    def test_write_through(self):
+        cache = self.db.habit_cache
+        assert get_habit_names(self.db) == ["cached"]
+        assert get_habit_names(self.db) == ["cached"]
+        assert get_periodicity(self.db, "cached") == ("daily",)
+        assert cache.stats()["hits"] >= 2
+        Habit("cached", "changed", "weekly").update(self.db)
+        assert get_habit(self.db, "cached") == ("cached", "changed", "weekly")
+        Habit("cached_2", "cached_2", "daily").store(self.db)
+        assert sorted(get_habit_names(self.db)) == ["cached", "cached_2"]
+        Habit("cached", "", "").remove(self.db)
+        assert get_habit_names(self.db) == ["cached_2"]
+        assert get_habit(self.db, "cached") is None
+
+    def test_other_connection_invalidates(self):
+        assert get_habit_names(self.db) == ["cached"]
+        other = get_db("test.db")
+        update_habit(other, "cached", "changed", "weekly")
+        add_habit(other, "cached_2", "cached_2", "daily")
+        other.close()
+        assert get_periodicity(self.db, "cached") == ("weekly",)
+        assert sorted(get_habit_names(self.db)) == ["cached", "cached_2"]
+
+    def test_lru_eviction(self):
+        cache = self.db.habit_cache
+        cache.maxsize = 2
+        for i in range(3):
+            add_habit(self.db, f"lru {i}", "", "daily")
+        assert cache.stats()["habits"] == 2
+        assert cache.get("lru 0") is None
+        assert get_periodicity(self.db, "lru 0") == ("daily",)
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestProfiling:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        self.profiler = enable_profiling(self.db)
+
+    def test_statements_grouped(self):
+        set_action(self.db, "Add habit")
+        add_habit(self.db, "profiled", "profiled", "daily")
+        set_action(self.db, "Show habits")
+        assert len(get_habits(self.db)) == 1
+        get_tracker_data(self.db, "profiled")
+        summary = self.profiler.summary()
+        assert summary["by_action"]["Add habit"]["queries"] >= 2
+        assert summary["by_caller"]["db.get_habits"] == {"queries": 1, "rows": 1,
+                                                         "seconds": summary["by_caller"]["db.get_habits"]["seconds"]}
+        assert summary["by_caller"]["db.add_habit"]["rows"] == 2
+        assert summary["slowest"][0]["seconds"] >= summary["slowest"][-1]["seconds"]
+        self.profiler.dump("test_profile.json")
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+        if os.path.exists("test_profile.json"):
+            os.remove("test_profile.json")
+
+
+class TestTenants:
+
+    def test_shards_and_maintenance(self, tmp_path):
+        with ShardRegistry(str(tmp_path / "tenants.db")) as registry:
+            for tenant in ("alice", "bob", "carol/../x"):
+                db = registry.get_db(tenant)
+                add_habit(db, "habit", "habit", "daily")
+                if tenant == "bob":
+                    db.execute("UPDATE tracker SET date = ?", (days_ago(3),))
+                    db.commit()
+                db.close()
+            assert registry.shard_path("alice") != registry.shard_path("bob")
+            assert len(registry.shards()) == 3
+            report = run_maintenance(registry, "sweep", processes=2)
+            assert report["shards"] == 3
+            assert report["failed"] == {}
+            assert report["results"] == {"alice": 0, "bob": 1, "carol/../x": 0}
+            assert run_maintenance(registry, "rebuild_stats", processes=2)["total"] == 3
+
+
+class TestScriptedCli:
+
+    def test_commands(self, capsys):
+        assert main(["--db", "test.db", "add", "scripted", "--periodicity", "weekly"]) == 0
+        assert main(["--db", "test.db", "status", "scripted"]) == 0
+        assert main(["--db", "test.db", "complete", "missing"]) == 1
+        assert main(["--db", "test.db", "streak", "scriptd"]) == 1
+        assert main(["--db", "test.db", "streak", "scripted", "--longest"]) == 0
+        assert main(["--db", "test.db", "top", "-k", "1", "--periodicity", "weekly"]) == 0
+        assert main(["--db", "test.db", "changes", "--since", "0"]) == 0
+        output = capsys.readouterr()
+        assert "scripted: completed this week" in output.out
+        assert "scripted: longest streak 0 weeks" in output.out
+        assert "  1. scripted (weekly): 0 weeks" in output.out
+        assert f"1 {date.today()} add scripted description='' periodicity='weekly'" in output.out
+        assert 'Habit "missing" does not exist' in output.err
+        assert 'Habit "scriptd" does not exist, did you mean scripted?' in output.err
+
+    def test_profile_options(self):
+        args = build_parser().parse_args(["--profile", "status"])
+        assert args.profile and args.profile_output is None and args.command == "status"
+        args = build_parser().parse_args(["--profile-output", "session.json", "top"])
+        assert args.profile_output == "session.json" and args.command == "top"
+
+    def test_report_without_streaks(self, capsys):
+        db = get_db("test.db")
+        # A habit without a habit_stats row, as imports made before stats were refreshed for every habit left behind
+        db.execute("INSERT INTO habits VALUES ('unsummarised', '', 1)")
+        db.commit()
+        db.close()
+        assert main(["--db", "test.db", "report"]) == 0
+        assert "No streaks found" in capsys.readouterr().out
+
+    def test_batch_is_atomic(self, monkeypatch):
+        import io
+        monkeypatch.setattr("sys.stdin", io.StringIO("add first\n# comment\nadd second\ncomplete first\n"))
+        assert main(["--db", "test.db", "batch"]) == 0
+        monkeypatch.setattr("sys.stdin", io.StringIO("add third\ncomplete nobody\n"))
+        assert main(["--db", "test.db", "batch"]) == 1
+        db = get_db("test.db")
+        assert sorted(get_habit_names(db)) == ["first", "second"]
+
+        def lines():
+            # The batch holds the write lock from its start, before any command has run
+            other = get_db("test.db")
+            other.execute("PRAGMA busy_timeout = 0")
+            with pytest.raises(sqlite3.OperationalError):
+                other.execute("BEGIN IMMEDIATE")
+            other.close()
+            yield "status first"
+        assert run_batch(db, lines(), build_parser()) == 1
+        db.close()
+
+    def teardown_method(self):
+        import os
+        if os.path.exists("test.db"):
+            os.remove("test.db")
+
+
+class TestSnapshotReplica:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        add_habit(self.db, "replicated", "replicated", "daily")
+        self.db.execute("UPDATE tracker SET date = ?, streakCounter = 6", (days_ago(1),))
+        self.db.commit()
+
+    def test_snapshot_reads(self):
+        replica = SnapshotReplica("test.db", max_staleness=3600)
+        snapshot = replica.connection()
+        assert replica.path == "test.snapshot.db" and replica.staleness() < 3600
+        # Writes to the primary while the snapshot is read
+        complete_habit(self.db, "replicated")
+        add_habit(self.db, "unreplicated", "unreplicated", "weekly")
+        assert get_habit_names(snapshot) == ["replicated"]
+        assert get_streak_counter(snapshot, "replicated") == 6
+        assert top_streaks(snapshot, 1) == [StreakRank(1, "replicated", "daily", 6)]
+        assert replica.connection() is snapshot and replica.refreshes == 1
+        with pytest.raises(sqlite3.OperationalError):
+            break_streak(snapshot, "replicated")
+        snapshot = replica.refresh()
+        assert get_habit_names(snapshot) == ["replicated", "unreplicated"]
+        assert get_streak_counter(snapshot, "replicated") == 7
+        replica.max_staleness = 0
+        assert replica.connection() is not snapshot and replica.refreshes == 3
+        replica.close()
+
+    def test_snapshot_option(self, capsys):
+        assert main(["--db", "test.db", "--snapshot", "60", "streak", "replicated"]) == 0
+        assert main(["--db", "test.db", "complete", "replicated"]) == 0
+        # Within 60 seconds the snapshot is reused, so the completion does not show yet
+        assert main(["--db", "test.db", "--snapshot", "60", "top", "-k", "1"]) == 0
+        assert main(["--db", "test.db", "--snapshot", "0", "top", "-k", "1"]) == 0
+        output = capsys.readouterr().out.splitlines()
+        assert output[0] == "replicated: streak 6 days"
+        assert output[2:] == ["  1. replicated (daily): 6 days", "  1. replicated (daily): 7 days"]
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        for path in ("test.db", "test.snapshot.db"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class TestServer:
+
+    def setup_method(self):
+        import threading
+        self.server = HabitServer(("127.0.0.1", 0), "test.db", pool_size=2, cache_age=60)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def request(self, method, path, payload=None):
+        import http.client
+        import json
+        connection = http.client.HTTPConnection(*self.server.server_address)
+        connection.request(method, path, None if payload is None else json.dumps(payload))
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read())
+        connection.close()
+        return result
+
+    def test_endpoints(self):
+        assert self.request("POST", "/habits", {"name": "served daily"})[0] == 201
+        assert self.request("POST", "/habits", {"name": "served weekly", "periodicity": "weekly"})[0] == 201
+        assert self.request("POST", "/habits", {"name": "served daily"})[0] == 409
+        assert self.request("PUT", "/habits/served%20daily", {"periodicity": "fortnightly"})[0] == 400
+        assert self.request("GET", "/habits/missing")[0] == 404
+        assert [habit["name"] for habit in self.request("GET", "/habits")[1]] == ["served daily", "served weekly"]
+        status, habit = self.request("GET", "/habits/served%20weekly")
+        assert habit["status"] == 4 and habit["streak"] == 0
+        status, results = self.request("POST", "/batch/complete", {"names": ["served daily", "served weekly"]})
+        assert [result["completed"] for result in results] == [False, False]
+        assert self.request("POST", "/batch/complete", {"names": ["served daily", "missing"]})[0] == 404
+        assert self.request("GET", "/streaks/top?k=1&periodicity=weekly")[1] == [
+            {"rank": 1, "name": "served weekly", "periodicity": "weekly", "streak": 0}]
+        # Served from the cache, until a write empties it
+        self.request("GET", "/streaks/top?k=1&periodicity=weekly")
+        assert self.server.cache.hits == 1
+        assert self.request("POST", "/habits/served%20weekly/break")[1] == {"name": "served weekly", "streak": 0}
+        assert self.request("DELETE", "/habits/served%20weekly")[0] == 200
+        assert self.request("GET", "/streaks/top?k=1&periodicity=weekly")[1] == []
+        status, log = self.request("GET", "/changes?since=1")
+        # Breaking a streak that is already 0 today changes nothing and is not logged
+        assert log["seq"] == 3 and [change["kind"] for change in log["changes"]] == ["add", "remove"]
+        assert log["changes"][0] == {"seq": 2, "kind": "add", "name": "served weekly", "day": date.today().toordinal(),
+                                     "data": {"description": "", "periodicity": "weekly"}}
+
+    def test_cache_skips_responses_read_before_a_write(self):
+        cache = self.server.cache
+        generation = cache.generation
+        cache.clear()
+        cache.put("/habits", b"[]", generation)
+        assert cache.get("/habits") is None
+        cache.put("/habits", b"[]", cache.generation)
+        assert cache.get("/habits") == b"[]"
+
+    def test_load(self):
+        results = bench_http(habits=5, requests=200, clients=4)
+        assert results["complete"]["count"] + results["streak"]["count"] == 200
+
+    def teardown_method(self):
+        import os
+        self.server.shutdown()
+        self.server.server_close()
+        os.remove("test.db")
+
+
+class TestScheduler:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        self.today = date.today().toordinal()
+        for name, periodicity, days_ago in (("sched_done", "daily", 0), ("sched_ready", "daily", 1),
+                                            ("sched_broken", "daily", 3), ("sched_weekly", "weekly", 0),
+                                            ("sched_three", "every 3 days", 1)):
+            add_habit(self.db, name, name, periodicity)
+            self.db.execute("UPDATE tracker SET date = ? WHERE habitName = ?", (self.today - days_ago, name))
+        self.db.commit()
+        self.scheduler = DueScheduler.load(self.db)
+
+    def test_matches_habit_status(self):
+        names = get_habit_names(self.db)
+        due = [name for name in names if habit_status(self.db, name) in (1, 2)]
+        assert sorted(self.scheduler.due_now()) == sorted(due)
+        assert self.scheduler.broken() == [name for name in names if habit_status(self.db, name) == 2]
+        # Daily habits completed yesterday or today break at the end of today or tomorrow
+        midnight = day_start(self.today)
+        assert self.scheduler.breaking_within(24, midnight) == ["sched_ready"]
+        assert sorted(self.scheduler.breaking_within(48, midnight)) == ["sched_done", "sched_ready"]
+        assert self.scheduler.next_reminder(midnight, warn_hours=2) == (
+            day_start(self.today + 1) - timedelta(hours=2), "breaking", "sched_ready")
+        assert self.scheduler.next_reminder(day_start(self.today + 1)) == (day_start(self.today + 2), "breaking",
+                                                                             "sched_done")
+
+    def test_updates(self):
+        mark_complete(self.db, "sched_ready")
+        self.scheduler.refresh(self.db, "sched_ready")
+        mark_complete(self.db, "sched_broken")
+        self.scheduler.refresh(self.db, "sched_broken")
+        self.scheduler.remove("sched_three")
+        assert self.scheduler.due_now() == [] and self.scheduler.broken() == []
+        # Stale heap entries never come back, even when a habit returns to an earlier schedule
+        self.scheduler.set("sched_three", self.today, self.today)
+        self.scheduler.set("sched_three", self.today, self.today)
+        assert self.scheduler.due_now() == ["sched_three"] and len(self.scheduler) == 5
+
+    def test_reminder_loop(self):
+        import threading
+        import time
+        stop = threading.Event()
+        calls = []
+
+        def notify(due, breaking):
+            calls.append((due, breaking))
+            stop.set()
+        run_reminders(self.scheduler, notify, warn_hours=1, stop=stop)
+        assert calls == [(self.scheduler.due_now(), self.scheduler.breaking_within(1))]
+        # A change wakes the loop without a new reminder, stopping it needs a wake up as well
+        calls.clear()
+        stop.clear()
+        loop = threading.Thread(target=run_reminders, args=(self.scheduler, lambda *due: calls.append(due)),
+                                kwargs={"stop": stop}, daemon=True)
+        loop.start()
+        while not calls:
+            time.sleep(0.01)
+        self.scheduler.remove("sched_ready")
+        stop.set()
+        self.scheduler.wake()
+        loop.join(5)
+        assert not loop.is_alive() and len(calls) == 1
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestNameIndex:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        for name in ("Running", "reading", "read news", "rowing", "meditate"):
+            add_habit(self.db, name, name, "daily")
+        self.index = NameIndex.load(self.db)
+
+    def test_lookups(self):
+        assert len(self.index) == 5 and "Running" in self.index and "running" not in self.index
+        assert self.index.prefix("r") == ["read news", "reading", "rowing", "Running"]
+        assert self.index.prefix("RE", limit=1) == ["read news"]
+        assert self.index.prefix("x") == []
+        assert self.index.resolve("running") == "Running"
+        assert self.index.resolve("walking") is None
+        assert self.index.fuzzy("runing") == ["Running", "rowing"]
+        assert self.index.fuzzy("runing", max_distance=1) == ["Running"]
+        assert self.index.fuzzy("rewing") == ["rowing", "reading"]
+        assert self.index.suggest("med") == ["meditate"]
+        assert edit_distance("kitten", "sitting") == 3
+        assert edit_distance("kitten", "sitting", limit=1) == 2
+
+    def test_stays_in_sync(self):
+        self.index.add("Rest")
+        self.index.add("Rest")
+        self.index.remove("reading")
+        self.index.remove("reading")
+        assert self.index.prefix("re") == ["read news", "Rest"]
+        assert self.index.names == sorted(self.index.names, key=str.casefold)
+        # Two names differing only in case are ambiguous
+        self.index.add("running")
+        assert self.index.resolve("RUNNING") is None
+
     def teardown_method(self):
         import os
         self.db.close()
         os.remove("test.db")
+
+
+class TestChangeLog:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        self.received = []
+        self.callback = subscribe(self.db, self.received.append)
+
+    def test_log_and_tail(self):
+        add_habit(self.db, "logged", "first", "daily")
+        update_habit(self.db, "logged", "second", "every 2 days")
+        assert not complete_habit(self.db, "logged")
+        self.db.execute("UPDATE tracker SET date = date - 1 WHERE habitName = 'logged'")
+        self.db.commit()
+        assert complete_habit(self.db, "logged")
+        break_streak(self.db, "logged")
+        break_streak(self.db, "logged")
+        break_streak(self.db, "nope")
+        remove_habit(self.db, "logged")
+        remove_habit(self.db, "logged")
+        changes = get_changes(self.db)
+        assert [(change.seq, change.kind) for change in changes] == [
+            (1, "add"), (2, "update"), (3, "complete"), (4, "break"), (5, "remove")]
+        assert changes[1].data == {"description": "second", "periodicity": "every 2 days"}
+        assert changes[2].data == {"streak": 1} and changes[2].day == date.today().toordinal()
+        assert get_changes(self.db, since=3) == changes[3:] and get_changes(self.db, 1, limit=1) == changes[1:2]
+        # Each commit reaches subscribers as one list
+        assert [batch for batch in self.received] == [[change] for change in changes]
+        assert prune_changes(self.db, 4) == 4
+        add_habit(self.db, "logged", "again", "daily")
+        assert get_change_seq(self.db) == 6
+        assert [change.seq for change in get_changes(self.db)] == [5, 6]
+
+    def test_adding_an_existing_habit(self):
+        add_habit(self.db, "kept", "", "daily")
+        self.db.execute("UPDATE tracker SET date = date - 1, streakCounter = 5 WHERE habitName = 'kept'")
+        self.db.commit()
+        add_habit(self.db, "kept", "again", "weekly")
+        assert get_streak_counter(self.db, "kept") == 5 and get_habit(self.db, "kept")[1:] == ("", "daily")
+        assert [change.kind for change in get_changes(self.db)] == ["add"]
+
+    def test_failing_subscriber(self, caplog):
+        def fail(changes):
+            raise RuntimeError("subscriber failed")
+        later = []
+        subscribe(self.db, fail)
+        subscribe(self.db, later.append)
+        add_habit(self.db, "added", "", "daily")
+        assert "added" in get_habit_names(self.db)
+        remove_habit(self.db, "added")
+        # The writes finish, including their cache write-through, and later subscribers still hear of them
+        assert get_habit(self.db, "added") is None and "added" not in get_habit_names(self.db)
+        assert len(later) == 2 and "subscriber failed" in caplog.text
+
+    def test_dispatch_after_commit(self):
+        with transaction(self.db):
+            add_habit(self.db, "first", "", "daily")
+            add_habit(self.db, "second", "", "daily")
+            assert self.received == []
+        assert [[change.name for change in batch] for batch in self.received] == [["first", "second"]]
+        with pytest.raises(RuntimeError):
+            with transaction(self.db):
+                add_habit(self.db, "rolled back", "", "daily")
+                raise RuntimeError
+        assert len(self.received) == 1 and get_change_seq(self.db) == 2
+        self.db.execute("UPDATE tracker SET date = date - 3")
+        self.db.commit()
+        assert sweep_broken_streaks(self.db) == 2
+        assert [(change.kind, change.name) for change in self.received[1]] == [("break", "first"), ("break", "second")]
+        unsubscribe(self.db, self.callback)
+        update_habit(self.db, "first", "unsubscribed", "daily")
+        assert len(self.received) == 2 and get_changes(self.db, since=4)[0].kind == "update"
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestPeriods:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        for periodicity in ("daily", "weekly", "weekdays", "monthly", "every 3 days"):
+            add_habit(self.db, periodicity, periodicity, periodicity)
+
+    def test_due_dates(self):
+        # A Friday
+        self.db.execute("UPDATE tracker SET date = ?", (date(2024, 3, 15).toordinal(),))
+        assert get_due_dates(self.db, "daily") == ("2024-03-16", "2024-03-16")
+        assert get_due_dates(self.db, "weekly") == ("2024-03-18", "2024-03-24")
+        assert get_due_dates(self.db, "weekdays") == ("2024-03-18", "2024-03-18")
+        assert get_due_dates(self.db, "monthly") == ("2024-04-01", "2024-04-30")
+        assert get_due_dates(self.db, "every 3 days") == ("2024-03-18", "2024-03-20")
+        update_habit(self.db, "daily", "daily", "every 2 days")
+        assert get_habit(self.db, "daily") == ("daily", "daily", "every 2 days")
+        assert get_due_dates(self.db, "daily") == ("2024-03-17", "2024-03-18")
+        # The cache holds the canonical spelling, the same as the database returns
+        update_habit(self.db, "daily", "daily", "every 1 days")
+        assert get_habit(self.db, "daily") == ("daily", "daily", "daily")
+        update_habit(self.db, "daily", "daily", "every 07 days")
+        assert get_periodicity(self.db, "daily") == ("every 7 days",)
+        add_habit(self.db, "padded", "", "every 02 days")
+        assert get_habit(self.db, "padded")[2] == "every 2 days"
+
+    def test_status_and_sweep(self):
+        assert habit_status(self.db, "every 3 days") == 5
+        # A weekdays habit done today stays done over a following weekend, so it is done for the period
+        assert habit_status(self.db, "weekdays") == 5
+        assert habit_status(self.db, "monthly") == 5
+        self.db.execute("UPDATE tracker SET date = ? WHERE habitName = 'every 3 days'",
+                        (days_ago(4),))
+        assert habit_status(self.db, "every 3 days") == 1
+        self.db.execute("UPDATE tracker SET date = ? WHERE habitName = 'every 3 days'",
+                        (days_ago(6),))
+        assert habit_status(self.db, "every 3 days") == 2
+        # A habit without a periodicity has no deadline, so it counts as broken even when completed today
+        self.db.execute("INSERT INTO habits VALUES ('unscheduled', '', NULL)")
+        self.db.execute("INSERT INTO tracker VALUES (?, 'unscheduled', 4)", (days_ago(0),))
+        assert habit_status(self.db, "unscheduled") == 2
+        assert sweep_broken_streaks(self.db) == 2
+        assert habit_status(self.db, "every 3 days") == 5
+        assert get_streak_counter(self.db, "unscheduled") == 0
+        # Streaks already broken today are left alone, as break_streak leaves them
+        assert sweep_broken_streaks(self.db) == 0
+
+    def test_runs_follow_periods(self):
+        streaks = pytest.importorskip("streaks")
+        # Completions on Monday and on the Sunday of the following week continue a weekly streak
+        self.db.executemany("INSERT INTO tracker VALUES (?, 'weekly', ?)",
+                            [(date(2024, 3, 4).toordinal(), 1), (date(2024, 3, 17).toordinal(), 2),
+                             (date(2024, 4, 1).toordinal(), 3)])
+        summary, runs = streaks.summarise(streaks.load_completions(self.db, "weekly"))
+        assert runs.length.tolist() == [2, 1]
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestHabitRepository:
+
+    def setup_method(self):
+        generate_database("test.db", habits=30, years=1, seed=5)
+        self.db = get_db("test.db")
+
+    def test_bulk_status_and_sync(self):
+        repository = pytest.importorskip("repository").HabitRepository.load(self.db)
+        assert len(repository) == 30
+        assert repository.statuses().tolist() == [habit_status(self.db, name) for name in repository.names]
+        ready = repository.names_with_status(1)
+        broken = repository.names_with_status(2)
+        streaks_before = {name: get_streak_counter(self.db, name) for name in ready}
+        repository.complete(ready + broken)
+        assert set(repository.names_with_status(1) + repository.names_with_status(2)) == set()
+        received = []
+        subscribe(self.db, received.append)
+        # Written elsewhere first, so the sync skips it
+        assert complete_habit(self.db, ready[0])
+        assert repository.sync(self.db) == len(ready) + len(broken) - 1
+        synced = received[-1]
+        kinds = ["complete"] * (len(ready) - 1) + ["complete", "break"] * len(broken)
+        assert [change.kind for change in synced] == kinds
+        assert synced == get_changes(self.db, since=synced[0].seq - 1)
+        for name in ready:
+            assert get_streak_counter(self.db, name) == streaks_before[name] + 1
+        for name in broken:
+            assert get_streak_counter(self.db, name) == 0
+        assert repository.statuses().tolist() == [habit_status(self.db, name) for name in repository.names]
+
+    def test_broken_completion_changes(self):
+        repository = pytest.importorskip("repository").HabitRepository.load(self.db)
+        first, second = repository.names_with_status(2)[:2]
+        # Completing a broken habit extends its streak and then breaks it, through main.mark_complete or a sync alike
+        expected = [change for name in (first, second)
+                    for change in (("complete", name, {"streak": get_streak_counter(self.db, name) + 1}),
+                                   ("break", name, {}))]
+        seq = get_change_seq(self.db)
+        assert mark_complete(self.db, first) == 2
+        repository.complete([second])
+        repository.sync(self.db)
+        assert [(change.kind, change.name, change.data) for change in get_changes(self.db, since=seq)] == expected
+        assert get_streak_counter(self.db, first) == get_streak_counter(self.db, second) == 0
+
+    def test_habit_views(self):
+        repository = pytest.importorskip("repository").HabitRepository.load(self.db)
+        habit = repository["habit 000000"]
+        assert not hasattr(habit, "__dict__")
+        assert (habit.name, habit.periodicity) == get_habit(self.db, "habit 000000")[::2]
+        assert habit.get_streak(self.db) == get_streak_counter(self.db, "habit 000000")
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestReports:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        self.today = date.today().toordinal()
+        add_habit(self.db, "rated_daily", "rated_daily", "daily")
+        add_habit(self.db, "rated_weekly", "rated_weekly", "weekly")
+        self.db.execute("UPDATE tracker SET date = ?", (self.today - 9,))
+        self.db.executemany("INSERT INTO tracker VALUES (?, 'rated_daily', ?)",
+                            [(self.today - days, 9 - days) for days in range(1, 9)])
+        self.db.execute("INSERT INTO tracker VALUES (?, 'rated_weekly', 1)", (self.today - 2,))
+        self.db.commit()
+
+    def test_rolling_rates(self):
+        report = completion_report(self.db)
+        daily, weekly = report.habits
+        assert daily.completions == {7: 6, 30: 8, 365: 8}
+        assert daily.rates[7] == 6 / 7 and daily.rates[30] == 8 / 10
+        assert weekly.completions[7] == 1 and weekly.rates[7] == 1.0
+        assert weekly.expected[30] == 10 / 7
+        assert report.overall[30] == (8 + 1) / (10 + 10 / 7)
+        assert completion_report(self.db, chunk_size=1) == report
+
+    def test_heatmap(self):
+        daily = completion_report(self.db).habits[0]
+        drawing = render_heatmap(daily.heatmap)
+        assert drawing.count("#") == 8
+        assert len(drawing.splitlines()) == 7
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        os.remove("test.db")
+
+
+class TestCompaction:
+
+    def setup_method(self):
+        self.db = get_db("test.db")
+        self.today = date.today().toordinal()
+        add_habit(self.db, "compacted_daily", "compacted_daily", "daily")
+        add_habit(self.db, "compacted_weekly", "compacted_weekly", "weekly")
+        self.db.execute("UPDATE tracker SET date = ?", (self.today - 200,))
+        # A 120 day streak, broken and restarted 80 days ago
+        self.db.executemany("INSERT INTO tracker VALUES (?, 'compacted_daily', ?)",
+                            [(self.today - 200 + days, days if days <= 120 else days - 121) for days in range(1, 200)])
+        self.db.executemany("INSERT INTO tracker VALUES (?, 'compacted_weekly', ?)",
+                            [(self.today - 200 + 7 * weeks, weeks) for weeks in range(1, 28)])
+        self.db.commit()
+
+    def snapshot(self):
+        return ([get_tracker_data(self.db, name) for name in ("compacted_daily", "compacted_weekly")],
+                self.db.execute("SELECT * FROM habit_stats ORDER BY habitName").fetchall(),
+                completion_report(self.db, self.today))
+
+    def test_compaction_keeps_history(self):
+        before = self.snapshot()
+        counts = compact_tracker(self.db, keep_days=30)
+        assert counts == {"habits": 2, "segments": 3, "rows": 120 + 50 + 25}
+        assert self.db.execute("SELECT COUNT(*) FROM tracker").fetchone()[0] == 30 + 3
+        assert self.snapshot() == before
+        rebuild_habit_stats(self.db)
+        assert self.snapshot() == before
+        # Compacting again extends the existing segments
+        assert compact_tracker(self.db, keep_days=0)["segments"] == 2
+        assert self.snapshot() == before
+        assert export_data(self.db, "test_backup.csv") == 2 + 200 + 28
+
+    def test_streaks_after_compaction(self):
+        streaks = pytest.importorskip("streaks")
+        before = streaks.summarise(streaks.load_completions(self.db), self.today)[0]
+        compact_tracker(self.db, keep_days=10)
+        after = streaks.summarise(streaks.load_completions(self.db), self.today)[0]
+        assert all((a == b).all() for a, b in zip(before[1:], after[1:]))
+        complete_habit(self.db, "compacted_daily")
+        assert get_streak_counter(self.db, "compacted_daily") == 79
+        assert get_single_alltime_streak(self.db, "compacted_daily") == 120
+
+    def test_import_after_compaction(self):
+        compact_tracker(self.db, keep_days=30)
+        before = self.snapshot()
+        seq = get_change_seq(self.db)
+        export_data(self.db, "test_backup.csv")
+        # The export writes compacted days out as rows, importing it again must not add them back to tracker
+        assert import_data(self.db, "test_backup.csv") == {"habits": 2, "tracker": 200 + 28}
+        assert self.db.execute("SELECT COUNT(*) FROM tracker").fetchone()[0] == 30 + 3
+        assert self.snapshot() == before
+        assert get_change_seq(self.db) == seq
+
+    def teardown_method(self):
+        import os
+        self.db.close()
+        for path in ("test.db", "test_backup.csv"):
+            if os.path.exists(path):
+                os.remove(path)